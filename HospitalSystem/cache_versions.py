@@ -0,0 +1,32 @@
+"""
+Version counters for cache-aside data: entries are keyed under the current version and a
+change bumps it, so stale entries are never read again and simply expire.
+"""
+import time
+
+from django.core.cache import cache
+
+
+def get_versions(keys):
+    """Current value of every version counter in ``keys``, seeding the ones the cache does not hold."""
+    keys = list(keys)
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # Seed from the clock so an evicted counter never falls back to a version that is still cached
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def get_version(key):
+    return get_versions([key])[key]
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted: a fresh seed is already newer than anything cached under the old counter
+        get_version(key)
@@ -0,0 +1,121 @@
+import posixpath
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.utils.text import get_valid_filename
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from HospitalSystem.metrics import STORAGE_UPLOAD_DURATION
+
+DIRECT_UPLOAD_SALT = 'direct-upload'
+
+
+class InstrumentedS3Storage(S3Boto3Storage):
+    def _save(self, name, content):
+        with STORAGE_UPLOAD_DURATION.time(prefix=name.split('/', 1)[0]):
+            return super()._save(name, content)
+
+
+class MediaURLCache:
+    """
+    LRU of storage key -> URL. Entries live for ``ttl`` seconds, which should stay below the
+    signature lifetime so a cached pre-signed URL is never handed out after it has expired.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name, build):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(name)
+                return entry[0]
+
+        url = build(name)
+
+        with self.lock:
+            self.entries[name] = (url, now + self.ttl)
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return url
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+media_url_cache = MediaURLCache(settings.MEDIA_URL_CACHE['MAX_SIZE'], settings.MEDIA_URL_CACHE['TTL'])
+
+
+def media_url(file):
+    """URL of a FieldFile or storage key, signed at most once per key and TTL."""
+    name = getattr(file, 'name', file)
+    if not name:
+        return None
+    return media_url_cache.get(name, default_storage.url)
+
+
+def absolute_media_url(request, file):
+    url = media_url(file)
+    if url and request:
+        return request.build_absolute_uri(url)
+    return url
+
+
+class DirectUploadError(Exception):
+    pass
+
+
+def presign_upload(upload_to, file_name, file_type, max_size, **claims):
+    """
+    Issue a pre-signed S3 POST for a new object under ``upload_to`` so the client sends the bytes
+    straight to the bucket. The returned token carries the object key and ``claims`` and is what
+    the finalize endpoint accepts, so no pending-upload state has to be stored.
+    """
+    key = posixpath.join(upload_to, uuid.uuid4().hex, get_valid_filename(file_name))
+    fields = {'Content-Type': file_type} if file_type else {}
+    conditions = [['content-length-range', 1, max_size]]
+    conditions += [{'Content-Type': file_type}] if file_type else []
+
+    post = default_storage.bucket.meta.client.generate_presigned_post(
+        Bucket=default_storage.bucket_name,
+        Key=key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=settings.DIRECT_UPLOAD_EXPIRES,
+    )
+    return {
+        'url': post['url'],
+        'fields': post['fields'],
+        'upload_token': signing.dumps({'key': key, 'file_type': file_type, **claims}, salt=DIRECT_UPLOAD_SALT),
+    }
+
+
+def resolve_upload(upload_token, **claims):
+    """Check an upload token against ``claims`` and confirm the object reached the bucket."""
+    try:
+        data = signing.loads(upload_token, salt=DIRECT_UPLOAD_SALT, max_age=settings.DIRECT_UPLOAD_EXPIRES * 2)
+    except signing.BadSignature:
+        raise DirectUploadError("Invalid or expired upload token.")
+
+    if any(data.get(claim) != value for claim, value in claims.items()):
+        raise DirectUploadError("Upload token was issued for another request.")
+
+    try:
+        default_storage.bucket.meta.client.head_object(Bucket=default_storage.bucket_name, Key=data['key'])
+    except ClientError:
+        raise DirectUploadError("File has not been uploaded.")
+
+    return data
@@ -0,0 +1,361 @@
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    """
+    Process-local accumulator. Counters and histogram samples are kept as deltas and pushed to
+    the shared store every METRICS['FLUSH_INTERVAL'] seconds by a background thread, so every
+    gunicorn worker, the mailer and the WebSocket processes add up to one view in /metrics.
+    Gauges are pushed as this process's absolute values and summed over live processes.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.flusher_lock = threading.Lock()
+        self.deltas = defaultdict(float)
+        self.gauges = {}
+        self.flusher_pid = None
+
+    def register(self, metric):
+        self.families[metric.name] = metric
+
+    def register_collector(self, collector):
+        """``collector()`` runs before every flush, to refresh gauges that are cheaper to read than to track."""
+        self.collectors.append(collector)
+
+    def add(self, name, labels, amount):
+        self.ensure_flusher()
+        with self.lock:
+            self.deltas[name, labels] += amount
+
+    def set_gauge(self, name, labels, value):
+        self.ensure_flusher()
+        with self.lock:
+            self.gauges[name, labels] = value
+
+    def add_gauge(self, name, labels, amount):
+        self.ensure_flusher()
+        with self.lock:
+            self.gauges[name, labels] = self.gauges.get((name, labels), 0) + amount
+
+    def ensure_flusher(self):
+        # Started lazily and per pid, so forked workers each get their own thread
+        if self.flusher_pid == os.getpid():
+            return
+        with self.flusher_lock:
+            if self.flusher_pid == os.getpid():
+                return
+            with self.lock:
+                self.deltas.clear()
+                self.gauges.clear()
+            threading.Thread(target=self.flush_forever, name='metrics-flusher', daemon=True).start()
+            self.flusher_pid = os.getpid()
+
+    def reset_locks(self):
+        # A fork can happen while another thread holds a lock; that thread does not exist in the child
+        self.lock = threading.Lock()
+        self.flusher_lock = threading.Lock()
+
+    def flush_forever(self):
+        while True:
+            time.sleep(settings.METRICS['FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not flush metrics")
+
+    def flush(self):
+        for collector in self.collectors:
+            collector()
+        with self.lock:
+            deltas, self.deltas = self.deltas, defaultdict(float)
+            gauges = dict(self.gauges)
+        try:
+            get_store().push(deltas, gauges)
+        except Exception:
+            # Keep the samples for the next attempt instead of losing them
+            with self.lock:
+                for key, amount in deltas.items():
+                    self.deltas[key] += amount
+            raise
+
+    def expose(self):
+        self.flush()
+        samples, gauges = get_store().collect()
+        by_family = defaultdict(list)
+        for (name, labels), value in sorted({**samples, **gauges}.items(), key=sample_order):
+            # Histogram series are <family>_bucket, <family>_sum and <family>_count
+            family = name if name in self.families else name.rsplit('_', 1)[0]
+            # repr keeps every digit; the exposition format takes Python's float literals
+            by_family[family].append(f'{name}{format_labels(labels)} {float(value)!r}')
+
+        lines = []
+        for name in sorted(self.families):
+            family = self.families[name]
+            lines.append(f'# HELP {name} {family.documentation}')
+            lines.append(f'# TYPE {name} {family.kind}')
+            lines.extend(by_family[name])
+        return '\n'.join(lines) + '\n'
+
+
+def sample_order(item):
+    # Buckets sort by their numeric bound, +Inf last
+    (name, labels), _ = item
+    return name, tuple((key, float(value)) if key == 'le' else (key, value) for key, value in labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def flush_at_exit():
+    if registry.flusher_pid != os.getpid():
+        return
+    try:
+        registry.flush()
+    except Exception:
+        logger.exception("Could not flush metrics at exit")
+
+
+registry = Registry()
+os.register_at_fork(after_in_child=registry.reset_locks)
+atexit.register(flush_at_exit)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def labels(self, labels):
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        registry.add(self.name, self.labels(labels), amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        registry.set_gauge(self.name, self.labels(labels), value)
+
+    def inc(self, amount=1, **labels):
+        registry.add_gauge(self.name, self.labels(labels), amount)
+
+    def dec(self, amount=1, **labels):
+        registry.add_gauge(self.name, self.labels(labels), -amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        labels = self.labels(labels)
+        # Buckets are stored cumulatively so the store only ever adds; untouched ones still get a zero series
+        for bound in self.buckets:
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            registry.add(f'{self.name}_bucket', labels + (('le', le),), 1 if value <= bound else 0)
+        registry.add(f'{self.name}_sum', labels, value)
+        registry.add(f'{self.name}_count', labels, 1)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class InMemoryMetricsStore:
+    """Single-process store for tests and development."""
+
+    def __init__(self):
+        self.samples = defaultdict(float)
+        self.gauges = {}
+
+    def push(self, deltas, gauges):
+        for key, amount in deltas.items():
+            self.samples[key] += amount
+        self.gauges = gauges
+
+    def collect(self):
+        return dict(self.samples), dict(self.gauges)
+
+
+class RedisMetricsStore:
+    """
+    Counters live in one hash incremented by every process. Each process writes its gauges to its
+    own hash that expires unless refreshed, so a dead worker's open sockets stop being counted.
+    """
+
+    def __init__(self, url=None, prefix='metrics'):
+        self.client = redis.Redis.from_url(url or settings.REDIS_URL)
+        self.prefix = prefix
+
+    @property
+    def process_key(self):
+        return f'{self.prefix}:gauges:{socket.gethostname()}:{os.getpid()}'
+
+    @staticmethod
+    def encode(name, labels):
+        return json.dumps([name, labels])
+
+    @staticmethod
+    def decode(field):
+        name, labels = json.loads(field)
+        return name, tuple(tuple(label) for label in labels)
+
+    def push(self, deltas, gauges):
+        pipe = self.client.pipeline(transaction=False)
+        for (name, labels), amount in deltas.items():
+            pipe.hincrbyfloat(f'{self.prefix}:samples', self.encode(name, labels), amount)
+        pipe.delete(self.process_key)
+        if gauges:
+            pipe.hset(self.process_key, mapping={self.encode(*key): value for key, value in gauges.items()})
+            pipe.expire(self.process_key, int(settings.METRICS['FLUSH_INTERVAL'] * 3) + 1)
+        pipe.execute()
+
+    def collect(self):
+        samples = {
+            self.decode(field): float(value)
+            for field, value in self.client.hgetall(f'{self.prefix}:samples').items()
+        }
+        gauges = defaultdict(float)
+        for key in self.client.scan_iter(f'{self.prefix}:gauges:*'):
+            for field, value in self.client.hgetall(key).items():
+                gauges[self.decode(field)] += float(value)
+        return samples, dict(gauges)
+
+
+@lru_cache(maxsize=None)
+def get_store():
+    config = settings.METRICS
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', "Time spent in a view, middleware included.", ('view', 'method', 'status'),
+)
+HTTP_DB_QUERIES = Histogram(
+    'http_db_queries', "Database queries per request.", ('view',), buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+HTTP_DB_DURATION = Histogram('http_db_duration_seconds', "Database time per request.", ('view',))
+WEBSOCKET_CONNECTS = Counter('websocket_connects_total', "Accepted WebSocket connections.", ('consumer',))
+WEBSOCKET_DISCONNECTS = Counter('websocket_disconnects_total', "Closed accepted WebSocket connections.", ('consumer',))
+WEBSOCKET_OPEN = Gauge('websocket_open', "Currently open WebSocket connections.", ('consumer',))
+GROUP_SEND_DURATION = Histogram('channel_layer_group_send_seconds', "Latency of channel layer group_send.", ('source',))
+EMAIL_SEND_DURATION = Histogram('email_send_seconds', "Time to hand one email to the SMTP server.", ('status',))
+STORAGE_UPLOAD_DURATION = Histogram(
+    'storage_upload_seconds', "Time to store one file in the media bucket.", ('prefix',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Records latency, query count and database time for every request, labelled by view class."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with connections['default'].execute_wrapper(timer):
+            response = self.get_response(request)
+        view = getattr(request, 'metrics_view', '<unresolved>')
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - started, view=view, method=request.method, status=response.status_code,
+        )
+        HTTP_DB_QUERIES.observe(timer.count, view=view)
+        HTTP_DB_DURATION.observe(timer.duration, view=view)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'view_class', view_func)
+        request.metrics_view = f'{view.__module__}.{view.__qualname__}'
+
+
+class MetricsConsumerMixin:
+    """Counts accepted and closed sockets per consumer class and times ``group_send``."""
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        self.metrics_open = True
+        WEBSOCKET_CONNECTS.inc(consumer=type(self).__name__)
+        WEBSOCKET_OPEN.inc(consumer=type(self).__name__)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, 'metrics_open', False):
+            self.metrics_open = False
+            WEBSOCKET_DISCONNECTS.inc(consumer=type(self).__name__)
+            WEBSOCKET_OPEN.dec(consumer=type(self).__name__)
+        await super().websocket_disconnect(message)
+
+    async def group_send(self, group, message):
+        with GROUP_SEND_DURATION.time(source=type(self).__name__):
+            await self.channel_layer.group_send(group, message)
+
+
+def metrics_view(request):
+    token = settings.METRICS['TOKEN']
+    if not token:
+        raise Http404
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
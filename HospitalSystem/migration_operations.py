@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def add_unique_concurrently(table, name, columns):
+    """
+    Operations for a non-atomic migration that add a unique constraint without blocking writes:
+    the unique index is built concurrently, then attached as the constraint (a catalog-only change).
+    Wrap them in SeparateDatabaseAndState with the matching AddConstraint/AlterField as state.
+    """
+    return [
+        migrations.RunSQL(
+            f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" ({columns})',
+            reverse_sql=f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"',
+        ),
+        migrations.RunSQL(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" UNIQUE USING INDEX "{name}"',
+            reverse_sql=f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}"',
+        ),
+    ]
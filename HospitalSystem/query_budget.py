@@ -0,0 +1,123 @@
+import logging
+import random
+import re
+from collections import Counter
+from contextlib import ContextDecorator
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_IN_LIST = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_shape(sql):
+    """SQL with every value replaced, so the same statement for different rows compares equal."""
+    return _LITERAL.sub('?', _IN_LIST.sub('(%s, ...)', sql))
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that counts queries by shape."""
+
+    def __init__(self):
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.shapes[query_shape(sql)] += 1
+        return execute(sql, params, many, context)
+
+    @property
+    def count(self):
+        return sum(self.shapes.values())
+
+    def problems(self, max_queries, max_repeats):
+        problems = []
+        if max_queries is not None and self.count > max_queries:
+            problems.append(f"{self.count} queries, budget is {max_queries}")
+        for shape, times in self.shapes.most_common():
+            if times <= max_repeats:
+                break
+            problems.append(f"N+1: {times}x {shape[:300]}")
+        return problems
+
+
+class query_budget(ContextDecorator):
+    """
+    Record every query on the default connection inside the block and enforce a budget: at most
+    ``max_queries`` queries in total and no statement shape repeated more than ``max_repeats``
+    times. Usable around a test request, or as a decorator on the sync function behind a consumer
+    event (``database_sync_to_async`` runs it on one thread, so nothing else is recorded).
+    """
+
+    def __init__(self, max_queries=None, max_repeats=None, label=None, mode=None):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats if max_repeats is not None else settings.QUERY_BUDGET['MAX_REPEATS']
+        self.label = label
+        self.mode = mode or settings.QUERY_BUDGET['MODE']
+
+    def _recreate_cm(self):
+        # Each decorated call records into its own recorder
+        return type(self)(self.max_queries, self.max_repeats, self.label, self.mode)
+
+    def __enter__(self):
+        self.recorder = QueryRecorder()
+        self.wrapper = connections['default'].execute_wrapper(self.recorder)
+        self.wrapper.__enter__()
+        return self.recorder
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wrapper.__exit__(exc_type, exc, tb)
+        if exc_type is None:
+            enforce(self.recorder, self.max_queries, self.max_repeats, self.label, self.mode)
+        return False
+
+
+def assert_query_budget(max_queries=None, max_repeats=None, label=None):
+    """Test helper: like ``query_budget`` but always raises, whatever QUERY_BUDGET['MODE'] says."""
+    return query_budget(max_queries, max_repeats, label, mode='raise')
+
+
+def enforce(recorder, max_queries, max_repeats, label, mode):
+    problems = recorder.problems(max_queries, max_repeats)
+    if not problems:
+        return
+    message = f"{label or 'Query budget'} exceeded: " + '; '.join(problems)
+    if mode == 'raise':
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class QueryBudgetMiddleware:
+    """
+    Enforces the ``query_budget`` declared on a view class; views without one (the admin, the
+    schema, anything not yet measured) are left alone. In ``raise`` mode (test runs) a violation
+    fails the request; in ``warn`` mode a SAMPLE_RATE share of requests is checked and violations
+    are logged; ``off`` disables it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = settings.QUERY_BUDGET
+        if config['MODE'] == 'off' or (config['MODE'] == 'warn' and random.random() >= config['SAMPLE_RATE']):
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        with connections['default'].execute_wrapper(recorder):
+            response = self.get_response(request)
+
+        view = getattr(request, 'query_budget_view', None)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None:
+            enforce(recorder, budget, config['MAX_REPEATS'], f'{view.__module__}.{view.__qualname__}', config['MODE'])
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget_view = getattr(view_func, 'view_class', view_func)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+import sys
 from datetime import timedelta
 from pathlib import Path
 from environs import Env
@@ -29,6 +30,9 @@ SECRET_KEY = env.str('SECRET_KEY')
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = env.bool('DEBUG')
 
+# `manage.py test` (or TESTING=1) swaps Redis-backed services for in-process ones, see the end of this file
+TESTING = env.bool('TESTING', sys.argv[1:2] == ['test'])
+
 ALLOWED_HOSTS = env.list('ALLOWED_HOSTS')
 
 AUTH_USER_MODEL = 'users.User'
@@ -38,7 +42,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.RoleJWTAuthentication',
     ],
     'TIME_INPUT_FORMATS': ['%H:%M', ],
     'TIME_FORMAT': ['%H:%M', ],
@@ -100,10 +104,13 @@ INSTALLED_APPS = [
     'appointment',
     'medicalBook',
     'chat',
+    'mailer',
     'storages',
 ]
 
 MIDDLEWARE = [
+    'HospitalSystem.metrics.MetricsMiddleware',
+    'HospitalSystem.query_budget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -149,7 +156,7 @@ DATABASES = {
         'PASSWORD': env.str('DB_PASSWORD'),
         'HOST': env.str('DB_HOST'),
         'PORT': env.int('DB_PORT'),
-        'OPTIONS': {'sslmode': 'require'}
+        'OPTIONS': {'sslmode': env.str('DB_SSLMODE', 'require')}
     }
 }
 
@@ -176,14 +183,26 @@ PASSWORD_HASHERS = [
 ]
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp-mail.outlook.com'
-EMAIL_PORT = 587
+EMAIL_HOST = env.str('EMAIL_HOST', 'smtp-mail.outlook.com')
+EMAIL_PORT = env.int('EMAIL_PORT', 587)
 EMAIL_HOST_USER = env.str('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = env.str('EMAIL_HOST_PASSWORD')
-EMAIL_USE_TLS = True
+EMAIL_USE_TLS = env.bool('EMAIL_USE_TLS', True)
+EMAIL_TIMEOUT = env.int('EMAIL_TIMEOUT', 30)
 SERVER_EMAIL = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Outgoing mail is queued in mailer.OutboundEmail and sent by `manage.py send_outbox`
+OUTBOX = {
+    'BATCH_SIZE': env.int('OUTBOX_BATCH_SIZE', 50),
+    'MAX_ATTEMPTS': env.int('OUTBOX_MAX_ATTEMPTS', 5),
+    'BACKOFF': env.int('OUTBOX_BACKOFF', 30),
+    'MAX_BACKOFF': env.int('OUTBOX_MAX_BACKOFF', 60 * 60),
+    'POLL_INTERVAL': env.int('OUTBOX_POLL_INTERVAL', 5),
+    # Seconds a worker owns the rows it claimed; keep it above the time one batch can take to send
+    'LEASE': env.int('OUTBOX_LEASE', 15 * 60),
+}
+
 CORS_ALLOWED_ORIGINS = env.list('CORS_ALLOWED_ORIGINS')
 
 CORS_ORIGIN_WHITELIST = env.list('CORS_ORIGIN_WHITELIST')
@@ -233,15 +252,79 @@ ACCOUNT_UNIQUE_EMAIL = True
 
 REDIS_URL = env.str('REDIS_URL')
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    },
+}
+
+# Samples are pushed to the store by every process; /metrics needs "Authorization: Bearer <METRICS_TOKEN>"
+METRICS = {
+    'BACKEND': env.str('METRICS_BACKEND', 'HospitalSystem.metrics.RedisMetricsStore'),
+    'FLUSH_INTERVAL': env.float('METRICS_FLUSH_INTERVAL', 5),
+    'TOKEN': env.str('METRICS_TOKEN', None),
+}
+
+# Query budgets and N+1 detection for views that declare a ``query_budget`` attribute: 'raise'
+# fails the request (test runs, or QUERY_BUDGET_MODE=raise in CI), 'warn' logs for a SAMPLE_RATE
+# share of requests, 'off' disables
+QUERY_BUDGET = {
+    'MODE': env.str('QUERY_BUDGET_MODE', 'raise' if TESTING else 'warn'),
+    'SAMPLE_RATE': env.float('QUERY_BUDGET_SAMPLE_RATE', 0.01),
+    'MAX_REPEATS': env.int('QUERY_BUDGET_MAX_REPEATS', 5),
+}
+
+# WebSocket handshakes resolve users from this snapshot cache instead of the database
+USER_SNAPSHOT_CACHE_TIMEOUT = env.int('USER_SNAPSHOT_CACHE_TIMEOUT', 60)
+
+DOCTOR_DIRECTORY_CACHE_TIMEOUT = env.int('DOCTOR_DIRECTORY_CACHE_TIMEOUT', 300)
+
+# Entries are keyed by a per-doctor version bumped on every appointment change; the TTL only bounds memory
+AVAILABILITY_CACHE_TIMEOUT = env.int('AVAILABILITY_CACHE_TIMEOUT', 60 * 60)
+AVAILABILITY_MAX_DAYS = env.int('AVAILABILITY_MAX_DAYS', 31)
+AVAILABILITY_MAX_DOCTORS = env.int('AVAILABILITY_MAX_DOCTORS', 50)
+
+CHAT_HISTORY_PAGE_SIZE = env.int('CHAT_HISTORY_PAGE_SIZE', 50)
+
+CHAT_MEDIA_MAX_SIZE = env.int('CHAT_MEDIA_MAX_SIZE', 25 * 1024 * 1024)
+
+CHAT_MEDIA_MAX_PENDING_UPLOADS = env.int('CHAT_MEDIA_MAX_PENDING_UPLOADS', 3)
+
+CHAT_PRESENCE = {
+    'BACKEND': env.str('CHAT_PRESENCE_BACKEND', 'chat.presence.RedisPresence'),
+    'TTL': env.int('CHAT_PRESENCE_TTL', 60),
+}
+
+# Use channels_redis.pubsub.RedisPubSubChannelLayer for lower-latency fan-out without per-channel buffering.
+# Several hosts shard channels and groups across Redis instances.
+CHANNEL_LAYER_BACKEND = env.str('CHANNEL_LAYER_BACKEND', 'channels_redis.core.RedisChannelLayer')
+CHANNEL_LAYER_CONFIG = {
+    'hosts': env.list('CHANNEL_LAYER_HOSTS', [REDIS_URL]),
+}
+if CHANNEL_LAYER_BACKEND == 'channels_redis.core.RedisChannelLayer':
+    CHANNEL_LAYER_CONFIG.update({
+        'capacity': env.int('CHANNEL_LAYER_CAPACITY', 100),
+        'expiry': env.int('CHANNEL_LAYER_EXPIRY', 60),
+        'group_expiry': env.int('CHANNEL_LAYER_GROUP_EXPIRY', 86400),
+        # Per channel-name-pattern capacities, e.g. "http.request=200,specific.*=50"
+        'channel_capacity': env.dict('CHANNEL_LAYER_CHANNEL_CAPACITY', {}, subcast_values=int),
+    })
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [REDIS_URL],
-        },
+        'BACKEND': CHANNEL_LAYER_BACKEND,
+        'CONFIG': CHANNEL_LAYER_CONFIG,
     },
 }
 
+# Every signaling frame fans out to the whole call, so the participant count bounds its cost
+CONFERENCE_MAX_PARTICIPANTS = env.int('CONFERENCE_MAX_PARTICIPANTS', 8)
+# Frames queued per WebSocket before slow clients start losing lossy frames or get disconnected
+WEBSOCKET_OUTBOUND_HIGH_WATER = env.int('WEBSOCKET_OUTBOUND_HIGH_WATER', 256)
+# Trickle ICE candidates arriving within this many seconds are relayed to peers as one frame
+CONFERENCE_ICE_BATCH_WINDOW = env.float('CONFERENCE_ICE_BATCH_WINDOW', 0.05)
+
 AWS_ACCESS_KEY_ID = env.str('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = env.str('AWS_SECRET_ACCESS_KEY')
 
@@ -252,14 +335,35 @@ AWS_S3_FILE_OVERWRITE = False
 AWS_DEFAULT_ACL = None
 AWS_S3_VERIFY = True
 AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.{AWS_S3_REGION_NAME}.amazonaws.com'
+AWS_QUERYSTRING_EXPIRE = env.int('AWS_QUERYSTRING_EXPIRE', 3600)
+
+# Media URLs are memoized per storage key; keep the TTL under the signature lifetime
+MEDIA_URL_CACHE = {
+    'MAX_SIZE': env.int('MEDIA_URL_CACHE_MAX_SIZE', 10000),
+    'TTL': env.int('MEDIA_URL_CACHE_TTL', AWS_QUERYSTRING_EXPIRE * 9 // 10),
+}
 
 MEDIA_URL = f'https://{AWS_S3_CUSTOM_DOMAIN}/media/'
 
+DIRECT_UPLOAD_EXPIRES = env.int('DIRECT_UPLOAD_EXPIRES', 900)
+
+MEDICAL_TESTS_MAX_SIZE = env.int('MEDICAL_TESTS_MAX_SIZE', 50 * 1024 * 1024)
+
 STORAGES = {
     'default': {
-        'BACKEND': 'storages.backends.s3boto3.S3Boto3Storage',
+        'BACKEND': 'HospitalSystem.media.InstrumentedS3Storage',
     },
     'staticfiles': {
         'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
     },
 }
+
+if TESTING:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    CHAT_PRESENCE = {**CHAT_PRESENCE, 'BACKEND': 'chat.presence.InMemoryPresence'}
+    METRICS = {**METRICS, 'BACKEND': 'HospitalSystem.metrics.InMemoryMetricsStore'}
+    # No collectstatic before a test run, so there is no manifest to look names up in
+    STORAGES = {**STORAGES, 'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}}
+    # Test tables are created from the models: the seed migrations download avatars and upload them to S3
+    MIGRATION_MODULES = {app.rsplit('.', 1)[-1]: None for app in INSTALLED_APPS}
@@ -0,0 +1,26 @@
+"""Helpers shared by the apps' test modules."""
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+
+from users.models import User, Role
+
+
+def make_user(email, role):
+    return User.objects.create_user(email=email, roles=Role.objects.get_or_create(role=role)[0])
+
+
+@skipUnless(connection.vendor == 'postgresql', "The index names and plans are PostgreSQL's")
+class QueryPlanTestCase(TestCase):
+    """Checks which index PostgreSQL picks for a queryset."""
+
+    def setUp(self):
+        super().setUp()
+        # The test tables are tiny, where a sequential scan always wins
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"{index_name} is not in the plan:\n{plan}")
@@ -0,0 +1,217 @@
+import os
+import threading
+import time
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from HospitalSystem.metrics import (
+    EMAIL_SEND_DURATION, WEBSOCKET_CONNECTS, WEBSOCKET_OPEN, InMemoryMetricsStore, Registry, flush_at_exit, get_store,
+    registry,
+)
+from HospitalSystem.media import media_url_cache
+from HospitalSystem.query_budget import QueryBudgetExceeded
+from HospitalSystem.testing import make_user
+from chat.views import RecentlyChat
+from users.models import User, Role
+
+
+@override_settings(METRICS={**settings.METRICS, 'TOKEN': 'secret'})
+class MetricsViewTests(SimpleTestCase):
+
+    def setUp(self):
+        # A fresh store per test, so the samples below are the only ones with their labels
+        get_store.cache_clear()
+        self.addCleanup(get_store.cache_clear)
+
+    def scrape(self, token='secret'):
+        return self.client.get('/metrics', headers={'Authorization': f'Bearer {token}'} if token else {})
+
+    def test_tests_never_reach_redis(self):
+        self.assertIsInstance(get_store(), InMemoryMetricsStore)
+
+    @override_settings(METRICS={**settings.METRICS, 'TOKEN': None})
+    def test_hidden_without_a_token(self):
+        self.assertEqual(self.scrape().status_code, 404)
+
+    def test_requires_the_token(self):
+        for token in (None, 'wrong'):
+            with self.subTest(token=token):
+                response = self.scrape(token)
+                self.assertEqual(response.status_code, 401)
+                self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+
+    def test_large_values_keep_every_digit(self):
+        WEBSOCKET_CONNECTS.inc(1234567, consumer='BusyConsumer')
+        EMAIL_SEND_DURATION.observe(0.1234567891, status='precise')
+
+        lines = self.scrape().content.decode().splitlines()
+
+        self.assertIn('websocket_connects_total{consumer="BusyConsumer"} 1234567.0', lines)
+        self.assertIn('email_send_seconds_sum{status="precise"} 0.1234567891', lines)
+
+    def test_exposition(self):
+        WEBSOCKET_CONNECTS.inc(consumer='ProbeConsumer')
+        WEBSOCKET_CONNECTS.inc(consumer='ProbeConsumer')
+        WEBSOCKET_OPEN.inc(consumer='ProbeConsumer')
+        self.addCleanup(WEBSOCKET_OPEN.dec, consumer='ProbeConsumer')
+        EMAIL_SEND_DURATION.observe(0.2, status='probe')
+
+        response = self.scrape()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        for name, kind in (
+            ('websocket_connects_total', 'counter'), ('websocket_open', 'gauge'), ('email_send_seconds', 'histogram'),
+        ):
+            self.assertIn(f'# TYPE {name} {kind}', lines)
+            self.assertEqual(len([line for line in lines if line.startswith(f'# HELP {name} ')]), 1)
+        self.assertIn('websocket_connects_total{consumer="ProbeConsumer"} 2.0', lines)
+        self.assertIn('websocket_open{consumer="ProbeConsumer"} 1.0', lines)
+
+        probe = [line for line in lines if 'status="probe"' in line]
+        below, above = ('0.005', '0.01', '0.025', '0.05', '0.1'), ('0.25', '0.5', '1', '2.5', '5', '10', '+Inf')
+        self.assertEqual(probe, [
+            *(f'email_send_seconds_bucket{{status="probe",le="{le}"}} 0.0' for le in below),
+            *(f'email_send_seconds_bucket{{status="probe",le="{le}"}} 1.0' for le in above),
+            'email_send_seconds_count{status="probe"} 1.0',
+            'email_send_seconds_sum{status="probe"} 0.2',
+        ])
+
+
+class RegistryTests(SimpleTestCase):
+
+    def test_one_flusher_per_process(self):
+        fresh = Registry()
+        start = threading.Barrier(16)
+
+        def record():
+            start.wait()
+            fresh.add('probe_total', (), 1)
+
+        pid = os.getpid()
+
+        def slow_getpid():
+            # Widens the gap between checking the flusher and starting it
+            time.sleep(0.001)
+            return pid
+
+        workers = [threading.Thread(target=record) for _ in range(16)]
+        with mock.patch('HospitalSystem.metrics.threading.Thread') as thread, \
+                mock.patch('HospitalSystem.metrics.os.getpid', side_effect=slow_getpid):
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        thread.assert_called_once()
+        self.assertEqual(fresh.deltas[('probe_total', ())], 16)
+
+    def test_exit_flush_logs_store_errors(self):
+        with mock.patch.object(registry, 'flusher_pid', os.getpid()), \
+                mock.patch('HospitalSystem.metrics.get_store', side_effect=ConnectionError('store is down')):
+            with self.assertLogs('HospitalSystem.metrics', 'ERROR') as logs:
+                flush_at_exit()
+        self.assertIn('Could not flush metrics at exit', logs.output[0])
+
+
+@override_settings(QUERY_BUDGET={**settings.QUERY_BUDGET, 'MODE': 'raise'})
+class QueryBudgetMiddlewareTests(TestCase):
+
+    def test_views_without_a_budget_are_not_enforced(self):
+        Role.objects.create(role='admin')
+        admin = User.objects.create_superuser(email='admin@test.invalid', password='password')
+        self.client.force_login(admin)
+        for index in range(10):
+            make_user(f'user{index}@test.invalid', 'patient')
+
+        for url in ('/admin/', '/admin/users/user/', f'/admin/users/user/{admin.id}/change/'):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_declared_budget_fails_the_request(self):
+        client = APIClient()
+        client.force_authenticate(make_user('patient@test.invalid', 'patient'))
+        with mock.patch.object(RecentlyChat, 'query_budget', 0):
+            with self.assertRaisesMessage(QueryBudgetExceeded, 'chat.views.RecentlyChat exceeded'):
+                client.get('/chat/get_chat/')
+
+
+class MediaURLTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        media_url_cache.clear()
+        self.addCleanup(media_url_cache.clear)
+        role = Role.objects.get_or_create(role='doctor')[0]
+        # Seven distinct avatars and doctors without one, as on a real directory
+        User.objects.bulk_create(
+            User(email=f'doctor{index}@test.invalid', roles=role,
+                 avatar=f'users_avatars/{index % 8}.png' if index % 8 else '')
+            for index in range(500)
+        )
+
+    def test_each_avatar_is_signed_once_across_the_list(self):
+        with mock.patch('HospitalSystem.media.default_storage') as storage:
+            storage.url.side_effect = lambda name: f'https://bucket.invalid/{name}?signature'
+            avatars = []
+            for page in range(1, 6):
+                response = APIClient().get(f'/doctor/all/?page_size=100&page={page}')
+                self.assertEqual(response.status_code, 200)
+                avatars += [doctor['avatar'] for doctor in response.data['results']]
+
+        self.assertEqual(len(avatars), 500)
+        self.assertEqual(avatars.count(None), 63)
+        self.assertEqual(storage.url.call_count, 7)
+        signed = [call.args[0] for call in storage.url.call_args_list]
+        self.assertCountEqual(signed, [f'users_avatars/{index}.png' for index in range(1, 8)])
+
+
+@skipUnless(connection.vendor == 'postgresql', "CREATE INDEX CONCURRENTLY is PostgreSQL's")
+@override_settings(MIGRATION_MODULES={})
+class ConcurrentMigrationTests(TransactionTestCase):
+    """
+    Test runs build their tables from the models, so the non-atomic index migrations are run here
+    explicitly: each one is reversed and re-applied outside a transaction, as ``migrate`` would.
+    """
+
+    def constraints(self):
+        with connection.cursor() as cursor:
+            return {
+                table: set(connection.introspection.get_constraints(cursor, table))
+                for table in connection.introspection.table_names(cursor)
+            }
+
+    def test_non_atomic_migrations_round_trip(self):
+        loader = MigrationLoader(None)
+        keys = sorted(key for key, migration in loader.disk_migrations.items() if not migration.atomic)
+        self.assertIn(('patient', '0006_appointment_appointment_unique_doctor_slot'), keys)
+
+        # The model-built table names ChatRoom.name's unique constraint itself; chat/0012 names it
+        with connection.cursor() as cursor:
+            name_unique = next(
+                name for name, details in connection.introspection.get_constraints(cursor, 'chat_chatroom').items()
+                if details['unique'] and not details['primary_key'] and details['columns'] == ['name']
+            )
+            cursor.execute(f'ALTER TABLE chat_chatroom RENAME CONSTRAINT "{name_unique}" TO chat_chatroom_name_uniq')
+        before = self.constraints()
+
+        for key in reversed(keys):
+            with connection.schema_editor(atomic=False) as editor:
+                loader.graph.nodes[key].unapply(loader.project_state(key, at_end=False), editor)
+        removed = {name for table, names in before.items() for name in names - self.constraints()[table]}
+        self.assertLessEqual({
+            'chat_history_room_ts_idx', 'chat_history_unread_idx', 'chat_chatroom_name_uniq', 'chat_room_unique_pair',
+            'appointment_unique_doctor_slot', 'appointment_patient_date_idx', 'reset_password_token_idx',
+        }, removed)
+
+        for key in keys:
+            with connection.schema_editor(atomic=False) as editor:
+                loader.graph.nodes[key].apply(loader.project_state(key, at_end=False), editor)
+        self.assertEqual(self.constraints(), before)
@@ -6,6 +6,8 @@ from django.conf import settings
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
+from HospitalSystem.metrics import metrics_view
+
 media_and_static_url = [
     path('media/<path:path>', serve, kwargs={'document_root': settings.MEDIA_ROOT}),
     path('static/<path:path>', serve, kwargs={'document_root': settings.STATIC_ROOT}),
@@ -24,6 +26,7 @@ urlpatterns = [
     path('appointment/', include('appointment.urls')),
     path('book/', include('medicalBook.urls')),
     path('chat/', include('chat.urls')),
+    path('metrics', metrics_view),
 ]
 
 urlpatterns += media_and_static_url
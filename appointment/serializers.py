@@ -1,12 +1,15 @@
+from django.db import IntegrityError, transaction
+
 from patient.models import Appointment
 from rest_framework import serializers
 from users.models import User
+from .exceptions import SlotAlreadyBooked
 
 
 class AppointmentSerializer(serializers.ModelSerializer):
     patient_name = serializers.SerializerMethodField()
     doctor_name = serializers.SerializerMethodField()
-    doctor_id = serializers.SerializerMethodField()
+    doctor_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Appointment
@@ -19,12 +22,6 @@ class AppointmentSerializer(serializers.ModelSerializer):
     def get_doctor_name(self, obj):
         return f"{obj.doctor.first_name} {obj.doctor.last_name}"
 
-    def doctor_id(self, obj):
-        return obj.doctor.id
-
-    def patient_id(self, obj):
-        return obj.patient.id
-
 
 class CreateAppointmentSerializer(serializers.ModelSerializer):
     doctor = serializers.PrimaryKeyRelatedField(queryset=User.objects.filter(roles__role='doctor'))
@@ -36,6 +33,8 @@ class CreateAppointmentSerializer(serializers.ModelSerializer):
             'patient': {'required': False},
             'doctor': {'required': True},
         }
+        # No read-before-write uniqueness check: the slot constraint decides, see create()
+        validators = []
 
     def create(self, validated_data):
         doctor = validated_data['doctor']
@@ -48,12 +47,16 @@ class CreateAppointmentSerializer(serializers.ModelSerializer):
         date_str = validated_data.get('date')
         time_str = validated_data.get('time')
 
-        appointment = Appointment.objects.create(
-            patient=patient,
-            doctor=doctor,
-            date=date_str,
-            time=time_str,
-            message=validated_data.get('message', '')
-        )
+        try:
+            with transaction.atomic():
+                appointment = Appointment.objects.create(
+                    patient=patient,
+                    doctor=doctor,
+                    date=date_str,
+                    time=time_str,
+                    message=validated_data.get('message', '')
+                )
+        except IntegrityError:
+            raise SlotAlreadyBooked()
 
         return appointment
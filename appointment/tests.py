@@ -0,0 +1,105 @@
+import datetime
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from HospitalSystem.query_budget import assert_query_budget
+from HospitalSystem.testing import make_user
+from appointment.views import UserAppointmentsMixin
+from patient.models import Appointment
+from users.models import User, Role
+
+
+class AppointmentListQueryCountTests(TestCase):
+
+    def setUp(self):
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.patient = make_user('patient@test.invalid', 'patient')
+
+    def book(self, count):
+        # bulk_create skips Appointment.save(), whose clean() only accepts future slots
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        Appointment.objects.bulk_create(
+            Appointment(patient=self.patient, doctor=self.doctor, date=tomorrow + datetime.timedelta(days=day),
+                        time=datetime.time(9))
+            for day in range(count)
+        )
+
+    def get(self, user, url):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        # One query authenticates the user with its role, one reads the page with both names joined
+        with self.assertNumQueries(2), assert_query_budget(UserAppointmentsMixin.query_budget):
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    def test_query_count_does_not_grow_with_appointments(self):
+        for count in (1, 40):
+            Appointment.objects.all().delete()
+            self.book(count)
+            for user in (self.patient, self.doctor):
+                for url in ('/appointment/get/', '/appointment/get-all/'):
+                    with self.subTest(count=count, user=user.role, url=url):
+                        results = self.get(user, url)
+                        self.assertEqual(len(results), count)
+                        self.assertEqual(results[0]['doctor_name'], str(self.doctor))
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    workers = 32
+
+    def setUp(self):
+        self.patient_role = Role.objects.get_or_create(role='patient')[0]
+        self.doctor_role = Role.objects.get_or_create(role='doctor')[0]
+        self.day = datetime.date.today() + datetime.timedelta(days=1)
+
+    def make_users(self, prefix, role, count):
+        # bulk_create skips password hashing, which would dominate the setup
+        return User.objects.bulk_create(
+            User(email=f'{prefix}{index}@test.invalid', roles=role) for index in range(count)
+        )
+
+    def book_in_parallel(self, bookings):
+        """POST every (patient, doctor) booking from a pool of threads released at the same moment."""
+        start = threading.Barrier(self.workers)
+
+        def run(share):
+            client = APIClient()
+            start.wait()
+            try:
+                statuses = []
+                for patient, doctor in share:
+                    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(patient)}')
+                    statuses.append(client.post('/appointment/create/', {
+                        'doctor': doctor.id, 'date': self.day.isoformat(), 'time': '09:00:00',
+                    }).status_code)
+                return statuses
+            finally:
+                connections.close_all()
+
+        shares = [bookings[index::self.workers] for index in range(self.workers)]
+        with ThreadPoolExecutor(self.workers) as pool:
+            return Counter(status for statuses in pool.map(run, shares) for status in statuses)
+
+    def test_exactly_one_of_many_parallel_bookings_wins_a_slot(self):
+        doctor = self.make_users('doctor', self.doctor_role, 1)[0]
+        patients = self.make_users('patient', self.patient_role, 300)
+
+        statuses = self.book_in_parallel([(patient, doctor) for patient in patients])
+
+        self.assertEqual(statuses, Counter({201: 1, 409: 299}))
+        self.assertEqual(Appointment.objects.filter(doctor=doctor, date=self.day).count(), 1)
+
+    def test_parallel_bookings_for_different_doctors_all_succeed(self):
+        doctors = self.make_users('doctor', self.doctor_role, self.workers)
+        patients = self.make_users('patient', self.patient_role, self.workers)
+
+        statuses = self.book_in_parallel(list(zip(patients, doctors)))
+
+        self.assertEqual(statuses, Counter({201: self.workers}))
@@ -1,96 +1,94 @@
-from smtplib import SMTPDataError
-
 from datetime import timedelta
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 
 import rest_framework.generics as generics
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
 from drf_spectacular.utils import extend_schema
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework_simplejwt.authentication import JWTAuthentication
 
+from mailer.outbox import enqueue_template_email
 from patient.models import Appointment
+from users.authentication import RoleJWTAuthentication
+from .pagination import AppointmentCursorPagination
 from .serializers import CreateAppointmentSerializer, AppointmentSerializer
 
 
 class CreateAppointmentView(generics.CreateAPIView):
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (RoleJWTAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = CreateAppointmentSerializer
 
     @extend_schema(description="Create appointment")
     def perform_create(self, serializer):
         patient = self.request.user
-        if patient.roles.role == 'patient':
+        if patient.role == 'patient':
             if serializer.is_valid(raise_exception=True):
                 # Сохранение данных
                 appointment = serializer.save(patient=patient)
-                try:
-                    subject = f"Appointment created with {appointment.doctor.first_name} {appointment.doctor.last_name}"
-                    html_message = render_to_string('appointment_email.html', {
-                        'patient_name': patient.first_name,
-                        'doctor_name': appointment.doctor.first_name,
-                        'date': appointment.date,
-                        'time': appointment.time,
-                    })
-                    message = strip_tags(html_message)
-                    email = EmailMultiAlternatives(subject, message, to=[patient.email])
-                    email.send()
-                except SMTPDataError as e:
-                    pass
+                subject = f"Appointment created with {appointment.doctor.first_name} {appointment.doctor.last_name}"
+                enqueue_template_email(subject, 'appointment_email', {
+                    'patient_name': patient.first_name,
+                    'doctor_name': appointment.doctor.first_name,
+                    'date': appointment.date,
+                    'time': appointment.time,
+                }, [patient.email])
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class GetUpcomingAndRecentAppointmentsView(generics.ListAPIView):
-    authentication_classes = (JWTAuthentication,)
+class UserAppointmentsMixin:
+    authentication_classes = (RoleJWTAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = AppointmentSerializer
+    pagination_class = AppointmentCursorPagination
+    query_budget = 2
+
+    def get_user_appointments(self):
+        user = self.request.user
+        if user.role == 'patient':
+            appointments = Appointment.objects.filter(patient=user)
+        elif user.role == 'doctor':
+            appointments = Appointment.objects.filter(doctor=user)
+        else:
+            return Appointment.objects.none()
+
+        # Optional ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD range, both ends inclusive
+        for param, lookup in (('date_from', 'date__gte'), ('date_to', 'date__lte')):
+            value = self.request.query_params.get(param)
+            if value:
+                try:
+                    parsed = parse_date(value)
+                except ValueError:
+                    parsed = None
+                if parsed is None:
+                    raise ValidationError({param: "Invalid date format."})
+                appointments = appointments.filter(**{lookup: parsed})
+
+        # Both names are serialized for every row
+        return appointments.select_related('patient', 'doctor')
+
+
+class GetUpcomingAndRecentAppointmentsView(UserAppointmentsMixin, generics.ListAPIView):
 
     @extend_schema(description="Get upcoming and last three days' appointments for user")
     def get_queryset(self):
-        user = self.request.user
-        now = timezone.now()
-        three_days_ago = now - timedelta(days=3)
-
-        if user.roles.role == 'patient':
-            # Получаем записи пациента, которые еще не прошли или произошли за последние три дня
-            appointments = Appointment.objects.filter(
-                patient=user, date__gte=three_days_ago
-            ).order_by('date')
-            return appointments
-        elif user.roles.role == 'doctor':
-            # Получаем записи врача, которые еще не прошли или произошли за последние три дня
-            appointments = Appointment.objects.filter(
-                doctor=user, date__gte=three_days_ago
-            ).order_by('date')
-            return appointments
-        return None
-
-
-class GetAppointmentForUserView(generics.ListAPIView):
-    authentication_classes = (JWTAuthentication,)
-    permission_classes = (IsAuthenticated,)
-    serializer_class = AppointmentSerializer
+        three_days_ago = timezone.now() - timedelta(days=3)
+        # Получаем записи, которые еще не прошли или произошли за последние три дня
+        return self.get_user_appointments().filter(date__gte=three_days_ago)
+
+
+class GetAppointmentForUserView(UserAppointmentsMixin, generics.ListAPIView):
 
     @extend_schema(description="Get appointments for user")
     def get_queryset(self):
-        user = self.request.user
-        if user.roles.role == 'patient':
-            appointments = Appointment.objects.filter(patient=user).order_by('date')
-            return appointments
-        elif user.roles.role == 'doctor':
-            appointments = Appointment.objects.filter(doctor=user).order_by('date')
-            return appointments
-        return None
+        return self.get_user_appointments()
 
 
 class DeleteAppointmentView(generics.DestroyAPIView):
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (RoleJWTAuthentication,)
     permission_classes = (IsAuthenticated,)
     serializer_class = AppointmentSerializer
 
@@ -109,12 +107,12 @@ class DeleteAppointmentView(generics.DestroyAPIView):
 
         # Проверка прав доступа (разрешение только пациенту или доктору удалить свою запись)
         user = request.user
-        if user.roles.role == 'patient' and instance.patient != user:
+        if user.role == 'patient' and instance.patient != user:
             return Response(
                 {"detail": "You do not have permission to delete this appointment."},
                 status=status.HTTP_403_FORBIDDEN
             )
-        elif user.roles.role == 'doctor' and instance.doctor != user:
+        elif user.role == 'doctor' and instance.doctor != user:
             return Response(
                 {"detail": "You do not have permission to delete this appointment."},
                 status=status.HTTP_403_FORBIDDEN
@@ -16,7 +16,7 @@ export POETRY_VIRTUALENVS_IN_PROJECT=true
 export POETRY_NO_INTERACTION=1
 
 # Устанавливаем зависимости проекта
-poetry install --no-root
+poetry install --no-root --without dev
 
 # Собираем статические файлы
 python manage.py collectstatic --noinput
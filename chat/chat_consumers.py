@@ -1,33 +1,62 @@
 import base64
 import binascii
 import json
+import uuid
 from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.core.files.base import ContentFile
-from django.db.models import F
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
 
+from HospitalSystem.metrics import MetricsConsumerMixin
+from HospitalSystem.query_budget import query_budget
 from chat.models import ChatRoom, ChatHistory
-from chat.utils import format_message, format_notification
+from chat.outbound import OutboundQueueMixin, COALESCE, DROP_OLDEST
+from chat.presence import PresenceConsumerMixin
+from chat.uploads import MediaUpload, UploadError
+from chat.utils import format_message, format_notification, format_message_values, encode_history_cursor, \
+    decode_history_cursor, dumps_frame, MESSAGE_FIELDS
+
+
+@database_sync_to_async
+@query_budget(1, label='chat.chat_consumers.mark_room_as_read')
+def mark_room_as_read(room_id, reader_id):
+    # One UPDATE for the whole backlog, RETURNING tells the other side which messages flipped
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {ChatHistory._meta.db_table} SET read_status = true '
+            'WHERE room_id = %s AND sender_id <> %s AND read_status = false '
+            'RETURNING id',
+            [room_id, reader_id]
+        )
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def merge_read_receipts(queued, new):
+    return {**queued, 'ids': sorted(set(queued['ids']) | set(new['ids']))}
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(MetricsConsumerMixin, PresenceConsumerMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
 
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.user = self.scope['user']
 
-        self.room = await ChatRoom.objects.aget(name=self.room_name)
+        self.room = await ChatRoom.objects.select_related('doctor', 'patient').aget(name=self.room_name)
 
         if self.user.is_anonymous:
             await self.close()
         else:
-            await self.update_active_users(increment=True)
+            self.counterpart_id = self.room.patient_id if self.user.id == self.room.doctor_id else self.room.doctor_id
+            self.uploads = {}
 
             self.room_group_name = f'chat_{self.room_name}'
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
+            await self.join_presence()
 
             await self.accept()
 
@@ -36,81 +65,73 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_history()
 
     async def disconnect(self, close_code):
-        await self.update_active_users(increment=False)
+        for upload in getattr(self, 'uploads', {}).values():
+            upload.close()
+
+        await self.leave_presence()
 
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def update_active_users(self, increment=True):
-        if increment:
-            self.room.active_users = F('active_users') + 1
-        else:
-            self.room.active_users = F('active_users') - 1
-
-        await self.room.asave()
-
-        updated_room = await ChatRoom.objects.aget(name=self.room_name)
-
-        return updated_room.active_users
+    async def counterpart_is_present(self):
+        return await self.presence.is_present(self.room_group_name, self.counterpart_id)
 
     async def mark_unread_messages_as_read(self):
-        active_users = await ChatRoom.objects.aget(name=self.room_name)
-        async for message in ChatHistory.objects.filter(
-                room=self.room,
-                read_status=False,
-        ).select_related('sender', 'room', 'replied_to'):
-
-            if message.sender != self.user:
-                message.read_status = True
-                await message.asave()
-                if active_users.active_users == 2:
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'update_status',
-                            'id': message.id,
-                            "read_status:": True,
-                        }
-                    )
-
-    async def send_history(self):
-        history = []
-        async for messages in (ChatHistory.objects.filter(room=self.room)
-                .order_by('timestamp')
-                .select_related('sender', 'room', 'replied_to')):
-            formatted_message = await format_message(messages)
-            history.append(formatted_message)
-        await self.send(text_data=json.dumps({'type': 'chat_history', 'messages': history}))
-
-    async def create_notification(self, new_message):
-        active_users = await ChatRoom.objects.aget(name=self.room_name)
+        read_ids = await mark_room_as_read(self.room.id, self.user.id)
 
-        if active_users.active_users == 1:
-            other_user = await sync_to_async(
-                lambda: self.room.patient if self.scope['user'] == self.room.doctor else self.room.doctor)()
-
-            notification_data = await format_notification(new_message)
-
-            await self.channel_layer.group_send(
-                f'notification_{other_user.id}',
+        if read_ids:
+            await self.group_send(
+                self.room_group_name,
                 {
-                    'type': 'send_notification',
-                    'notification': notification_data
+                    'type': 'messages_read',
+                    'ids': read_ids,
                 }
             )
 
-    async def create_message(self, new_message):
-        active_users = await ChatRoom.objects.aget(name=self.room_name)
+    async def send_history(self, cursor=None):
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        queryset = ChatHistory.objects.filter(room=self.room)
+
+        if cursor:
+            try:
+                timestamp, message_id = decode_history_cursor(cursor)
+            except ValueError:
+                await self.send_error('Invalid history cursor.')
+                return
+            queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+        # Newest first so the (room, timestamp, id) index serves the page, one extra row tells if more remain
+        page = []
+        async for row in queryset.order_by('-timestamp', '-id').values(*MESSAGE_FIELDS)[:page_size + 1]:
+            page.append(row)
+
+        has_more = len(page) > page_size
+        page = page[:page_size]
+
+        await self.send(text_data=dumps_frame({
+            'type': 'older_messages' if cursor else 'chat_history',
+            'messages': [format_message_values(row) for row in reversed(page)],
+            'cursor': encode_history_cursor(page[-1]['timestamp'], page[-1]['id']) if has_more else None,
+            'has_more': has_more,
+        }))
 
-        if active_users.active_users == 2:
-            new_message.read_status = True
-            await new_message.asave()
+    async def create_notification(self, new_message):
+        notification_data = format_notification(new_message)
 
-        formatted_message = await format_message(new_message)
+        await self.group_send(
+            f'notification_{self.counterpart_id}',
+            {
+                'type': 'send_notification',
+                'notification': notification_data
+            }
+        )
 
-        await self.channel_layer.group_send(
+    async def create_message(self, new_message):
+        formatted_message = format_message(new_message)
+
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
@@ -118,9 +139,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }
         )
 
-        await self.create_notification(new_message)
+        # Read status was decided from presence before the insert: unread means the counterpart is away
+        if not new_message.read_status:
+            await self.create_notification(new_message)
+
+    async def send_error(self, detail):
+        await self.send(text_data=dumps_frame({'type': 'error', 'detail': detail}))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            # Binary frame: 16 bytes of upload id followed by a chunk of the file
+            if len(bytes_data) < 16:
+                await self.send_error("Invalid media chunk.")
+                return
+            await self.handle_media_chunk(uuid.UUID(bytes=bytes_data[:16]), bytes_data[16:])
+            return
 
-    async def receive(self, text_data):
         data = json.loads(text_data)
         message_type = data.get('type', 'text')
 
@@ -128,25 +162,37 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.handle_text_message(data)
         elif message_type == 'media':
             await self.handle_media_message(data)
+        elif message_type == 'media_start':
+            await self.handle_media_start(data)
+        elif message_type == 'media_chunk':
+            await self.handle_media_chunk_message(data)
+        elif message_type == 'media_cancel':
+            await self.handle_media_cancel(data)
         elif message_type == 'edit':
             await self.handle_edit_message(data)
         elif message_type == 'delete':
             await self.handle_delete_message(data)
+        elif message_type == 'load_more':
+            cursor = data.get('cursor')
+            if cursor:
+                await self.send_history(cursor=cursor)
+
+    async def get_replied_to(self, replied_to_id):
+        # Only messages of this room can be quoted; anything else is sent as a plain message
+        if replied_to_id:
+            return await ChatHistory.objects.filter(room=self.room, id=replied_to_id).afirst()
+        return None
 
     async def handle_text_message(self, data):
         message = data['message']
         sender = self.scope['user']
-        replied_to_id = data.get('replied_to', None)
-
-        replied_to_message = None
-        if replied_to_id:
-            replied_to_message = await ChatHistory.objects.aget(id=replied_to_id)
 
         new_message = await ChatHistory.objects.acreate(
             room=self.room,
             sender=sender,
             message=message,
-            replied_to=replied_to_message
+            replied_to=await self.get_replied_to(data.get('replied_to', None)),
+            read_status=await self.counterpart_is_present()
         )
 
         await self.create_message(new_message)
@@ -161,27 +207,120 @@ class ChatConsumer(AsyncWebsocketConsumer):
         return base64_string
 
     async def handle_media_message(self, data):
-        media_data = data['media']
-        file_name = data.get('file_name', None)
-        file_type = data.get('file_type', None)
-        sender = self.scope['user']
-        replied_to_id = data.get('replied_to', None)
+        # Legacy single-frame upload, kept for older clients; goes through the same spool-and-store path
+        if not isinstance(data.get('media'), str):
+            await self.send_error("Invalid media chunk.")
+            return
+
+        try:
+            media_data = self.validate_and_add_padding(data['media'])
+            upload = MediaUpload(
+                file_name=data.get('file_name', None),
+                file_type=data.get('file_type', None),
+                size=len(media_data) // 4 * 3 - media_data.count('=', -2),
+                replied_to_id=data.get('replied_to', None),
+            )
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        try:
+            upload.write(base64.b64decode(media_data))
+        except (UploadError, binascii.Error) as e:
+            upload.close()
+            await self.send_error(str(e))
+            return
+
+        await self.store_media_upload(upload)
+
+    async def handle_media_start(self, data):
+        if len(self.uploads) >= settings.CHAT_MEDIA_MAX_PENDING_UPLOADS:
+            await self.send_error("Too many uploads in progress.")
+            return
+
+        try:
+            upload = MediaUpload(
+                file_name=data.get('file_name', None),
+                file_type=data.get('file_type', None),
+                size=int(data['size']),
+                replied_to_id=data.get('replied_to', None),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            await self.send_error(str(e))
+            return
 
-        media_data = await sync_to_async(self.validate_and_add_padding)(media_data)
+        self.uploads[upload.id] = upload
+        await self.send(text_data=dumps_frame({'type': 'media_upload', 'upload_id': str(upload.id)}))
 
-        replied_to_message = None
-        if replied_to_id:
-            replied_to_message = await ChatHistory.objects.aget(id=replied_to_id)
-
-        media_file = ContentFile(base64.b64decode(media_data), name=f"{file_name}")
+    @staticmethod
+    def parse_upload_id(value):
+        if not isinstance(value, str):
+            raise ValueError("Invalid upload id.")
+        try:
+            return uuid.UUID(value)
+        except ValueError:
+            raise ValueError("Invalid upload id.")
+
+    async def handle_media_chunk_message(self, data):
+        # Text fallback for clients that cannot send binary frames: the chunk arrives base64-encoded
+        try:
+            upload_id = self.parse_upload_id(data.get('upload_id'))
+            chunk = base64.b64decode(data.get('data', ''))
+        except (TypeError, binascii.Error):
+            await self.send_error("Invalid media chunk.")
+            return
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        await self.handle_media_chunk(upload_id, chunk)
+
+    async def handle_media_cancel(self, data):
+        try:
+            upload_id = self.parse_upload_id(data.get('upload_id'))
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        self.discard_upload(upload_id)
+
+    async def handle_media_chunk(self, upload_id, chunk):
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            await self.send_error("Unknown upload.")
+            return
+
+        try:
+            upload.write(chunk)
+        except UploadError as e:
+            self.discard_upload(upload_id)
+            await self.send_error(str(e))
+            return
+
+        if upload.complete:
+            del self.uploads[upload_id]
+            await self.store_media_upload(upload)
+
+    def discard_upload(self, upload_id):
+        upload = self.uploads.pop(upload_id, None)
+        if upload is not None:
+            upload.close()
+
+    async def store_media_upload(self, upload):
+        try:
+            # The storage upload runs off the event loop and off the shared ORM thread
+            media_name = await sync_to_async(upload.save_to_storage, thread_sensitive=False)()
+        finally:
+            upload.close()
 
         new_message = await ChatHistory.objects.acreate(
             room=self.room,
-            sender=sender,
-            media=media_file,
-            file_type=file_type,
+            sender=self.scope['user'],
+            media=media_name,
+            file_type=upload.file_type,
             message='',
-            replied_to=replied_to_message
+            replied_to=await self.get_replied_to(upload.replied_to_id),
+            read_status=await self.counterpart_is_present()
         )
 
         await self.create_message(new_message)
@@ -190,14 +329,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message_id = data['message_id']
         new_message = data['new_message']
 
-        message = await ChatHistory.objects.aget(id=message_id)
+        message = await ChatHistory.objects.select_related('replied_to').aget(id=message_id)
         message.message = new_message
         message.is_edited = True
         await message.asave()
 
-        formatted_message = await format_message(message)
+        formatted_message = format_message(message)
 
-        await self.channel_layer.group_send(
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'edit_message',
@@ -208,13 +347,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def handle_delete_message(self, data):
         message_id = data['message_id']
 
-        message = await ChatHistory.objects.aget(id=message_id)
+        message = await ChatHistory.objects.select_related('replied_to').aget(id=message_id)
         message.is_deleted = True
         await message.asave()
 
-        formatted_message = await format_message(message)
+        formatted_message = format_message(message)
 
-        await self.channel_layer.group_send(
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'delete_message',
@@ -225,7 +364,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def chat_message(self, event):
         message = event['messages']
 
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_frame({
             'type': 'chat_message',
             'messages': message
         }))
@@ -233,7 +372,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def delete_message(self, event):
         message = event['messages']
 
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_frame({
             'type': 'delete_message',
             'messages': message
         }))
@@ -241,24 +380,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def edit_message(self, event):
         message = event['messages']
 
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_frame({
             'type': 'edit_message',
             'messages': message
         }))
 
-    async def update_status(self, event):
-        id = event['id']
-        read_status = event['read_status:']
-
-        await self.send(text_data=json.dumps({
-            'type': 'update_status',
-            'id': id,
-            "read_status:": read_status
-        }))
+    async def messages_read(self, event):
+        # Receipts still waiting in the queue are folded into one frame
+        await self.send_frame({
+            'type': 'messages_read',
+            'ids': event['ids'],
+        }, COALESCE, key='messages_read', merge=merge_read_receipts)
 
     async def send_notification(self, event):
         notification = event['notification']
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'notification',
             'notification': notification
-        }))
+        }, DROP_OLDEST, key='notification')
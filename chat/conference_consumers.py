@@ -1,13 +1,28 @@
+import asyncio
 import json
 
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 
-from django.db.models import F
-
+from HospitalSystem.metrics import MetricsConsumerMixin
 from chat.models import ChatRoom
+from chat.outbound import OutboundQueueMixin, DROP_OLDEST, DISCONNECT
+from chat.presence import PresenceConsumerMixin
+
+SIGNALING_TYPES = {'signal', 'offer', 'answer'}
+MEDIA_KINDS = ('audio', 'video', 'screen')
 
 
-class ConferenceConsumer(AsyncWebsocketConsumer):
+class ConferenceConsumer(MetricsConsumerMixin, PresenceConsumerMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
+    """
+    Multi-party WebRTC signaling relay. Each participant is identified by its channel name and
+    registered in presence with its user and media state. Frames carrying ``to`` go to that
+    participant only; the rest go to every other participant. Either way the client's text is
+    forwarded as is, with ``from`` appended, and never echoed back. Trickle ICE candidates are held
+    for CONFERENCE_ICE_BATCH_WINDOW and relayed together as one ``ice_candidates`` frame. When a
+    client falls behind, candidates and participant updates are dropped first; losing a session
+    description closes the socket instead.
+    """
 
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
@@ -19,6 +34,21 @@ class ConferenceConsumer(AsyncWebsocketConsumer):
             await self.close()
         else:
             self.room_group_name = f'conference_{self.room_name}'
+            self.peers = set()
+            self.pending_candidates = {}
+            self.candidate_flush = None
+            self.state = {
+                'user_id': self.user.id,
+                'name': f"{self.user.first_name} {self.user.last_name}",
+                'media': dict.fromkeys(MEDIA_KINDS, False),
+            }
+
+            await self.join_presence()
+            if await self.presence.count(self.room_group_name) > settings.CONFERENCE_MAX_PARTICIPANTS:
+                await self.leave_presence()
+                await self.close(code=4009)
+                return
+            await self.presence.set_state(self.room_group_name, self.channel_name, self.state)
 
             await self.channel_layer.group_add(
                 self.room_group_name,
@@ -26,123 +56,111 @@ class ConferenceConsumer(AsyncWebsocketConsumer):
             )
 
             await self.accept()
+            self.admitted = True
 
-            active_users = await self.update_active_users(increment=True)
+            await self.send(json.dumps({'type': 'joined', 'id': self.channel_name}))
+            await self.broadcast_participants('join')
 
-    async def update_active_users(self, increment=True):
-        if increment:
-            self.room.active_voice_users = F('active_voice_users') + 1
-        else:
-            self.room.active_voice_users = F('active_voice_users') - 1
-        await self.room.asave()
+    async def broadcast_participants(self, event):
+        participants = await self.presence.participants(self.room_group_name)
 
-        updated_room = await ChatRoom.objects.aget(name=self.room_name)
-
-        await self.channel_layer.group_send(
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'active_users',
-                'users': updated_room.active_voice_users,
+                'event': event,
+                'participant': self.channel_name,
+                'participants': [{'id': channel_name, **state} for channel_name, state in participants.items()],
             }
         )
-        return updated_room.active_voice_users
 
     async def disconnect(self, close_code):
-        active_users = await self.update_active_users(increment=False)
+        if not getattr(self, 'admitted', False):
+            return
+
+        await self.flush_candidates()
+        await self.leave_presence()
 
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        type = text_data_json.get('type')
-        if type == 'signal':
-            signal = text_data_json.get('signal')
-            await self.send_signals(signal)
-        elif type == 'ice_candidate':
-            candidate = text_data_json.get('candidate')
-            await self.send_ice_candidate(candidate)
-        elif type == 'offer':
-            sdp_offer = text_data_json.get('sdp')
-            await self.send_offers(sdp_offer)
-        elif type == 'answer':
-            sdp_answer = text_data_json.get('sdp')
-            await self.send_answers(sdp_answer)
-
-    async def send_signals(self, signal):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'signal',
-                'signal': signal if signal else None,
-            }
-        )
-
-    async def send_signal(self, event):
-        signal = event['signal']
-
-        await self.send(json.dumps({
-            'type': 'signal',
-            'signal': signal,
-        }))
-
-    async def send_offers(self, sdp):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'send_offer',
-                'offer': sdp if sdp else None,
-            }
-        )
-
-    async def send_offer(self, event):
-        offer = event['offer']
-
-        await self.send(json.dumps({
-            'type': 'offer',
-            'sdp': offer,
-        }))
-
-    async def send_ice_candidate(self, candidate):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'ice_candidate',
-                'candidate': candidate,
-            }
-        )
-
-    async def send_answers(self, sdp):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'send_answer',
-                'answer': sdp if sdp else None,
-            }
-        )
-
-    async def send_answer(self, event):
-        answer = event['answer']
-
-        await self.send(json.dumps({
-            'type': 'answer',
-            'sdp': answer,
-        }))
-
-    async def ice_candidate(self, event):
-        candidate = event['candidate']
-
-        await self.send(json.dumps({
-            'type': 'ice_candidate',
-            'candidate': candidate,
-        }))
+        await self.broadcast_participants('leave')
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Decoded only to route; peers receive text_data unchanged apart from the appended sender
+        try:
+            frame = json.loads(text_data)
+        except (TypeError, ValueError):
+            frame = None
+        # stamp() splices into the text, so only JSON objects can be relayed
+        if not isinstance(frame, dict):
+            await self.send(json.dumps({'type': 'error', 'detail': 'Invalid frame.'}))
+            return
+        frame_type = frame.get('type')
+        to = frame.get('to')
+        # A list or object "to" would raise on the set lookup
+        if to is not None and (not isinstance(to, str) or to not in self.peers):
+            await self.send(json.dumps({'type': 'error', 'detail': 'Unknown participant.', 'to': to}))
+            return
+
+        if frame_type == 'ice_candidate':
+            self.pending_candidates.setdefault(to, []).append(self.stamp(text_data))
+            if self.candidate_flush is None:
+                self.candidate_flush = asyncio.create_task(self.flush_candidates_later())
+        elif frame_type in SIGNALING_TYPES:
+            # Keep candidates behind the description they belong to
+            await self.flush_candidates()
+            await self.relay(to, {'type': 'relay_frame', 'text': self.stamp(text_data), 'policy': DISCONNECT})
+        elif frame_type == 'media_state':
+            self.state['media'].update({kind: bool(frame[kind]) for kind in MEDIA_KINDS if kind in frame})
+            await self.presence.set_state(self.room_group_name, self.channel_name, self.state)
+            await self.broadcast_participants('media_state')
+
+    def stamp(self, text_data):
+        # Appended last so a client-supplied "from" cannot win
+        return f'{text_data.rstrip()[:-1]},"from":{json.dumps(self.channel_name)}}}'
+
+    async def relay(self, to, message):
+        for peer in [to] if to is not None else self.peers:
+            await self.channel_layer.send(peer, message)
+
+    async def flush_candidates_later(self):
+        await asyncio.sleep(settings.CONFERENCE_ICE_BATCH_WINDOW)
+        self.candidate_flush = None
+        await self.flush_candidates()
+
+    async def flush_candidates(self):
+        if self.candidate_flush is not None:
+            self.candidate_flush.cancel()
+            self.candidate_flush = None
+
+        pending, self.pending_candidates = self.pending_candidates, {}
+        for to, candidates in pending.items():
+            if len(candidates) == 1:
+                await self.relay(to, {
+                    'type': 'relay_frame', 'text': candidates[0], 'policy': DROP_OLDEST, 'key': 'ice_candidates',
+                })
+            else:
+                await self.relay(to, {'type': 'relay_candidates', 'candidates': candidates})
+
+    async def relay_frame(self, event):
+        await self.send_frame(event['text'], event['policy'], key=event.get('key'))
+
+    async def relay_candidates(self, event):
+        # Each element is a client frame that is already JSON, so the batch is spliced rather than re-encoded
+        text = '{"type":"ice_candidates","candidates":[' + ','.join(event['candidates']) + ']}'
+        await self.send_frame(text, DROP_OLDEST, key='ice_candidates')
 
     async def active_users(self, event):
-        active_voice_users = event['users']
+        participants = event['participants']
+        self.peers = {participant['id'] for participant in participants} - {self.channel_name}
 
-        await self.send(json.dumps({
+        await self.send_frame({
             'type': 'active_users',
-            'users': active_voice_users
-        }))
+            'users': len(participants),
+            'event': event['event'],
+            'participant': event['participant'],
+            'participants': participants,
+        }, DROP_OLDEST, key='active_users')
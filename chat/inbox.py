@@ -0,0 +1,41 @@
+from django.db.models import OuterRef, Subquery, Count, IntegerField, DateTimeField, F
+from django.db.models.functions import Coalesce, Left
+
+from .models import ChatRoom, ChatHistory
+
+INBOX_SNIPPET_LENGTH = 100
+
+
+def inbox_queryset(user):
+    """
+    The user's rooms with counterpart, last message preview, last activity and unread count,
+    all in a single query. The last-message subqueries are backed by chat_history_room_ts_idx.
+    """
+    if user.role == 'doctor':
+        rooms = ChatRoom.objects.filter(doctor=user).select_related('patient')
+    elif user.role == 'patient':
+        rooms = ChatRoom.objects.filter(patient=user).select_related('doctor')
+    else:
+        return ChatRoom.objects.none()
+
+    last_message = ChatHistory.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+    unread = (
+        ChatHistory.objects
+        .filter(room=OuterRef('pk'), read_status=False)
+        .exclude(sender_id=user.id)
+        .order_by()
+        .values('room')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+
+    return rooms.annotate(
+        last_message=Subquery(last_message.values(snippet=Left('message', INBOX_SNIPPET_LENGTH))[:1]),
+        last_message_type=Subquery(last_message.values('file_type')[:1]),
+        last_message_deleted=Subquery(last_message.values('is_deleted')[:1]),
+        last_sender_id=Subquery(last_message.values('sender_id')[:1]),
+        last_activity=Coalesce(
+            Subquery(last_message.values('timestamp')[:1]), F('created_at'), output_field=DateTimeField()
+        ),
+        unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), 0),
+    )
@@ -0,0 +1,67 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Measure group_send delivery latency of the configured channel layer with simulated sockets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000, help="Number of simulated consumer channels")
+        parser.add_argument('--group-size', type=int, default=2, help="Members per group (2 for a chat room)")
+        parser.add_argument('--messages', type=int, default=20, help="Messages sent to every group")
+        parser.add_argument('--interval', type=float, default=0.05, help="Seconds between rounds of sends")
+        parser.add_argument('--layer', default='default', help="CHANNEL_LAYERS alias to benchmark")
+
+    def handle(self, *args, **options):
+        latencies, elapsed = asyncio.run(self.run(**options))
+        if not latencies:
+            self.stderr.write("No messages were delivered")
+            return
+
+        expected = options['sockets'] // options['group_size'] * options['group_size'] * options['messages']
+        percentiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"delivered {len(latencies)}/{expected} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} msg/s)\n"
+            f"latency ms: p50={percentiles[49]:.2f} p95={percentiles[94]:.2f} p99={percentiles[98]:.2f} "
+            f"max={max(latencies):.2f}"
+        )
+
+    async def run(self, sockets, group_size, messages, interval, layer, **options):
+        channel_layer = get_channel_layer(layer)
+        prefix = f'bench_{uuid.uuid4().hex[:8]}'
+        groups = [f'{prefix}_{index}' for index in range(sockets // group_size)]
+        channels = [await channel_layer.new_channel() for _ in range(len(groups) * group_size)]
+        for index, channel in enumerate(channels):
+            await channel_layer.group_add(groups[index // group_size], channel)
+
+        latencies = []
+        # Allow stragglers a little while after the last round before counting them as lost
+        deadline = messages * interval + 30
+
+        async def consume(channel):
+            for _ in range(messages):
+                message = await channel_layer.receive(channel)
+                latencies.append((time.perf_counter() - message['sent']) * 1000)
+
+        consumers = [asyncio.create_task(consume(channel)) for channel in channels]
+        started = time.perf_counter()
+        try:
+            for _ in range(messages):
+                await asyncio.gather(*(
+                    channel_layer.group_send(group, {'type': 'bench.message', 'sent': time.perf_counter()})
+                    for group in groups
+                ))
+                await asyncio.sleep(interval)
+            await asyncio.wait(consumers, timeout=deadline)
+        finally:
+            elapsed = time.perf_counter() - started
+            for consumer in consumers:
+                consumer.cancel()
+            for index, channel in enumerate(channels):
+                await channel_layer.group_discard(groups[index // group_size], channel)
+        return latencies, elapsed
@@ -0,0 +1,70 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import ChatRoom, ChatHistory
+from chat.routing import websocket_urlpatterns
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = "Measure ChatConsumer connect latency (handshake to first history page) as a room's history grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='0,1000,10000,100000', help="Comma-separated message counts to grow the room through",
+        )
+        parser.add_argument('--connects', type=int, default=20, help="Connections measured at every size")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Messages inserted per bulk_create")
+
+    def handle(self, *args, **options):
+        if options['connects'] < 2:
+            raise CommandError("--connects must be at least 2 to compute percentiles")
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        prefix = f'bench_{uuid.uuid4().hex[:8]}'
+        doctor = User.objects.create_user(email=f'{prefix}_doctor@bench.invalid')
+        patient = User.objects.create_user(email=f'{prefix}_patient@bench.invalid')
+        room = ChatRoom.objects.create(name=prefix, doctor=doctor, patient=patient)
+
+        try:
+            stored = 0
+            for size in sizes:
+                while stored < size:
+                    batch = min(options['batch_size'], size - stored)
+                    # Already read, so every connect measures the history page and not a one-off UPDATE
+                    ChatHistory.objects.bulk_create(
+                        ChatHistory(room=room, sender=patient, message=f'message {stored + index}', read_status=True)
+                        for index in range(batch)
+                    )
+                    stored += batch
+
+                latencies = asyncio.run(self.run(room.name, doctor, options['connects']))
+                percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+                self.stdout.write(
+                    f"{size:>9} messages: p50={percentiles[49]:.2f} p95={percentiles[94]:.2f} "
+                    f"max={max(latencies):.2f} ms"
+                )
+        finally:
+            # Cascades to the room and its messages
+            User.objects.filter(id__in=[doctor.id, patient.id]).delete()
+
+    async def run(self, room_name, user, connects):
+        application = URLRouter(websocket_urlpatterns)
+        latencies = []
+        for _ in range(connects):
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{room_name}/')
+            communicator.scope['user'] = user
+            started = time.perf_counter()
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError("ChatConsumer refused the connection")
+            while (await communicator.receive_json_from(timeout=30))['type'] != 'chat_history':
+                pass
+            latencies.append((time.perf_counter() - started) * 1000)
+            await communicator.disconnect()
+        return latencies
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatRoom, ChatHistory
+from chat.utils import format_message, format_notification, format_message_values, dumps_frame, orjson
+from users.models import User
+
+logger = logging.getLogger('chat')
+
+
+# The formatters as they were before they became plain functions, kept here as the baseline
+
+@sync_to_async
+def legacy_format_notification(message):
+    sender = message.sender
+    room = message.room
+    logger.info(f"Форматируем уведомление: {message}")
+    return {
+        'room_name': room.name,
+        'sender_id': sender.id,
+        'sender_name': f"{sender.first_name} {sender.last_name}",
+        **{'sender_avatar': None},
+        **{'content': message.message if message.message else None},
+        **{'media': None},
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+@sync_to_async
+def legacy_format_message(message):
+    logger.info(f"Форматируем сообщение: {message}")
+    return {
+        'id': message.id,
+        'sender': message.sender.id,
+        **{'content': message.message if message.message else None},
+        **{'media': None},
+        **{'file_type': message.file_type if message.file_type else None},
+        'timestamp': message.timestamp.isoformat(),
+        **{'replied_to': message.replied_to.message if message.replied_to else None},
+        'is_edited': message.is_edited,
+        'is_deleted': message.is_deleted,
+        'is_read': message.read_status,
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare the chat frame formatters against the former sync_to_async ones on in-memory messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000, help="Messages formatted per run")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per formatter; the fastest is reported")
+
+    def handle(self, *args, **options):
+        messages, rows = self.build(options['messages'])
+        cases = [
+            ('legacy format_message (sync_to_async)', lambda: self.run_legacy(legacy_format_message, messages)),
+            ('format_message', lambda: [format_message(message) for message in messages]),
+            ('format_message_values', lambda: [format_message_values(row) for row in rows]),
+            ('legacy format_notification (sync_to_async)',
+             lambda: self.run_legacy(legacy_format_notification, messages)),
+            ('format_notification', lambda: [format_notification(message) for message in messages]),
+        ]
+        frame = {'type': 'chat_history', 'messages': [format_message(message) for message in messages]}
+        cases += [
+            ('json.dumps frame', lambda: json.dumps(frame)),
+            (f"dumps_frame ({'orjson' if orjson else 'json fallback'})", lambda: dumps_frame(frame)),
+        ]
+
+        for name, case in cases:
+            best = min(self.timed(case) for _ in range(options['repeat']))
+            self.stdout.write(
+                f"{name:<45} {best * 1000:9.2f} ms  {best / options['messages'] * 1e6:7.2f} us/message"
+            )
+
+    @staticmethod
+    def build(count):
+        # Unsaved rows with every relation attached, so neither side touches the database
+        doctor = User(id=1, first_name='Doctor', last_name='Bench')
+        patient = User(id=2, first_name='Patient', last_name='Bench')
+        room = ChatRoom(id=1, name='bench', doctor=doctor, patient=patient)
+        timestamp = datetime.now(timezone.utc)
+        messages, rows = [], []
+        for index in range(count):
+            sender = doctor if index % 2 else patient
+            replied_to = messages[-1] if index % 10 == 1 else None
+            message = ChatHistory(
+                id=index + 1, room=room, sender=sender, message=f'message {index}', timestamp=timestamp,
+                replied_to=replied_to,
+            )
+            messages.append(message)
+            rows.append({
+                'id': message.id, 'sender_id': sender.id, 'message': message.message, 'media': '',
+                'file_type': None, 'timestamp': timestamp,
+                'replied_to__message': replied_to.message if replied_to else None,
+                'is_edited': False, 'is_deleted': False, 'read_status': False,
+            })
+        return messages, rows
+
+    @staticmethod
+    def run_legacy(formatter, messages):
+        async def run():
+            return [await formatter(message) for message in messages]
+        return asyncio.run(run())
+
+    @staticmethod
+    def timed(case):
+        started = time.perf_counter()
+        case()
+        return time.perf_counter() - started
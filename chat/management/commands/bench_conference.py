@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+import json
+import uuid
+from collections import Counter
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import ChatRoom
+from chat.presence import get_presence
+from chat.routing import websocket_urlpatterns
+from users.models import User
+
+LAYER_OPERATIONS = ('send', 'group_send', 'group_add', 'group_discard')
+PRESENCE_OPERATIONS = ('join', 'heartbeat', 'leave', 'is_present', 'count', 'channels', 'set_state', 'participants')
+
+
+class Command(BaseCommand):
+    help = (
+        "Count socket frames, channel layer operations and presence operations while N participants join a "
+        "conference, negotiate a full mesh (offer, answer, trickle ICE) and leave"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=4, help="Participants joining the call one by one")
+        parser.add_argument('--candidates', type=int, default=20, help="ICE candidates each side sends per peer")
+        parser.add_argument(
+            '--candidate-interval', type=float, default=0.01, help="Seconds between one participant's candidates",
+        )
+
+    def handle(self, *args, **options):
+        if not 2 <= options['participants'] <= settings.CONFERENCE_MAX_PARTICIPANTS:
+            raise CommandError(f"--participants must be between 2 and {settings.CONFERENCE_MAX_PARTICIPANTS}")
+        prefix = f'bench_{uuid.uuid4().hex[:8]}'
+        users = [
+            User.objects.create_user(email=f'{prefix}_{index}@bench.invalid')
+            for index in range(options['participants'])
+        ]
+        ChatRoom.objects.create(name=prefix, doctor=users[0], patient=users[1])
+
+        layer, presence = Counted(get_channel_layer(), LAYER_OPERATIONS), Counted(get_presence(), PRESENCE_OPERATIONS)
+        try:
+            with layer, presence:
+                phases = asyncio.run(self.run(prefix, users, options, layer, presence))
+        finally:
+            # Cascades to the room
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        for name, counts in phases.items():
+            frames, layer_calls, presence_calls = (f"{sum(calls.values())} ({self.format(calls)})" for calls in counts)
+            self.stdout.write(f"{name}: frames {frames}; layer {layer_calls}; presence {presence_calls}")
+
+    async def run(self, room_name, users, options, layer, presence):
+        application = URLRouter(websocket_urlpatterns)
+        sockets, ids = [], []
+        frames = Counter()
+        candidates = Counter()
+        phases = {}
+
+        async def receive(communicator):
+            frame = json.loads(await communicator.receive_from(timeout=10))
+            frames[frame['type']] += 1
+            if frame['type'] == 'ice_candidate':
+                candidates['delivered'] += 1
+            elif frame['type'] == 'ice_candidates':
+                candidates['delivered'] += len(frame['candidates'])
+            return frame
+
+        async def phase(name, step):
+            frames.clear()
+            layer.calls.clear()
+            presence.calls.clear()
+            await step()
+            # Whatever is still queued or waiting out the ICE batch window belongs to this phase
+            await asyncio.sleep(settings.CONFERENCE_ICE_BATCH_WINDOW * 2)
+            for communicator in sockets:
+                while not await communicator.receive_nothing(timeout=0.05):
+                    await receive(communicator)
+            phases[name] = (Counter(frames), Counter(layer.calls), Counter(presence.calls))
+
+        async def join():
+            for user in users:
+                communicator = WebsocketCommunicator(application, f'/ws/conference/{room_name}/')
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise RuntimeError("ConferenceConsumer refused the connection")
+                ids.append((await receive(communicator))['id'])
+                sockets.append(communicator)
+                # Everyone learns about the newcomer before it starts negotiating
+                for other in sockets:
+                    while True:
+                        frame = await receive(other)
+                        if frame['type'] == 'active_users' and frame['participant'] == ids[-1]:
+                            break
+
+        async def negotiate():
+            # Full mesh: every participant offers to those who joined before it and they answer
+            for index, communicator in enumerate(sockets):
+                for peer in range(index):
+                    await communicator.send_to(text_data=json.dumps({'type': 'offer', 'to': ids[peer], 'sdp': 'v=0'}))
+                    await sockets[peer].send_to(
+                        text_data=json.dumps({'type': 'answer', 'to': ids[index], 'sdp': 'v=0'})
+                    )
+            await asyncio.gather(*(self.trickle(index, sockets, ids, options) for index in range(len(sockets))))
+
+        async def leave():
+            for communicator in sockets:
+                await communicator.disconnect()
+
+        await phase('join', join)
+        await phase('negotiate', negotiate)
+        await phase('leave', leave)
+
+        expected = len(users) * (len(users) - 1) * options['candidates']
+        if candidates['delivered'] != expected:
+            self.stderr.write(f"{candidates['delivered']} of {expected} ICE candidates were delivered")
+        return phases
+
+    @staticmethod
+    async def trickle(index, sockets, ids, options):
+        for candidate in range(options['candidates']):
+            for peer in range(len(sockets)):
+                if peer != index:
+                    await sockets[index].send_to(text_data=json.dumps({
+                        'type': 'ice_candidate', 'to': ids[peer], 'candidate': f'candidate:{candidate}',
+                    }))
+            await asyncio.sleep(options['candidate_interval'])
+
+    @staticmethod
+    def format(calls):
+        return ' '.join(f'{name}={count}' for name, count in sorted(calls.items())) or '-'
+
+
+class Counted:
+    """
+    Counts calls to the named coroutine methods of ``target`` while used as a context manager.
+    Calls the methods make to each other, like InMemoryChannelLayer's group_send fanning out
+    through send, are not counted.
+    """
+
+    def __init__(self, target, names):
+        self.target = target
+        self.names = names
+        self.calls = Counter()
+        self.inside = contextvars.ContextVar('inside', default=False)
+
+    def __enter__(self):
+        for name in self.names:
+            setattr(self.target, name, self.wrap(name, getattr(self.target, name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name in self.names:
+            delattr(self.target, name)
+
+    def wrap(self, name, method):
+        async def counted(*args, **kwargs):
+            if self.inside.get():
+                return await method(*args, **kwargs)
+            self.calls[name] += 1
+            token = self.inside.set(True)
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.inside.reset(token)
+        return counted
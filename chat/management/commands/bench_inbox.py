@@ -0,0 +1,76 @@
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.models import ChatRoom, ChatHistory
+from chat.views import RecentlyChat
+from users.models import User, Role
+
+
+class Command(BaseCommand):
+    help = "Measure the doctor's inbox (RecentlyChat's first page) latency and query count as the room count grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='10,100,1000', help="Comma-separated room counts to grow the inbox through",
+        )
+        parser.add_argument('--messages', type=int, default=20, help="Messages stored in every room")
+        parser.add_argument('--requests', type=int, default=20, help="Requests measured at every size")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 2:
+            raise CommandError("--requests must be at least 2 to compute percentiles")
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        prefix = f'bench_{uuid.uuid4().hex[:8]}'
+        doctor_role = Role.objects.get_or_create(role='doctor')[0]
+        patient_role = Role.objects.get_or_create(role='patient')[0]
+        doctor = User.objects.create_user(email=f'{prefix}_doctor@bench.invalid', roles=doctor_role)
+        patients = []
+
+        try:
+            for size in sizes:
+                while len(patients) < size:
+                    patient = User.objects.create_user(
+                        email=f'{prefix}_patient{len(patients)}@bench.invalid', roles=patient_role,
+                    )
+                    room = ChatRoom.objects.create(name=f'{prefix}_{len(patients)}', doctor=doctor, patient=patient)
+                    # The patient has the last word, so every room carries unread messages for the doctor
+                    ChatHistory.objects.bulk_create(
+                        ChatHistory(room=room, sender=doctor if index % 2 else patient, message=f'message {index}')
+                        for index in range(options['messages'])
+                    )
+                    patients.append(patient)
+
+                latencies, queries = self.run(doctor, options['requests'])
+                percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+                self.stdout.write(
+                    f"{size:>6} rooms: p50={percentiles[49]:.2f} p95={percentiles[94]:.2f} "
+                    f"max={max(latencies):.2f} ms, {queries} queries"
+                )
+        finally:
+            # Cascades to the rooms and their messages
+            User.objects.filter(id__in=[doctor.id, *(patient.id for patient in patients)]).delete()
+
+    def run(self, doctor, requests):
+        view = RecentlyChat.as_view()
+        factory = APIRequestFactory()
+        authorization = f'Bearer {AccessToken.for_user(doctor)}'
+        latencies = []
+        queries = set()
+        for _ in range(requests):
+            request = factory.get('/chat/get_chat/', HTTP_AUTHORIZATION=authorization)
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                response = view(request)
+                response.render()
+                latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"RecentlyChat answered {response.status_code}")
+            queries.add(len(context))
+        return latencies, '/'.join(str(count) for count in sorted(queries))
@@ -1,31 +1,34 @@
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from django.contrib.auth import get_user_model
-import jwt
-from django.conf import settings
+from rest_framework_simplejwt.settings import api_settings
 from urllib.parse import parse_qs
 
+from users.cache import get_cached_user
+
 
 @database_sync_to_async
 def get_user(user_id):
-    User = get_user_model()
-    try:
-        return User.objects.get(id=user_id)
-    except User.DoesNotExist:
+    user = get_cached_user(user_id)
+    if user is None or not user.is_active or user.is_blocked:
         return AnonymousUser()
+    return user
 
 
 class JWTAuthMiddleware(BaseMiddleware):
+    # Same validation as the HTTP API: signature, expiry with leeway and token type
+    authentication = JWTAuthentication()
+
     async def __call__(self, scope, receive, send):
         query_params = parse_qs(scope['query_string'].decode())
         if 'token' in query_params:
             token_key = query_params['token'][0]
             try:
-                decoded_data = jwt.decode(token_key, settings.SECRET_KEY, algorithms=["HS256"])
-                scope['user'] = await get_user(decoded_data['id'])
-            except (InvalidToken, TokenError, jwt.DecodeError, KeyError) as e:
+                validated_token = self.authentication.get_validated_token(token_key)
+                scope['user'] = await get_user(validated_token[api_settings.USER_ID_CLAIM])
+            except (InvalidToken, TokenError, KeyError) as e:
                 scope['user'] = AnonymousUser()
         else:
             scope['user'] = AnonymousUser()
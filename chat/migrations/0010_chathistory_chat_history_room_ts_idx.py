@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:12
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chat', '0009_alter_chathistory_media'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='chathistory',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_history_room_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.3 on 2026-10-18 11:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chat', '0010_chathistory_chat_history_room_ts_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chatroom',
+            name='active_users',
+        ),
+        migrations.RemoveField(
+            model_name='chatroom',
+            name='active_voice_users',
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:19
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+from HospitalSystem.migration_operations import add_unique_concurrently
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chat', '0011_remove_chatroom_active_users_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='chathistory',
+            index=models.Index(condition=models.Q(('read_status', False)), fields=['room', 'sender'], name='chat_history_unread_idx'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                *add_unique_concurrently('chat_chatroom', 'chat_chatroom_name_uniq', '"name"'),
+                *add_unique_concurrently('chat_chatroom', 'chat_room_unique_pair', '"doctor_id", "patient_id"'),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='chatroom',
+                    name='name',
+                    field=models.CharField(max_length=255, unique=True),
+                ),
+                migrations.AddConstraint(
+                    model_name='chatroom',
+                    constraint=models.UniqueConstraint(fields=('doctor', 'patient'), name='chat_room_unique_pair'),
+                ),
+            ],
+        ),
+    ]
@@ -4,12 +4,15 @@ from users.models import User
 
 
 class ChatRoom(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_doctor')
     patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_patient')
     created_at = models.DateTimeField(auto_now_add=True)
-    active_users = models.PositiveIntegerField(default=0)
-    active_voice_users = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'patient'], name='chat_room_unique_pair'),
+        ]
 
     def __str__(self):
         return f'Room between {self.doctor} and {self.patient}'
@@ -27,6 +30,15 @@ class ChatHistory(models.Model):
     replied_to = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
     read_status = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_history_room_ts_idx'),
+            # Unread lookups (mark as read, inbox counts, notification snapshot) only touch this small slice
+            models.Index(
+                fields=['room', 'sender'], condition=models.Q(read_status=False), name='chat_history_unread_idx'
+            ),
+        ]
+
     def __str__(self):
         if self.is_deleted:
             return "This message has been deleted."
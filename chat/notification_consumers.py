@@ -1,13 +1,16 @@
-import json
-
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.db.models import Q
+from django.db.models import Q, F, Count, Window
+from django.db.models.functions import RowNumber
 
-from chat.models import ChatHistory, ChatRoom
-from chat.utils import format_notification
+from HospitalSystem.metrics import MetricsConsumerMixin
+from chat.models import ChatHistory
+from chat.outbound import OutboundQueueMixin, DROP_OLDEST
+from chat.utils import format_notification, dumps_frame
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(MetricsConsumerMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
+    # Anything missed is in the unread snapshot on the next connect
+    outbound_policy = DROP_OLDEST
 
     async def connect(self):
         try:
@@ -24,7 +27,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 )
                 await self.accept()
 
-                await self.send_notifications()  # This line was changed
+                await self.send_notifications()
 
         except Exception as e:
             await self.close()
@@ -35,33 +38,40 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-    async def get_unread_messages(self):
-        unread_messages = []
-        async for messages in ChatHistory.objects.filter(
-                room__in=ChatRoom.objects.filter(
-                    Q(doctor=self.user) | Q(patient=self.user)
-                ),
-                read_status=False
+    async def get_unread_summary(self):
+        """
+        One row per room with unread messages: the latest unread message, annotated with the
+        room's unread count. Window functions keep this to a single query however many are unread.
+        """
+        by_room = {'partition_by': [F('room_id')]}
+        latest_unread = ChatHistory.objects.filter(
+            Q(room__doctor=self.user) | Q(room__patient=self.user),
+            read_status=False,
         ).exclude(
             sender=self.user
-        ).select_related('room').all():
-            unread_messages.append(messages)
-        return list(unread_messages) if unread_messages else None
+        ).annotate(
+            unread_count=Window(Count('id'), **by_room),
+            position=Window(RowNumber(), order_by=[F('timestamp').desc(), F('id').desc()], **by_room),
+        ).filter(
+            position=1
+        ).select_related('room', 'sender').order_by('-timestamp', '-id')
+        return [message async for message in latest_unread]
 
     async def send_notifications(self):
-        unread_messages = await self.get_unread_messages()
-        if unread_messages:
-            for message in unread_messages:
-                await self.send(text_data=json.dumps({
-                    'type': 'notification',
-                    'notification': await format_notification(message)
-                }))
-        else:
-            print("No unread messages")
+        # Snapshot of what was missed while offline; live messages still arrive one by one via send_notification
+        unread = await self.get_unread_summary()
+        await self.send(text_data=dumps_frame({
+            'type': 'notification_snapshot',
+            'total_unread': sum(message.unread_count for message in unread),
+            'rooms': [
+                {'unread_count': message.unread_count, 'latest': format_notification(message)}
+                for message in unread
+            ],
+        }))
 
     async def send_notification(self, event):
         notification = event['notification']
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_frame({
             'type': 'notification',
             'notification': notification
         }))
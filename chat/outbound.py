@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import weakref
+from collections import Counter, deque
+
+from django.conf import settings
+
+from HospitalSystem.metrics import Counter as MetricCounter, Gauge, registry
+from chat.utils import dumps_frame
+
+logger = logging.getLogger(__name__)
+
+# What to do with a frame once the socket's queue is at its high-water mark
+DROP_OLDEST = 'drop_oldest'  # lossy frames: the oldest queued frame with the same key makes room
+COALESCE = 'coalesce'  # merged into the queued frame with the same key, so it never adds depth
+DISCONNECT = 'disconnect'  # frames that must not be lost: close the socket and let the client resync
+
+OVERFLOW_CLOSE_CODE = 4008
+WRITE_ERROR_CLOSE_CODE = 1011
+
+outbound_totals = Counter()
+_queues = weakref.WeakSet()
+
+OUTBOUND_OVERFLOW = MetricCounter(
+    'websocket_outbound_overflow_total',
+    "Frames dropped or coalesced, and sockets closed, by full send queues; write_errors counts failed sends.",
+    ('outcome',),
+)
+OUTBOUND_DEPTH = Gauge('websocket_outbound_depth', "Frames waiting in WebSocket send queues.")
+OUTBOUND_MAX_DEPTH = Gauge('websocket_outbound_max_depth', "Deepest WebSocket send queue of a process.")
+
+
+def outbound_metrics():
+    """Process-wide view of every live outbound queue."""
+    depths = [len(queue) for queue in _queues]
+    return {
+        'queues': len(depths),
+        'depth': sum(depths),
+        'max_depth': max(depths, default=0),
+        **{name: outbound_totals[name] for name in ('dropped', 'coalesced', 'disconnects', 'write_errors')},
+    }
+
+
+def record_overflow(outcome):
+    outbound_totals[outcome] += 1
+    OUTBOUND_OVERFLOW.inc(outcome=outcome)
+
+
+def collect_depth():
+    try:
+        stats = outbound_metrics()
+    except RuntimeError:
+        # Runs on the flusher thread; a socket opened mid-read just means this sample is skipped
+        return
+    OUTBOUND_DEPTH.set(stats['depth'])
+    OUTBOUND_MAX_DEPTH.set(stats['max_depth'])
+
+
+registry.register_collector(collect_depth)
+
+
+class Frame:
+    """
+    One queued frame. ``key`` names its kind: COALESCE frames merge into the queued frame with the
+    same key, and a DROP_OLDEST frame only ever pushes out an older frame with the same key.
+    """
+
+    __slots__ = ('text', 'payload', 'policy', 'key', 'merge')
+
+    def __init__(self, text=None, payload=None, policy=DISCONNECT, key=None, merge=None):
+        self.text = text
+        self.payload = payload
+        self.policy = policy
+        self.key = key
+        self.merge = merge
+
+    def render(self):
+        return self.text if self.payload is None else dumps_frame(self.payload)
+
+
+class OutboundQueue:
+    """
+    Bounded per-socket send queue drained by a single writer task. Handlers return as soon as a
+    frame is queued, so a slow client never stalls the consumer's channel-layer inbox; instead the
+    queue fills up and each frame's policy decides what gives. A failed send stops the queue and
+    calls ``on_error``, which should close the socket.
+    """
+
+    def __init__(self, send, on_overflow, on_error, high_water=None):
+        self.send = send
+        self.on_overflow = on_overflow
+        self.on_error = on_error
+        self.high_water = high_water or settings.WEBSOCKET_OUTBOUND_HIGH_WATER
+        self.frames = deque()
+        self.keyed = {}
+        self.ready = asyncio.Event()
+        self.stopped = False
+        self.writer = asyncio.create_task(self.run())
+        _queues.add(self)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        if self.stopped:
+            return
+
+        if frame.policy == COALESCE and frame.key in self.keyed:
+            queued = self.keyed[frame.key]
+            queued.payload = frame.merge(queued.payload, frame.payload) if frame.merge else frame.payload
+            record_overflow('coalesced')
+            return
+
+        if len(self.frames) >= self.high_water and not self.make_room(frame):
+            return
+
+        self.frames.append(frame)
+        if frame.policy == COALESCE:
+            self.keyed[frame.key] = frame
+        self.ready.set()
+
+    def make_room(self, frame):
+        # A lossy frame only displaces its own kind, so a burst of one kind cannot starve another;
+        # a frame that must not be lost may displace any lossy one
+        for queued in self.frames:
+            if queued.policy == DROP_OLDEST and (frame.policy != DROP_OLDEST or queued.key == frame.key):
+                self.frames.remove(queued)
+                record_overflow('dropped')
+                return True
+
+        if frame.policy == DROP_OLDEST:
+            record_overflow('dropped')
+            return False
+
+        # Nothing left that may be lost: the client is too far behind to catch up frame by frame
+        self.stop()
+        record_overflow('disconnects')
+        asyncio.create_task(self.on_overflow())
+        return False
+
+    def stop(self):
+        self.stopped = True
+        self.frames.clear()
+        self.keyed.clear()
+
+    async def run(self):
+        while True:
+            if not self.frames:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            frame = self.frames.popleft()
+            if frame.policy == COALESCE:
+                del self.keyed[frame.key]
+            try:
+                await self.send(text_data=frame.render())
+            except Exception:
+                # Without a writer nothing would drain the queue again
+                logger.exception("Could not write to a WebSocket, closing it")
+                self.stop()
+                record_overflow('write_errors')
+                await self.on_error()
+                return
+
+    def close(self):
+        self.writer.cancel()
+        _queues.discard(self)
+
+
+class OutboundQueueMixin:
+    """
+    Routes every ``send`` of a WebSocket consumer through an OutboundQueue. Plain sends use the
+    consumer's ``outbound_policy``; handlers that need another policy call ``send_frame``.
+    """
+
+    outbound_policy = DISCONNECT
+
+    @property
+    def outbound(self):
+        queue = getattr(self, '_outbound', None)
+        if queue is None:
+            queue = self._outbound = OutboundQueue(super().send, self.close_overflowed, self.close_failed)
+        return queue
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if bytes_data is not None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        self.outbound.put(Frame(text=text_data, policy=self.outbound_policy))
+
+    async def send_frame(self, payload, policy=None, key=None, merge=None):
+        """Queue a frame given as a dict (rendered when written, after any merging) or as ready JSON text."""
+        text, payload = (payload, None) if isinstance(payload, str) else (None, payload)
+        self.outbound.put(Frame(text, payload, policy or self.outbound_policy, key, merge))
+
+    async def close_overflowed(self):
+        await self.close(code=OVERFLOW_CLOSE_CODE)
+
+    async def close_failed(self):
+        try:
+            await self.close(code=WRITE_ERROR_CLOSE_CODE)
+        except Exception:
+            # The failed send usually means the socket is already gone
+            logger.warning("Could not close a WebSocket after a failed write", exc_info=True)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, '_outbound', None) is not None:
+            self._outbound.close()
+        await super().websocket_disconnect(message)
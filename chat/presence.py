@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import time
+from functools import lru_cache
+
+import redis.asyncio as redis
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class BasePresence:
+    """
+    Tracks which channels are connected to a group. Every entry expires after ``ttl`` seconds
+    unless it is refreshed, so channels of a crashed worker disappear on their own.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+
+    async def join(self, group, channel_name, user_id):
+        raise NotImplementedError
+
+    async def heartbeat(self, group, channel_name, user_id):
+        await self.join(group, channel_name, user_id)
+
+    async def leave(self, group, channel_name, user_id):
+        raise NotImplementedError
+
+    async def is_present(self, group, user_id):
+        raise NotImplementedError
+
+    async def count(self, group):
+        raise NotImplementedError
+
+    async def channels(self, group):
+        raise NotImplementedError
+
+    async def set_state(self, group, channel_name, state):
+        """Attach a JSON-serialisable ``state`` to a joined channel; it is dropped when the channel leaves."""
+        raise NotImplementedError
+
+    async def participants(self, group):
+        """Live channels of ``group`` mapped to their state."""
+        raise NotImplementedError
+
+
+class RedisPresence(BasePresence):
+    """
+    Two sorted sets per group scored by expiry time: one with every live channel of the group
+    and one per user, so both the counter and the "is this user here" check stay O(1). A hash per
+    group holds each channel's state.
+    """
+
+    def __init__(self, ttl=60, url=None, prefix='presence'):
+        super().__init__(ttl)
+        self.url = url or settings.REDIS_URL
+        self.prefix = prefix
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = redis.from_url(self.url)
+        return self._client
+
+    def group_key(self, group):
+        return f'{self.prefix}:{group}'
+
+    def user_key(self, group, user_id):
+        return f'{self.prefix}:{group}:{user_id}'
+
+    def state_key(self, group):
+        return f'{self.prefix}:{group}:state'
+
+    async def join(self, group, channel_name, user_id):
+        expires_at = time.time() + self.ttl
+        group_key, user_key = self.group_key(group), self.user_key(group, user_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zadd(group_key, {channel_name: expires_at})
+            pipe.zadd(user_key, {channel_name: expires_at})
+            pipe.expire(group_key, self.ttl)
+            pipe.expire(user_key, self.ttl)
+            pipe.expire(self.state_key(group), self.ttl)
+            await pipe.execute()
+
+    async def leave(self, group, channel_name, user_id):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zrem(self.group_key(group), channel_name)
+            pipe.zrem(self.user_key(group, user_id), channel_name)
+            pipe.hdel(self.state_key(group), channel_name)
+            await pipe.execute()
+
+    async def _live(self, key):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, '-inf', time.time())
+            pipe.zcard(key)
+            _, live = await pipe.execute()
+        return live
+
+    async def is_present(self, group, user_id):
+        return await self._live(self.user_key(group, user_id)) > 0
+
+    async def count(self, group):
+        return await self._live(self.group_key(group))
+
+    async def channels(self, group):
+        key = self.group_key(group)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, '-inf', time.time())
+            pipe.zrange(key, 0, -1)
+            _, channel_names = await pipe.execute()
+        return [channel_name.decode() for channel_name in channel_names]
+
+    async def set_state(self, group, channel_name, state):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hset(self.state_key(group), channel_name, json.dumps(state))
+            pipe.expire(self.state_key(group), self.ttl)
+            await pipe.execute()
+
+    async def participants(self, group):
+        # State of crashed channels lingers in the hash until the group goes quiet, so only live ones are returned
+        live = await self.channels(group)
+        if not live:
+            return {}
+        states = await self.client.hmget(self.state_key(group), live)
+        return {channel_name: json.loads(state) if state else {} for channel_name, state in zip(live, states)}
+
+
+class InMemoryPresence(BasePresence):
+    """Process-local stand-in for tests and single-process development."""
+
+    def __init__(self, ttl=60):
+        super().__init__(ttl)
+        self.groups = {}
+        self.states = {}
+
+    def _live(self, group):
+        now = time.monotonic()
+        channels = self.groups.get(group, {})
+        for channel_name, (_, expires_at) in list(channels.items()):
+            if expires_at <= now:
+                del channels[channel_name]
+        return channels
+
+    async def join(self, group, channel_name, user_id):
+        self.groups.setdefault(group, {})[channel_name] = (user_id, time.monotonic() + self.ttl)
+
+    async def leave(self, group, channel_name, user_id):
+        self.groups.get(group, {}).pop(channel_name, None)
+        self.states.get(group, {}).pop(channel_name, None)
+
+    async def is_present(self, group, user_id):
+        return any(present_id == user_id for present_id, _ in self._live(group).values())
+
+    async def count(self, group):
+        return len(self._live(group))
+
+    async def channels(self, group):
+        return list(self._live(group))
+
+    async def set_state(self, group, channel_name, state):
+        self.states.setdefault(group, {})[channel_name] = state
+
+    async def participants(self, group):
+        states = self.states.get(group, {})
+        return {channel_name: states.get(channel_name, {}) for channel_name in self._live(group)}
+
+
+@lru_cache(maxsize=None)
+def get_presence():
+    config = settings.CHAT_PRESENCE
+    return import_string(config['BACKEND'])(ttl=config.get('TTL', 60), **config.get('OPTIONS', {}))
+
+
+class PresenceConsumerMixin:
+    """Registers the consumer's channel in ``room_group_name`` and keeps it alive while connected."""
+
+    @property
+    def presence(self):
+        return get_presence()
+
+    async def join_presence(self):
+        await self.presence.join(self.room_group_name, self.channel_name, self.user.id)
+        self.presence_heartbeat = asyncio.create_task(self.keep_presence())
+
+    async def keep_presence(self):
+        interval = self.presence.ttl / 3
+        delay = interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.presence.heartbeat(self.room_group_name, self.channel_name, self.user.id)
+            except Exception:
+                # Retried well before the entry expires, so a blip in the store does not drop the channel
+                logger.warning("Presence heartbeat failed for %s, retrying", self.room_group_name, exc_info=True)
+                delay = interval / 4
+            else:
+                delay = interval
+
+    async def leave_presence(self):
+        heartbeat = getattr(self, 'presence_heartbeat', None)
+        if heartbeat is None:
+            return
+        heartbeat.cancel()
+        await self.presence.leave(self.room_group_name, self.channel_name, self.user.id)
@@ -1,46 +1,64 @@
 from rest_framework import serializers
+
+from HospitalSystem.media import absolute_media_url
 from .models import ChatRoom
 
 
 class ChatRoomSerializer(serializers.ModelSerializer):
+    """Inbox row; expects a room from chat.inbox.inbox_queryset."""
     room_name = serializers.CharField(source='name')
     user_name = serializers.SerializerMethodField()
     user_id = serializers.SerializerMethodField()
     avatar = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+    last_message_type = serializers.CharField(read_only=True)
+    last_sender_id = serializers.IntegerField(read_only=True)
+    last_activity = serializers.DateTimeField(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = ChatRoom
-        fields = ['room_name', 'user_name', 'user_id', 'avatar']
+        fields = [
+            'room_name', 'user_name', 'user_id', 'avatar', 'last_message', 'last_message_type', 'last_sender_id',
+            'last_activity', 'unread_count',
+        ]
 
-    def get_user_name(self, obj):
+    def get_counterpart(self, obj):
         request_user = self.context['request_user']
-        if request_user.roles.role == 'doctor':
-            return f"{obj.patient.first_name} {obj.patient.last_name}"
-        elif request_user.roles.role == 'patient':
-            return f"{obj.doctor.first_name} {obj.doctor.last_name}"
+        if request_user.role == 'doctor':
+            return obj.patient
+        elif request_user.role == 'patient':
+            return obj.doctor
         return None
 
+    def get_user_name(self, obj):
+        counterpart = self.get_counterpart(obj)
+        return f"{counterpart.first_name} {counterpart.last_name}" if counterpart else None
+
     def get_user_id(self, obj):
-        request_user = self.context['request_user']
-        if request_user.roles.role == 'doctor':
-            return obj.patient.id
-        elif request_user.roles.role == 'patient':
-            return obj.doctor.id
-        return None
+        counterpart = self.get_counterpart(obj)
+        return counterpart.id if counterpart else None
 
     def get_avatar(self, obj):
         request = self.context.get('request')
-        request_user = self.context['request_user']
-
-        # Depending on the role, fetch the patient's or doctor's avatar
-        if request_user.roles.role == 'doctor':
-            avatar_url = obj.patient.avatar.url if obj.patient.avatar else None
-        elif request_user.roles.role == 'patient':
-            avatar_url = obj.doctor.avatar.url if obj.doctor.avatar else None
-        else:
-            avatar_url = None
-
-        # Build absolute URL if avatar exists
-        if avatar_url and request:
-            return request.build_absolute_uri(avatar_url)
+        counterpart = self.get_counterpart(obj)
+        if request and counterpart:
+            return absolute_media_url(request, counterpart.avatar)
         return None
+
+    def get_last_message(self, obj):
+        if obj.last_message_deleted:
+            return "This message has been deleted."
+        return obj.last_message
+
+
+class ChatMediaUploadSerializer(serializers.Serializer):
+    room_name = serializers.CharField()
+    file_name = serializers.CharField(max_length=255)
+    file_type = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    size = serializers.IntegerField(min_value=1)
+
+
+class ChatMediaFinalizeSerializer(serializers.Serializer):
+    upload_token = serializers.CharField()
+    replied_to = serializers.IntegerField(required=False, allow_null=True)
@@ -1,3 +1,706 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+from contextlib import asynccontextmanager
+from unittest import mock
 
-# Create your tests here.
+import boto3
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from moto import mock_aws
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from HospitalSystem.metrics import registry
+from HospitalSystem.query_budget import assert_query_budget
+from HospitalSystem.testing import QueryPlanTestCase, make_user
+from chat.middleware import JWTAuthMiddleware
+from chat.models import ChatRoom, ChatHistory
+from chat.outbound import (
+    COALESCE, DROP_OLDEST, Frame, OutboundQueue, collect_depth, outbound_metrics, outbound_totals,
+)
+from chat.presence import InMemoryPresence, PresenceConsumerMixin
+from chat.routing import websocket_urlpatterns
+from chat.views import RecentlyChat
+from users.cache import invalidate_user_snapshot
+
+
+def mock_media_bucket(test):
+    """Run the test against a moto S3 with the media bucket created; returns the S3 client."""
+    aws = mock_aws()
+    aws.start()
+    test.addCleanup(aws.stop)
+    s3 = boto3.client('s3', region_name=settings.AWS_S3_REGION_NAME)
+    s3.create_bucket(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        CreateBucketConfiguration={'LocationConstraint': settings.AWS_S3_REGION_NAME},
+    )
+    return s3
+
+
+@asynccontextmanager
+async def capture_queries():
+    """CaptureQueriesContext for async tests, bound to the thread database_sync_to_async runs queries on."""
+    context = await sync_to_async(lambda: CaptureQueriesContext(connections['default']))()
+    await sync_to_async(context.__enter__)()
+    try:
+        yield context
+    finally:
+        await sync_to_async(context.__exit__)(None, None, None)
+
+
+class IndexUsageTests(QueryPlanTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.room = ChatRoom.objects.create(name='room', doctor=self.doctor, patient=self.patient)
+
+    def test_history_page_uses_room_timestamp_index(self):
+        page = ChatHistory.objects.filter(room=self.room).order_by('-timestamp', '-id')[:50]
+        self.assertUsesIndex(page, 'chat_history_room_ts_idx')
+
+    def test_unread_lookup_uses_partial_index(self):
+        unread = ChatHistory.objects.filter(room=self.room, read_status=False).exclude(sender=self.doctor)
+        self.assertUsesIndex(unread, 'chat_history_unread_idx')
+
+
+class InboxQueryBudgetTests(TestCase):
+
+    def setUp(self):
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.patient)}')
+
+    def test_inbox_stays_within_budget(self):
+        for count in (1, 30):
+            for index in range(ChatRoom.objects.count(), count):
+                doctor = make_user(f'doctor{index}@test.invalid', 'doctor')
+                room = ChatRoom.objects.create(name=f'room{index}', doctor=doctor, patient=self.patient)
+                ChatHistory.objects.create(room=room, sender=doctor, message='unread')
+            with self.subTest(count=count), assert_query_budget(RecentlyChat.query_budget):
+                response = self.client.get('/chat/get_chat/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['results'][0]['unread_count'], 1)
+
+    def test_doctor_inbox_pages_stay_within_budget(self):
+        doctor = make_user('doctor@test.invalid', 'doctor')
+        for index in range(250):
+            patient = make_user(f'patient{index}@test.invalid', 'patient')
+            room = ChatRoom.objects.create(name=f'room{index}', doctor=doctor, patient=patient)
+            ChatHistory.objects.bulk_create(
+                ChatHistory(room=room, sender=patient, message=f'{index}.{count}') for count in range(index % 3 + 1)
+            )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(doctor)}')
+
+        rows = []
+        url = '/chat/get_chat/?page_size=100'
+        while url:
+            with assert_query_budget(RecentlyChat.query_budget):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            rows += response.data['results']
+            url = response.data['next']
+
+        self.assertEqual(len(rows), 250)
+        # Newest activity first: the rooms were created, and written to, in index order
+        self.assertEqual([row['room_name'] for row in rows], [f'room{index}' for index in reversed(range(250))])
+        self.assertEqual([row['unread_count'] for row in rows], [index % 3 + 1 for index in reversed(range(250))])
+        self.assertEqual(rows[0]['last_message'], '249.0')
+
+
+# The consumers reach the database through database_sync_to_async, which closes connections, so
+# these tests cannot run inside TestCase's transaction
+class ChatConsumerTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.room = ChatRoom.objects.create(name='room', doctor=self.doctor, patient=self.patient)
+
+    async def connect(self, user, path='chat'):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/{path}/{self.room.name}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frame(self, communicator, frame_type):
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == frame_type:
+                return frame
+
+
+class MarkRoomAsReadTests(ChatConsumerTestCase):
+
+    async def test_backlog_is_marked_read_with_one_update_and_one_receipt(self):
+        unread = [
+            await ChatHistory.objects.acreate(room=self.room, sender=self.patient, message=f'message {index}')
+            for index in range(5)
+        ]
+        patient = await self.connect(self.patient)
+        await self.receive_frame(patient, 'chat_history')
+
+        channel_layer = get_channel_layer()
+        with mock.patch.object(channel_layer, 'group_send', wraps=channel_layer.group_send) as group_send:
+            async with capture_queries() as queries:
+                doctor = await self.connect(self.doctor)
+                await self.receive_frame(doctor, 'chat_history')
+
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        receipts = [call.args[1] for call in group_send.call_args_list if call.args[1]['type'] == 'messages_read']
+        self.assertEqual(receipts, [{'type': 'messages_read', 'ids': [message.id for message in unread]}])
+
+        frame = await self.receive_frame(patient, 'messages_read')
+        self.assertEqual(frame['ids'], [message.id for message in unread])
+        self.assertEqual(await ChatHistory.objects.filter(read_status=False).acount(), 0)
+
+        await doctor.disconnect()
+        await patient.disconnect()
+
+    async def test_nothing_unread_sends_no_receipt(self):
+        await ChatHistory.objects.acreate(room=self.room, sender=self.doctor, message='own message')
+
+        channel_layer = get_channel_layer()
+        with mock.patch.object(channel_layer, 'group_send', wraps=channel_layer.group_send) as group_send:
+            doctor = await self.connect(self.doctor)
+            await self.receive_frame(doctor, 'chat_history')
+
+        self.assertFalse([call for call in group_send.call_args_list if call.args[1]['type'] == 'messages_read'])
+        await doctor.disconnect()
+
+
+class MessageQueryCountTests(ChatConsumerTestCase):
+
+    async def test_each_message_costs_one_insert_and_no_room_lookup(self):
+        doctor = await self.connect(self.doctor)
+        await self.receive_frame(doctor, 'chat_history')
+
+        async with capture_queries() as queries:
+            for index in range(100):
+                await doctor.send_json_to({'type': 'text', 'message': f'message {index}'})
+                await self.receive_frame(doctor, 'chat_message')
+
+        statements = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len(statements), 100)
+        self.assertTrue(all(sql.startswith('INSERT INTO "chat_chathistory"') for sql in statements))
+        await doctor.disconnect()
+
+
+@override_settings(CHAT_HISTORY_PAGE_SIZE=3)
+class HistoryCursorTests(ChatConsumerTestCase):
+
+    async def test_load_more_pages_back_through_history(self):
+        messages = [
+            await ChatHistory.objects.acreate(room=self.room, sender=self.doctor, message=f'message {index}')
+            for index in range(5)
+        ]
+        doctor = await self.connect(self.doctor)
+        first = await self.receive_frame(doctor, 'chat_history')
+        self.assertEqual([message['id'] for message in first['messages']], [message.id for message in messages[2:]])
+        self.assertTrue(first['has_more'])
+
+        await doctor.send_json_to({'type': 'load_more', 'cursor': first['cursor']})
+        older = await self.receive_frame(doctor, 'older_messages')
+        self.assertEqual([message['id'] for message in older['messages']], [message.id for message in messages[:2]])
+        self.assertEqual((older['cursor'], older['has_more']), (None, False))
+        await doctor.disconnect()
+
+    async def test_invalid_cursor(self):
+        doctor = await self.connect(self.doctor)
+        for cursor in ('garbage', 'not-a-date|1', '2024-01-01T00:00:00+00:00|x', 5, ['list'], {'id': 1}):
+            with self.subTest(cursor=cursor):
+                await doctor.send_json_to({'type': 'load_more', 'cursor': cursor})
+                frame = await self.receive_frame(doctor, 'error')
+                self.assertEqual(frame, {'type': 'error', 'detail': 'Invalid history cursor.'})
+        await doctor.disconnect()
+
+
+class MalformedMediaFrameTests(ChatConsumerTestCase):
+
+    async def assert_rejected(self, communicator, detail):
+        self.assertEqual(await self.receive_frame(communicator, 'error'), {'type': 'error', 'detail': detail})
+        # The consumer survived and still serves the room
+        await communicator.send_json_to({'type': 'text', 'message': 'still here'})
+        self.assertEqual((await self.receive_frame(communicator, 'chat_message'))['messages']['content'], 'still here')
+
+    async def test_short_binary_frame(self):
+        doctor = await self.connect(self.doctor)
+        await doctor.send_to(bytes_data=b'short')
+        await self.assert_rejected(doctor, "Invalid media chunk.")
+        await doctor.disconnect()
+
+    async def test_bad_upload_id(self):
+        doctor = await self.connect(self.doctor)
+        for upload_id in ('not-a-uuid', ['list'], None):
+            await doctor.send_json_to({'type': 'media_chunk', 'upload_id': upload_id, 'data': 'YQ=='})
+            await self.assert_rejected(doctor, "Invalid upload id.")
+            await doctor.send_json_to({'type': 'media_cancel', 'upload_id': upload_id})
+            await self.assert_rejected(doctor, "Invalid upload id.")
+        await doctor.disconnect()
+
+    async def test_bad_base64_chunk(self):
+        doctor = await self.connect(self.doctor)
+        for chunk in ('YQ=', 5):
+            await doctor.send_json_to({
+                'type': 'media_chunk', 'upload_id': '00000000-0000-0000-0000-000000000000', 'data': chunk,
+            })
+            await self.assert_rejected(doctor, "Invalid media chunk.")
+        await doctor.disconnect()
+
+
+    async def test_non_string_file_name(self):
+        doctor = await self.connect(self.doctor)
+        await doctor.send_json_to({'type': 'media', 'media': 'YQ==', 'file_name': ['scan.png']})
+        await self.assert_rejected(doctor, "Invalid file name.")
+        await doctor.send_json_to({'type': 'media_start', 'size': 1, 'file_name': {'name': 'scan.png'}})
+        await self.assert_rejected(doctor, "Invalid file name.")
+        await doctor.send_json_to({'type': 'media', 'media': 5})
+        await self.assert_rejected(doctor, "Invalid media chunk.")
+        await doctor.disconnect()
+
+
+# Re-creating the storage makes it connect inside the moto mock
+@override_settings(STORAGES={**settings.STORAGES})
+class MediaFrameStorageTests(ChatConsumerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.s3 = mock_media_bucket(self)
+
+    async def test_legacy_frame_without_file_name_gets_a_generated_name(self):
+        doctor = await self.connect(self.doctor)
+        media = base64.b64encode(b'scan').decode()
+        await doctor.send_json_to({'type': 'media', 'media': media, 'file_type': 'image/png'})
+
+        frame = await self.receive_frame(doctor, 'chat_message')
+        message = await ChatHistory.objects.aget(id=frame['messages']['id'])
+        self.assertRegex(message.media.name, r'^chat_media/[0-9a-f]{32}')
+        body = self.s3.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=message.media.name)['Body'].read()
+        self.assertEqual(body, b'scan')
+        await doctor.disconnect()
+
+
+class NotificationSnapshotTests(ChatConsumerTestCase):
+
+    async def snapshot(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/notification/')
+        communicator.scope['user'] = user
+        async with capture_queries() as queries:
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frame = await self.receive_frame(communicator, 'notification_snapshot')
+        await communicator.disconnect()
+        return frame, len(queries)
+
+    async def add_room(self, name, patient, unread):
+        room = await ChatRoom.objects.acreate(name=name, doctor=self.doctor, patient=patient)
+        await ChatHistory.objects.acreate(room=room, sender=patient, message='already read', read_status=True)
+        for index in range(unread):
+            await ChatHistory.objects.acreate(room=room, sender=patient, message=f'{name} {index}')
+        return room
+
+    async def test_one_row_per_room_in_one_query(self):
+        await ChatHistory.objects.acreate(room=self.room, sender=self.patient, message='earlier')
+        await ChatHistory.objects.acreate(room=self.room, sender=self.patient, message='latest')
+        # The doctor's own unread messages are not notifications
+        await ChatHistory.objects.acreate(room=self.room, sender=self.doctor, message='own')
+        await self.add_room('quiet', await sync_to_async(make_user)('quiet@test.invalid', 'patient'), 0)
+        other_patient = await sync_to_async(make_user)('other@test.invalid', 'patient')
+        await self.add_room('other', other_patient, 3)
+        # Someone else's room
+        other_doctor = await sync_to_async(make_user)('otherdoctor@test.invalid', 'doctor')
+        await ChatHistory.objects.acreate(
+            room=await ChatRoom.objects.acreate(name='elsewhere', doctor=other_doctor, patient=self.patient),
+            sender=self.patient, message='not for this doctor',
+        )
+
+        frame, queries = await self.snapshot(self.doctor)
+
+        self.assertEqual(queries, 1)
+        self.assertEqual(frame['total_unread'], 5)
+        self.assertEqual(
+            [(room['unread_count'], room['latest']['room_name'], room['latest']['content']) for room in frame['rooms']],
+            [(3, 'other', 'other 2'), (2, 'room', 'latest')],
+        )
+        latest = frame['rooms'][0]['latest']
+        self.assertEqual(latest['sender_id'], other_patient.id)
+        self.assertEqual(latest['sender_name'], f'{other_patient.first_name} {other_patient.last_name}')
+
+    async def test_query_count_does_not_grow_with_rooms(self):
+        for index in range(20):
+            await self.add_room(f'room{index}', await sync_to_async(make_user)(f'p{index}@test.invalid', 'patient'), 2)
+
+        frame, queries = await self.snapshot(self.doctor)
+
+        self.assertEqual(queries, 1)
+        self.assertEqual(len(frame['rooms']), 20)
+        self.assertEqual(frame['total_unread'], 40)
+
+    async def test_nothing_unread(self):
+        frame, _ = await self.snapshot(self.patient)
+        self.assertEqual(frame, {'type': 'notification_snapshot', 'total_unread': 0, 'rooms': []})
+
+
+class ConferenceRoutingTests(ChatConsumerTestCase):
+
+    async def test_unhashable_recipient_is_rejected(self):
+        doctor = await self.connect(self.doctor, 'conference')
+        doctor_id = (await self.receive_frame(doctor, 'joined'))['id']
+        patient = await self.connect(self.patient, 'conference')
+        patient_id = (await self.receive_frame(patient, 'joined'))['id']
+        await self.receive_frame(doctor, 'active_users')
+
+        for to in (['list'], {'id': patient_id}):
+            await doctor.send_json_to({'type': 'offer', 'to': to, 'sdp': 'offer'})
+            frame = await self.receive_frame(doctor, 'error')
+            self.assertEqual(frame, {'type': 'error', 'detail': 'Unknown participant.', 'to': to})
+
+        # The consumer survived and still relays
+        await doctor.send_json_to({'type': 'offer', 'to': patient_id, 'sdp': 'offer'})
+        frame = await self.receive_frame(patient, 'offer')
+        self.assertEqual(frame, {'type': 'offer', 'to': patient_id, 'sdp': 'offer', 'from': doctor_id})
+        await patient.disconnect()
+        await doctor.disconnect()
+
+    async def test_frames_that_are_not_objects_are_rejected(self):
+        doctor = await self.connect(self.doctor, 'conference')
+        self.assertEqual((await self.receive_frame(doctor, 'active_users'))['event'], 'join')
+
+        invalid = {'type': 'error', 'detail': 'Invalid frame.'}
+        for text in ('[]', '"offer"', '1', 'null', 'not json'):
+            with self.subTest(text=text):
+                await doctor.send_to(text_data=text)
+                self.assertEqual(await self.receive_frame(doctor, 'error'), invalid)
+        await doctor.send_to(bytes_data=b'{}')
+        self.assertEqual(await self.receive_frame(doctor, 'error'), invalid)
+
+        # The consumer survived and still handles frames
+        await doctor.send_json_to({'type': 'media_state', 'audio': True})
+        frame = await self.receive_frame(doctor, 'active_users')
+        self.assertEqual(frame['event'], 'media_state')
+        await doctor.disconnect()
+
+
+class WhoAmIConsumer(AsyncJsonWebsocketConsumer):
+
+    async def connect(self):
+        await self.accept()
+        user = self.scope['user']
+        await self.send_json({'id': user.id, 'role': None if user.is_anonymous else user.roles.role})
+
+
+class JWTAuthMiddlewareTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.token = AccessToken.for_user(self.doctor)
+
+    async def whoami(self, token):
+        communicator = WebsocketCommunicator(JWTAuthMiddleware(WhoAmIConsumer.as_asgi()), f'/ws/?token={token}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return frame
+
+    async def test_reconnect_with_a_cached_user_makes_no_queries(self):
+        async with capture_queries() as queries:
+            self.assertEqual(await self.whoami(self.token), {'id': self.doctor.id, 'role': 'doctor'})
+        self.assertEqual(len(queries), 1)
+
+        async with capture_queries() as queries:
+            self.assertEqual(await self.whoami(self.token), {'id': self.doctor.id, 'role': 'doctor'})
+        self.assertEqual(len(queries), 0)
+
+        # Profile and block updates drop the snapshot, so the next connect reads the user again
+        await sync_to_async(invalidate_user_snapshot)(self.doctor.id)
+        async with capture_queries() as queries:
+            await self.whoami(self.token)
+        self.assertEqual(len(queries), 1)
+
+    async def test_invalid_token_is_anonymous(self):
+        async with capture_queries() as queries:
+            self.assertEqual(await self.whoami('invalid'), {'id': None, 'role': None})
+        self.assertEqual(len(queries), 0)
+
+
+class PresenceMember(PresenceConsumerMixin):
+    presence = None
+
+    def __init__(self, presence, channel_name='channel', user_id=1):
+        self.presence = presence
+        self.room_group_name = 'room'
+        self.channel_name = channel_name
+        self.user = mock.Mock(id=user_id)
+
+
+class PresenceTests(SimpleTestCase):
+
+    async def test_join_and_leave(self):
+        presence = InMemoryPresence()
+        await presence.join('room', 'a', 1)
+        await presence.join('room', 'b', 1)
+        await presence.join('room', 'c', 2)
+        await presence.set_state('room', 'c', {'media': 'audio'})
+
+        self.assertEqual(await presence.count('room'), 3)
+        self.assertCountEqual(await presence.channels('room'), ['a', 'b', 'c'])
+        self.assertEqual(await presence.participants('room'), {'a': {}, 'b': {}, 'c': {'media': 'audio'}})
+
+        await presence.leave('room', 'a', 1)
+        self.assertTrue(await presence.is_present('room', 1))
+        await presence.leave('room', 'b', 1)
+        self.assertFalse(await presence.is_present('room', 1))
+        await presence.leave('room', 'c', 2)
+        self.assertEqual(await presence.count('room'), 0)
+        self.assertEqual(await presence.participants('room'), {})
+
+        # State does not outlive a leave
+        await presence.join('room', 'c', 2)
+        self.assertEqual(await presence.participants('room'), {'c': {}})
+
+    async def test_expired_channels_are_reaped(self):
+        presence = InMemoryPresence(ttl=60)
+        with mock.patch('chat.presence.time.monotonic', return_value=1000):
+            await presence.join('room', 'crashed', 1)
+            await presence.join('room', 'alive', 2)
+        with mock.patch('chat.presence.time.monotonic', return_value=1040):
+            await presence.heartbeat('room', 'alive', 2)
+
+        with mock.patch('chat.presence.time.monotonic', return_value=1061):
+            self.assertEqual(await presence.channels('room'), ['alive'])
+            self.assertFalse(await presence.is_present('room', 1))
+            self.assertEqual(await presence.count('room'), 1)
+        with mock.patch('chat.presence.time.monotonic', return_value=1101):
+            self.assertEqual(await presence.count('room'), 0)
+
+    async def test_heartbeat_survives_store_errors(self):
+        presence = InMemoryPresence(ttl=0.06)
+        member = PresenceMember(presence)
+        beats = []
+
+        async def heartbeat(*args):
+            beats.append(args)
+            if len(beats) == 1:
+                raise ConnectionError("Redis is down")
+            await InMemoryPresence.heartbeat(presence, *args)
+
+        with mock.patch.object(presence, 'heartbeat', heartbeat), self.assertLogs('chat.presence', 'WARNING'):
+            await member.join_presence()
+            # A heartbeat task that died on the error never gets here
+            await asyncio.wait_for(self.beats(beats, 4), timeout=5)
+            self.assertFalse(member.presence_heartbeat.done())
+            self.assertTrue(await presence.is_present('room', 1))
+            await member.leave_presence()
+
+        self.assertEqual(await presence.count('room'), 0)
+
+    async def beats(self, beats, count):
+        while len(beats) < count:
+            await asyncio.sleep(0.01)
+
+
+class OutboundQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.overflowed = asyncio.Event()
+        self.failed = asyncio.Event()
+        self.totals = dict(outbound_totals)
+
+    async def send(self, text_data):
+        self.sent.append(json.loads(text_data))
+
+    async def on_overflow(self):
+        self.overflowed.set()
+
+    async def on_error(self):
+        self.failed.set()
+
+    def queue(self, high_water=3, send=None):
+        queue = OutboundQueue(send or self.send, self.on_overflow, self.on_error, high_water=high_water)
+        self.addCleanup(queue.close)
+        return queue
+
+    async def drain(self, queue):
+        # put() is synchronous, so nothing is written until the test yields to the writer task
+        while queue.frames:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    def counted(self, outcome):
+        return outbound_totals[outcome] - self.totals.get(outcome, 0)
+
+    def sent_ids(self):
+        return [frame['id'] for frame in self.sent]
+
+    async def test_frames_are_written_in_order(self):
+        queue = self.queue(high_water=10)
+        for index in range(5):
+            queue.put(Frame(payload={'id': index}))
+        await self.drain(queue)
+        self.assertEqual(self.sent_ids(), [0, 1, 2, 3, 4])
+
+    async def test_coalesced_frames_merge_into_the_queued_one(self):
+        def merge(queued, new):
+            return {'id': 'read', 'ids': queued['ids'] + new['ids']}
+
+        queue = self.queue()
+        for ids in ([1], [2], [3]):
+            queue.put(Frame(payload={'id': 'read', 'ids': ids}, policy=COALESCE, key='read', merge=merge))
+        self.assertEqual(len(queue), 1)
+        await self.drain(queue)
+        self.assertEqual(self.sent, [{'id': 'read', 'ids': [1, 2, 3]}])
+        self.assertEqual(self.counted('coalesced'), 2)
+
+    async def test_lossy_frames_only_push_out_their_own_kind(self):
+        queue = self.queue()
+        queue.put(Frame(payload={'id': 'users 1'}, policy=DROP_OLDEST, key='users'))
+        queue.put(Frame(payload={'id': 'ice 1'}, policy=DROP_OLDEST, key='ice'))
+        queue.put(Frame(payload={'id': 'ice 2'}, policy=DROP_OLDEST, key='ice'))
+        # A burst of candidates replaces older candidates, never the participant update
+        for index in range(3, 6):
+            queue.put(Frame(payload={'id': f'ice {index}'}, policy=DROP_OLDEST, key='ice'))
+        # With no older frame of its kind queued, a lossy frame is itself dropped
+        queue.put(Frame(payload={'id': 'notification'}, policy=DROP_OLDEST, key='notification'))
+
+        await self.drain(queue)
+        self.assertEqual(self.sent_ids(), ['users 1', 'ice 4', 'ice 5'])
+        self.assertEqual(self.counted('dropped'), 4)
+        self.assertFalse(self.overflowed.is_set())
+
+    async def test_frames_that_must_arrive_push_out_any_lossy_frame(self):
+        queue = self.queue()
+        queue.put(Frame(payload={'id': 'users'}, policy=DROP_OLDEST, key='users'))
+        queue.put(Frame(payload={'id': 'message 1'}))
+        queue.put(Frame(payload={'id': 'ice'}, policy=DROP_OLDEST, key='ice'))
+        queue.put(Frame(payload={'id': 'message 2'}))
+        await self.drain(queue)
+        self.assertEqual(self.sent_ids(), ['message 1', 'ice', 'message 2'])
+        self.assertEqual(self.counted('dropped'), 1)
+
+    async def test_overflow_without_lossy_frames_disconnects(self):
+        queue = self.queue()
+        for index in range(4):
+            queue.put(Frame(payload={'id': index}))
+
+        await asyncio.wait_for(self.overflowed.wait(), 1)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.counted('disconnects'), 1)
+        # The socket is closing; later frames are ignored
+        queue.put(Frame(payload={'id': 'late'}))
+        await self.drain(queue)
+        self.assertEqual(self.sent, [])
+
+    async def test_failed_send_stops_the_queue_and_closes(self):
+        async def broken_send(text_data):
+            raise ConnectionResetError
+
+        queue = self.queue(send=broken_send)
+        queue.put(Frame(payload={'id': 1}))
+        queue.put(Frame(payload={'id': 2}))
+
+        with self.assertLogs('chat.outbound', 'ERROR'):
+            await asyncio.wait_for(self.failed.wait(), 1)
+        self.assertTrue(queue.writer.done())
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.counted('write_errors'), 1)
+
+    async def test_metrics_report_queue_depths(self):
+        before = outbound_metrics()
+        first, second = self.queue(high_water=10), self.queue(high_water=10)
+        for index in range(3):
+            first.put(Frame(payload={'id': index}))
+        second.put(Frame(payload={'id': 0}))
+
+        stats = outbound_metrics()
+        self.assertEqual(stats['queues'], before['queues'] + 2)
+        self.assertEqual(stats['depth'], before['depth'] + 4)
+        self.assertEqual(stats['max_depth'], max(before['max_depth'], 3))
+        collect_depth()
+        self.assertEqual(registry.gauges[('websocket_outbound_depth', ())], stats['depth'])
+        self.assertEqual(registry.gauges[('websocket_outbound_max_depth', ())], stats['max_depth'])
+
+
+# Re-creating the storage makes it connect inside the moto mock
+@override_settings(STORAGES={**settings.STORAGES})
+class ChatMediaFinalizeTests(TestCase):
+
+    def setUp(self):
+        self.s3 = mock_media_bucket(self)
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.room = ChatRoom.objects.create(name='room', doctor=self.doctor, patient=self.patient)
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+
+    def upload(self, body=b'scan'):
+        response = self.client.post('/chat/media/upload/', {
+            'room_name': self.room.name, 'file_name': 'scan.png', 'file_type': 'image/png', 'size': len(body),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.s3.put_object(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=response.data['fields']['key'], Body=body,
+            ContentType='image/png',
+        )
+        return response.data['upload_token']
+
+    def finalize(self, upload_token, **data):
+        return self.client.post('/chat/media/finalize/', {'upload_token': upload_token, **data}, format='json')
+
+    def test_finalize_is_idempotent(self):
+        upload_token = self.upload()
+        channel_layer = get_channel_layer()
+        with mock.patch.object(channel_layer, 'group_send', wraps=channel_layer.group_send) as group_send:
+            first = self.finalize(upload_token)
+            retry = self.finalize(upload_token)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(ChatHistory.objects.filter(room=self.room).count(), 1)
+        chat_messages = [call for call in group_send.call_args_list if call.args[1]['type'] == 'chat_message']
+        self.assertEqual(len(chat_messages), 1)
+
+    def test_finalize_requires_the_uploaded_object(self):
+        response = self.client.post('/chat/media/upload/', {
+            'room_name': self.room.name, 'file_name': 'scan.png', 'size': 4,
+        })
+        self.assertEqual(self.finalize(response.data['upload_token']).status_code, 400)
+        self.assertFalse(ChatHistory.objects.exists())
+
+    def test_token_is_bound_to_its_user(self):
+        upload_token = self.upload()
+        self.client.force_authenticate(self.patient)
+        self.assertEqual(self.finalize(upload_token).status_code, 400)
+
+    def test_replied_to_must_belong_to_the_room(self):
+        other_room = ChatRoom.objects.create(
+            name='other', doctor=self.doctor, patient=make_user('other@test.invalid', 'patient'),
+        )
+        foreign = ChatHistory.objects.create(room=other_room, sender=self.doctor, message='private')
+        upload_token = self.upload()
+
+        for replied_to in (foreign.id, foreign.id + 1000):
+            response = self.finalize(upload_token, replied_to=replied_to)
+            self.assertEqual(response.status_code, 400)
+            self.assertNotIn('private', str(response.data))
+        self.assertFalse(ChatHistory.objects.filter(room=self.room).exists())
+
+        own = ChatHistory.objects.create(room=self.room, sender=self.patient, message='question')
+        response = self.finalize(upload_token, replied_to=own.id)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['replied_to'], 'question')
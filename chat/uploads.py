@@ -0,0 +1,56 @@
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from chat.models import ChatHistory
+
+
+class UploadError(ValueError):
+    pass
+
+
+class MediaUpload:
+    """
+    A chat attachment arriving in chunks. Data is spooled to a temporary file so the whole
+    file never sits in memory, and the announced size is enforced before anything is accepted.
+    """
+
+    def __init__(self, file_name, file_type, size, replied_to_id=None):
+        if size <= 0:
+            raise UploadError("File size must be positive.")
+        if size > settings.CHAT_MEDIA_MAX_SIZE:
+            raise UploadError(f"File is larger than {settings.CHAT_MEDIA_MAX_SIZE} bytes.")
+
+        if file_name is not None and not isinstance(file_name, str):
+            raise UploadError("Invalid file name.")
+
+        self.id = uuid.uuid4()
+        # Older clients may leave the name out; the storage still needs one
+        self.file_name = file_name or self.id.hex
+        self.file_type = file_type
+        self.size = size
+        self.replied_to_id = replied_to_id
+        self.received = 0
+        self.file = tempfile.TemporaryFile()
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def write(self, chunk):
+        if self.received + len(chunk) > self.size:
+            raise UploadError("Received more data than announced.")
+        self.file.write(chunk)
+        self.received += len(chunk)
+
+    def save_to_storage(self):
+        # Blocking: run in a worker thread. S3Boto3Storage switches to multipart uploads for large files.
+        self.file.seek(0)
+        name = ChatHistory._meta.get_field('media').generate_filename(None, self.file_name)
+        return default_storage.save(name, File(self.file))
+
+    def close(self):
+        self.file.close()
@@ -5,4 +5,6 @@ from chat import views
 urlpatterns = [
     path('get_room/', views.ChatRoomView.as_view()),
     path('get_chat/', views.RecentlyChat.as_view()),
+    path('media/upload/', views.ChatMediaUploadView.as_view()),
+    path('media/finalize/', views.ChatMediaFinalizeView.as_view()),
 ]
@@ -1,12 +1,20 @@
+import json
+from datetime import datetime
 from urllib.parse import urljoin
 
-from asgiref.sync import sync_to_async
-
 from HospitalSystem import settings
+from HospitalSystem.media import media_url
 
-import logging
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-logger = logging.getLogger('chat')
+# Columns needed by format_message_values, so history pages can skip model instantiation
+MESSAGE_FIELDS = (
+    'id', 'sender_id', 'message', 'media', 'file_type', 'timestamp', 'replied_to__message', 'is_edited', 'is_deleted',
+    'read_status',
+)
 
 
 def build_media_absolute_uri(media_url):
@@ -14,34 +22,65 @@ def build_media_absolute_uri(media_url):
     return urljoin(base_url, media_url)
 
 
-@sync_to_async
+def dumps_frame(payload):
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload)
+
+
+def encode_history_cursor(timestamp, message_id):
+    return f"{timestamp.isoformat()}|{message_id}"
+
+
+def decode_history_cursor(cursor):
+    """Inverse of encode_history_cursor; raises ValueError for anything it did not produce."""
+    if not isinstance(cursor, str):
+        raise ValueError("History cursor must be a string.")
+    timestamp, _, message_id = cursor.rpartition('|')
+    return datetime.fromisoformat(timestamp), int(message_id)
+
+
+# The formatters below never touch the database: callers pass rows with sender, room and replied_to already loaded
+
+
 def format_notification(message):
     sender = message.sender
-    room = message.room
-    logger.info(f"Форматируем уведомление: {message}")
     return {
-        'room_name': room.name,
+        'room_name': message.room.name,
         'sender_id': sender.id,
         'sender_name': f"{sender.first_name} {sender.last_name}",
-        **{'sender_avatar': build_media_absolute_uri(sender.avatar.url) if sender.avatar else None},
-        **{'content': message.message if message.message else None},
-        **{'media': build_media_absolute_uri(message.media.url) if message.media else None},
+        'sender_avatar': build_media_absolute_uri(media_url(sender.avatar)) if sender.avatar else None,
+        'content': message.message or None,
+        'media': build_media_absolute_uri(media_url(message.media)) if message.media else None,
         'timestamp': message.timestamp.isoformat(),
     }
 
 
-@sync_to_async
 def format_message(message):
-    logger.info(f"Форматируем сообщение: {message}")
     return {
         'id': message.id,
-        'sender': message.sender.id,
-        **{'content': message.message if message.message else None},
-        **{'media': build_media_absolute_uri(message.media.url) if message.media else None},
-        **{'file_type': message.file_type if message.file_type else None},
+        'sender': message.sender_id,
+        'content': message.message or None,
+        'media': build_media_absolute_uri(media_url(message.media)) if message.media else None,
+        'file_type': message.file_type or None,
         'timestamp': message.timestamp.isoformat(),
-        **{'replied_to': message.replied_to.message if message.replied_to else None},
+        'replied_to': message.replied_to.message if message.replied_to_id else None,
         'is_edited': message.is_edited,
         'is_deleted': message.is_deleted,
         'is_read': message.read_status,
     }
+
+
+def format_message_values(row):
+    return {
+        'id': row['id'],
+        'sender': row['sender_id'],
+        'content': row['message'] or None,
+        'media': build_media_absolute_uri(media_url(row['media'])) if row['media'] else None,
+        'file_type': row['file_type'] or None,
+        'timestamp': row['timestamp'].isoformat(),
+        'replied_to': row['replied_to__message'],
+        'is_edited': row['is_edited'],
+        'is_deleted': row['is_deleted'],
+        'is_read': row['read_status'],
+    }
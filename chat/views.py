@@ -1,53 +1,150 @@
 import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework.generics import GenericAPIView
-from rest_framework.views import APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.generics import GenericAPIView, ListAPIView
 
-from .models import ChatRoom
-from .serializers import ChatRoomSerializer
+from HospitalSystem.media import presign_upload, resolve_upload, DirectUploadError
+from HospitalSystem.metrics import GROUP_SEND_DURATION
+from users.authentication import RoleJWTAuthentication
+from .inbox import inbox_queryset
+from .models import ChatRoom, ChatHistory
+from .pagination import InboxCursorPagination
+from .presence import get_presence
+from .serializers import ChatRoomSerializer, ChatMediaUploadSerializer, ChatMediaFinalizeSerializer
+from .utils import format_message, format_notification
 
 
 class ChatRoomView(GenericAPIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [RoleJWTAuthentication]
 
     def post(self, request):
-        if request.user.roles.role == 'doctor':
+        if request.user.role == 'doctor':
             doctor = request.user.id
             patient = request.data.get('user_id')
-        elif request.user.roles.role == 'patient':
+        elif request.user.role == 'patient':
             doctor = request.data.get('user_id')
             patient = request.user.id
         else:
             return Response({'detail': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        try:
-            room = ChatRoom.objects.get(doctor_id=doctor, patient_id=patient)
-            return Response({'room_name': room.name}, status=status.HTTP_200_OK)
-        except ChatRoom.DoesNotExist:
-            uuid_str = str(uuid.uuid4())
-            room_name = f'Room_{doctor}_{patient}_{uuid_str}'  # Название новой комнаты
-            room = ChatRoom.objects.create(name=room_name, doctor_id=doctor, patient_id=patient)
+        # chat_room_unique_pair makes concurrent first contacts converge on one room
+        room, created = ChatRoom.objects.get_or_create(
+            doctor_id=doctor, patient_id=patient,
+            defaults={'name': lambda: f'Room_{doctor}_{patient}_{uuid.uuid4()}'},
+        )
+        return Response({'room_name': room.name}, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+class RecentlyChat(ListAPIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [RoleJWTAuthentication]
+    serializer_class = ChatRoomSerializer
+    pagination_class = InboxCursorPagination
+    query_budget = 2
+
+    def get_queryset(self):
+        return inbox_queryset(self.request.user)
 
-            return Response({'room_name': room.name}, status=status.HTTP_201_CREATED)
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'request_user': self.request.user}
 
 
-class RecentlyChat(APIView):
+class ChatMediaUploadView(GenericAPIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [RoleJWTAuthentication]
+    serializer_class = ChatMediaUploadSerializer
 
-    def get(self, request):
-        user = request.user
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
 
-        if user.roles.role == 'doctor':
-            queryset = ChatRoom.objects.filter(doctor=user)
-        elif user.roles.role == 'patient':
-            queryset = ChatRoom.objects.filter(patient=user)
-        else:
-            queryset = []
+        room = ChatRoom.objects.filter(
+            Q(doctor=request.user) | Q(patient=request.user), name=data['room_name']
+        ).first()
+        if not room:
+            return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        if data['size'] > settings.CHAT_MEDIA_MAX_SIZE:
+            return Response({'detail': f'File is larger than {settings.CHAT_MEDIA_MAX_SIZE} bytes.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        upload = presign_upload(
+            ChatHistory._meta.get_field('media').upload_to, data['file_name'], data.get('file_type') or None,
+            settings.CHAT_MEDIA_MAX_SIZE, user=request.user.id, room=room.id
+        )
+        return Response(upload, status=status.HTTP_200_OK)
+
+
+class ChatMediaFinalizeView(GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [RoleJWTAuthentication]
+    serializer_class = ChatMediaFinalizeSerializer
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            upload = resolve_upload(serializer.validated_data['upload_token'], user=request.user.id)
+        except DirectUploadError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        replied_to_id = serializer.validated_data.get('replied_to')
+        with transaction.atomic():
+            # Locking the room serializes finalizes of its uploads, so a retried token finds the first message
+            room = ChatRoom.objects.select_for_update().get(id=upload['room'])
+            # The token is at most two upload lifetimes old, which keeps this lookup on the (room, timestamp) index
+            message = ChatHistory.objects.select_related('replied_to').filter(
+                room=room, media=upload['key'],
+                timestamp__gte=timezone.now() - timedelta(seconds=settings.DIRECT_UPLOAD_EXPIRES * 2),
+            ).first()
+            if message:
+                return Response(format_message(message), status=status.HTTP_200_OK)
+
+            replied_to = None
+            if replied_to_id is not None:
+                replied_to = ChatHistory.objects.filter(room=room, id=replied_to_id).first()
+                if replied_to is None:
+                    return Response({'detail': 'Replied message not found.'}, status=status.HTTP_400_BAD_REQUEST)
+
+            group_name = f'chat_{room.name}'
+            counterpart_id = room.patient_id if request.user.id == room.doctor_id else room.doctor_id
+            is_read = async_to_sync(get_presence().is_present)(group_name, counterpart_id)
+
+            message = ChatHistory.objects.create(
+                room=room,
+                sender=request.user,
+                media=upload['key'],
+                file_type=upload['file_type'],
+                message='',
+                replied_to=replied_to,
+                read_status=is_read
+            )
+
+        formatted_message = format_message(message)
+
+        channel_layer = get_channel_layer()
+        with GROUP_SEND_DURATION.time(source=type(self).__name__):
+            async_to_sync(channel_layer.group_send)(group_name, {
+                'type': 'chat_message',
+                'messages': formatted_message
+            })
+        if not is_read:
+            with GROUP_SEND_DURATION.time(source=type(self).__name__):
+                async_to_sync(channel_layer.group_send)(f'notification_{counterpart_id}', {
+                    'type': 'send_notification',
+                    'notification': format_notification(message)
+                })
 
-        serializer = ChatRoomSerializer(queryset, many=True, context={'request_user': user, 'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(formatted_message, status=status.HTTP_201_CREATED)
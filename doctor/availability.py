@@ -0,0 +1,102 @@
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+from HospitalSystem.cache_versions import bump_version, get_versions
+from patient.models import Appointment
+
+
+def _build_slots():
+    # (start, "HH:MM-HH:MM" label, "HH:MM:SS" value) for every bookable slot that ends the same day
+    day_end = datetime.datetime.combine(datetime.date.min, datetime.time(23, 59))
+    slots = []
+    for start, _ in Appointment.TIME_CHOICES:
+        end = datetime.datetime.combine(datetime.date.min, start) + Appointment.VISIT_DURATION
+        if end <= day_end:
+            slots.append((start, f"{start.strftime('%H:%M')}-{end.strftime('%H:%M')}", start.strftime('%H:%M:%S')))
+    return tuple(slots)
+
+
+SLOTS = _build_slots()
+
+
+def _version_key(doctor_id):
+    return f'availability:version:{doctor_id}'
+
+
+def _cache_key(doctor_id, version, day):
+    return f'availability:{doctor_id}:{version}:{day.isoformat()}'
+
+
+def _get_versions(doctor_ids):
+    keys = {doctor_id: _version_key(doctor_id) for doctor_id in doctor_ids}
+    versions = get_versions(keys.values())
+    return {doctor_id: versions[key] for doctor_id, key in keys.items()}
+
+
+def busy_slots(doctor_ids, days):
+    """
+    Booked start times per (doctor_id, day). Doctor-days missing from the cache are loaded
+    with a single range query and cached under the doctor's current version.
+    """
+    # Versions are read before the database: a booking committed after this point bumps the
+    # version, so whatever this call caches from an older snapshot is never read again
+    versions = _get_versions(doctor_ids)
+    keys = {
+        (doctor_id, day): _cache_key(doctor_id, versions[doctor_id], day) for doctor_id in doctor_ids for day in days
+    }
+    cached = cache.get_many(keys.values())
+
+    busy = {}
+    missing = []
+    for doctor_day, key in keys.items():
+        if key in cached:
+            busy[doctor_day] = set(cached[key])
+        else:
+            missing.append(doctor_day)
+
+    if missing:
+        fetched = {doctor_day: set() for doctor_day in missing}
+        rows = Appointment.objects.filter(
+            doctor_id__in={doctor_id for doctor_id, _ in missing},
+            date__range=(min(day for _, day in missing), max(day for _, day in missing)),
+        ).values_list('doctor_id', 'date', 'time')
+        for doctor_id, day, start in rows:
+            if (doctor_id, day) in fetched:
+                fetched[(doctor_id, day)].add(start)
+
+        cache.set_many({keys[doctor_day]: sorted(times) for doctor_day, times in fetched.items()},
+                       settings.AVAILABILITY_CACHE_TIMEOUT)
+        busy.update(fetched)
+
+    return busy
+
+
+def day_availability(busy_times, day, now):
+    # Slots that already started today are not offered at all
+    current_time = now.time() if day == now.date() else None
+    return [
+        {
+            "time": label,
+            "value": value,
+            "is_available": start not in busy_times,
+        }
+        for start, label, value in SLOTS
+        if current_time is None or start >= current_time
+    ]
+
+
+def availability_matrix(doctor_ids, start, days):
+    dates = [start + datetime.timedelta(days=offset) for offset in range(days)]
+    busy = busy_slots(doctor_ids, dates)
+    now = datetime.datetime.now()
+    return {
+        doctor_id: {day.isoformat(): day_availability(busy[(doctor_id, day)], day, now) for day in dates}
+        for doctor_id in doctor_ids
+    }
+
+
+def invalidate_availability(doctor_id):
+    """Drop every cached day of a doctor; doctor.signals calls it once an appointment change commits."""
+    bump_version(_version_key(doctor_id))
@@ -0,0 +1,26 @@
+import hashlib
+
+from django.utils.http import quote_etag
+
+from HospitalSystem.cache_versions import bump_version, get_version
+
+DIRECTORY_VERSION_KEY = 'doctor_directory:version'
+
+
+def get_directory_version():
+    return get_version(DIRECTORY_VERSION_KEY)
+
+
+def bump_directory_version():
+    """Invalidate every cached directory page; call after any change to a doctor's public profile."""
+    bump_version(DIRECTORY_VERSION_KEY)
+
+
+def directory_cache_key(request, version):
+    digest = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'doctor_directory:{version}:{digest}'
+
+
+def directory_etag(cache_key):
+    # "<version>:<url digest>" changes exactly when the cached page does
+    return quote_etag(cache_key.split(':', 1)[1])
@@ -1,3 +1,4 @@
+from HospitalSystem.media import absolute_media_url
 from patient.models import Appointment
 from rest_framework import serializers
 from users.models import User, Role, SubRole
@@ -16,10 +17,7 @@ class DoctorSerializer(serializers.ModelSerializer):
             'id', 'avatar', 'first_name', 'last_name', 'email', 'phone', 'gender', 'date_birth', 'roles', 'sub_role')
 
     def get_avatar(self, obj):
-        request = self.context.get('request')
-        if obj.avatar:
-            return request.build_absolute_uri(obj.avatar.url)
-        return None
+        return absolute_media_url(self.context.get('request'), obj.avatar)
 
 
 class DoctorRegisterSerializer(serializers.ModelSerializer):
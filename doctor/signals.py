@@ -0,0 +1,23 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from doctor.availability import invalidate_availability
+from patient.models import Appointment
+
+
+@receiver(post_init, sender=Appointment)
+def remember_appointment_doctor(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred doctor_id is not loaded just for this
+    instance._loaded_doctor_id = instance.__dict__.get('doctor_id')
+
+
+@receiver([post_save, post_delete], sender=Appointment)
+def invalidate_appointment_availability(sender, instance, **kwargs):
+    # Covers the booking API, admin edits and cascade deletes alike. Runs after commit so readers
+    # that refill the cache from then on see the change
+    for doctor_id in {instance.doctor_id, instance._loaded_doctor_id} - {None}:
+        transaction.on_commit(partial(invalidate_availability, doctor_id))
+    instance._loaded_doctor_id = instance.doctor_id
@@ -0,0 +1,192 @@
+import datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from HospitalSystem.query_budget import assert_query_budget
+from HospitalSystem.testing import make_user
+from doctor.availability import busy_slots
+from doctor.views import AllSpecialistList, AvailabilityView, ReturnTimeList, SpecialistList
+from patient.models import Appointment
+from users.models import User, SubRole
+
+
+class AvailabilityCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.other_doctor = make_user('other@test.invalid', 'doctor')
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.day = datetime.date.today() + datetime.timedelta(days=1)
+
+    def busy(self, doctor, day=None):
+        day = day or self.day
+        return busy_slots([doctor.id], [day])[(doctor.id, day)]
+
+    def book(self, doctor=None, day=None, start=datetime.time(9)):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Appointment.objects.create(
+                patient=self.patient, doctor=doctor or self.doctor, date=day or self.day, time=start,
+            )
+
+    def test_booking_committed_during_a_refill_is_not_hidden(self):
+        real_set_many = cache.set_many
+
+        def book_then_set_many(*args, **kwargs):
+            # The refill already read the database; the booking commits before it stores the result
+            self.book()
+            return real_set_many(*args, **kwargs)
+
+        with mock.patch.object(cache, 'set_many', side_effect=book_then_set_many):
+            self.assertEqual(self.busy(self.doctor), set())
+        self.assertEqual(self.busy(self.doctor), {datetime.time(9)})
+
+    def test_cached_days_are_served_without_queries(self):
+        self.book()
+        self.busy(self.doctor)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.busy(self.doctor), {datetime.time(9)})
+
+    def test_edits_outside_the_booking_api_invalidate(self):
+        appointment = self.book()
+        self.assertEqual(self.busy(self.doctor), {datetime.time(9)})
+
+        # As the admin would: move the appointment to another doctor and time
+        appointment.doctor = self.other_doctor
+        appointment.time = datetime.time(10)
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.save()
+        self.assertEqual(self.busy(self.doctor), set())
+        self.assertEqual(self.busy(self.other_doctor), {datetime.time(10)})
+
+        # Deleting the patient cascades to the appointment
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.delete()
+        self.assertEqual(self.busy(self.other_doctor), set())
+
+    def test_evicted_version_never_serves_stale_days(self):
+        self.busy(self.doctor)
+        cache.delete(f'availability:version:{self.doctor.id}')
+        # Booked while the counter is gone: the bump re-seeds it from the clock
+        self.book()
+        self.assertEqual(self.busy(self.doctor), {datetime.time(9)})
+
+    def test_invalidation_waits_for_commit(self):
+        self.busy(self.doctor)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=self.day, time=datetime.time(9))
+            self.assertEqual(self.busy(self.doctor), set())
+        self.assertEqual(len(callbacks), 1)
+
+
+class DirectoryQueryBudgetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.patient)}')
+        self.day = datetime.date.today() + datetime.timedelta(days=1)
+
+    def add_doctors(self, count):
+        specialization = SubRole.objects.get_or_create(sub_role='cardiologist')[0]
+        for index in range(User.objects.filter(roles__role='doctor').count(), count):
+            doctor = make_user(f'doctor{index}@test.invalid', 'doctor')
+            doctor.sub_role = specialization
+            doctor.save()
+            Appointment.objects.create(patient=self.patient, doctor=doctor, date=self.day, time=datetime.time(9))
+
+    def get(self, view, url):
+        # Every request misses the caches, so the budget covers the database path
+        cache.clear()
+        with assert_query_budget(view.query_budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_directory_stays_within_budget(self):
+        for count in (1, 25):
+            self.add_doctors(count)
+            with self.subTest(count=count):
+                self.assertEqual(self.get(AllSpecialistList, '/doctor/all/')['count'], count)
+                data = self.get(SpecialistList, '/doctor/specialist/?specialization=cardiologist')
+                self.assertEqual(data['count'], count)
+
+    def test_availability_stays_within_budget(self):
+        self.add_doctors(10)
+        doctors = ','.join(str(doctor.id) for doctor in User.objects.filter(roles__role='doctor'))
+        self.get(ReturnTimeList, f'/doctor/time/?date={self.day.isoformat()}&doctor={doctors.split(",")[0]}')
+        data = self.get(AvailabilityView, f'/doctor/availability/?doctors={doctors}&start={self.day.isoformat()}')
+        self.assertEqual(len(data), 10)
+
+
+class AvailabilityValidationTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(make_user('patient@test.invalid', 'patient'))
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+
+    def test_impossible_dates_are_rejected(self):
+        for date in ('2024-02-30', '2024-13-01', 'tomorrow'):
+            with self.subTest(date=date):
+                response = self.client.get(f'/doctor/availability/?doctors={self.doctor.id}&start={date}')
+                self.assertEqual(response.status_code, 400)
+                response = self.client.get(f'/doctor/time/?doctor={self.doctor.id}&date={date}')
+                self.assertEqual(response.status_code, 400)
+
+    def test_start_defaults_to_today(self):
+        response = self.client.get(f'/doctor/availability/?doctors={self.doctor.id}&days=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data[self.doctor.id]), [datetime.date.today().isoformat()])
+
+
+class DirectoryConditionalTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.client = APIClient()
+
+    def directory(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/doctor/all/', **headers)
+
+    def assertInvalidated(self, etag, first_name):
+        response = self.directory(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['results'][0]['first_name'], first_name)
+
+    def test_etag_round_trip(self):
+        response = self.directory()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.directory(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_doctor_update_invalidates(self):
+        etag = self.directory()['ETag']
+
+        response = self.client.patch('/doctor/update/', {'id': self.doctor.id, 'first_name': 'Renamed'})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertInvalidated(etag, 'Renamed')
+
+    def test_user_update_invalidates(self):
+        etag = self.directory()['ETag']
+
+        doctor_client = APIClient()
+        doctor_client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.doctor)}')
+        response = doctor_client.patch('/users/update/', {'first_name': 'Renamed'}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertInvalidated(etag, 'Renamed')
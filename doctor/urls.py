@@ -11,4 +11,5 @@ urlpatterns = [
     path('specialist/', views.SpecialistList.as_view()),
     path('all/', views.AllSpecialistList.as_view()),
     path('time/', views.ReturnTimeList.as_view()),
+    path('availability/', views.AvailabilityView.as_view()),
 ]
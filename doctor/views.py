@@ -1,6 +1,9 @@
-from datetime import timedelta, datetime, time
+from datetime import datetime
 
-from django.core.mail import send_mail
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.dateparse import parse_date
 from drf_spectacular.utils import extend_schema
 from rest_framework import status
@@ -9,82 +12,135 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from doctor.availability import busy_slots, day_availability, availability_matrix
+from doctor.directory import get_directory_version, bump_directory_version, directory_cache_key, directory_etag
+from doctor.pagination import DoctorDirectoryPagination
 from doctor.serializers import DoctorSerializer, DoctorRegisterSerializer, DoctorUpdateSerializer
+from mailer.outbox import enqueue_email
+from users.cache import invalidate_user_snapshot
 from users.models import User, SubRole
-from patient.models import Appointment
 
 
-class SpecialistList(APIView):
+class DoctorDirectoryMixin:
+    serializer_class = DoctorSerializer
+    pagination_class = DoctorDirectoryPagination
+    query_budget = 3
+
+    def get_queryset(self):
+        queryset = User.objects.filter(roles__role='doctor').select_related('roles', 'sub_role')
+
+        specialization = self.request.query_params.get('specialization')
+        if specialization:
+            queryset = queryset.filter(sub_role__sub_role=specialization)
+
+        name = self.request.query_params.get('name')
+        if name:
+            queryset = queryset.filter(Q(first_name__icontains=name) | Q(last_name__icontains=name))
+
+        return queryset.order_by('last_name', 'first_name', 'id')
+
+    def list(self, request, *args, **kwargs):
+        # Pages are cached under the directory version, which doctor profile updates bump
+        cache_key = directory_cache_key(request, get_directory_version())
+        etag = directory_etag(cache_key)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            data = cache.get(cache_key)
+            if data is None:
+                data = super().list(request, *args, **kwargs).data
+                cache.set(cache_key, data, settings.DOCTOR_DIRECTORY_CACHE_TIMEOUT)
+            response = Response(data)
+
+        # A 304 carries the same validator and caching headers as the 200 it stands for
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class SpecialistList(DoctorDirectoryMixin, ListAPIView):
 
     @extend_schema(description="Get specific specialists")
     def get(self, request, *args, **kwargs):
-        if request.user.roles.role != 'doctor':
-            specialization = request.query_params.get('specialization')
-            queryset = User.objects.filter(roles__role='doctor', sub_role__sub_role=specialization)
-            serializer = DoctorSerializer(queryset, many=True, context={'request': request})
-            return Response(serializer.data)
+        if request.user.role == 'doctor':
+            return Response({"detail": "Only patients can browse specialists."}, status=status.HTTP_403_FORBIDDEN)
+        return self.list(request, *args, **kwargs)
 
 
-class AllSpecialistList(ListAPIView):
-    serializer_class = DoctorSerializer
+class AllSpecialistList(DoctorDirectoryMixin, ListAPIView):
     permission_classes = (AllowAny,)
 
     @extend_schema(description="Get all specialists")
     def get(self, request, *args, **kwargs):
-        queryset = User.objects.filter(roles__role='doctor')
-        serializer = DoctorSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data)
+        return self.list(request, *args, **kwargs)
 
 
 class ReturnTimeList(ListAPIView):
+    query_budget = 2
 
     @extend_schema(description="Checking available hours for recording")
     def get(self, request, *args, **kwargs):
         date_str = request.query_params.get('date')
         doctor = request.query_params.get('doctor')
-        current_time = datetime.now().time()
-        today = datetime.now().date()
 
         if date_str is None or doctor is None:
             return Response({"error": "Date or doctor parameter is missing"}, status=400)
 
-        date = parse_date(date_str)
+        try:
+            date = parse_date(date_str)
+        except ValueError:
+            # Well-formed but impossible, such as 2024-02-30
+            date = None
         if date is None:
             return Response({"error": "Invalid date format"}, status=400)
 
-        time_choices = [t[0] for t in Appointment.TIME_CHOICES]
+        try:
+            doctor = int(doctor)
+        except ValueError:
+            return Response({"error": "Invalid doctor"}, status=400)
 
         try:
-            busy_times = set(Appointment.objects.filter(date=date, doctor=doctor).values_list('time', flat=True))
+            busy_times = busy_slots([doctor], [date])[(doctor, date)]
         except Exception as e:
             return Response({"error": "Error fetching data from the database"}, status=500)
 
-        if date == today:
-            time_status_list = [
-                {
-                    "time": f"{t.strftime('%H:%M')}-{(datetime.combine(date.today(), t) + timedelta(minutes=50)).strftime('%H:%M')}",
-                    "value": t.strftime('%H:%M:%S'),
-                    "is_available": (t not in busy_times and t >= current_time)
-                }
-                for t in time_choices
-                if
-                t >= current_time and (datetime.combine(date.today(), t) + timedelta(minutes=50)) <= datetime.combine(
-                    date.today(), time(23, 59))
-            ]
+        return Response(day_availability(busy_times, date, datetime.now()))
+
+
+class AvailabilityView(APIView):
+    query_budget = 2
+
+    @extend_schema(description="Available hours for several doctors over several days")
+    def get(self, request, *args, **kwargs):
+        try:
+            doctors = [int(doctor) for doctor in request.query_params.get('doctors', '').split(',') if doctor]
+        except ValueError:
+            return Response({"error": "Invalid doctors parameter"}, status=400)
+
+        if not doctors:
+            return Response({"error": "Doctors parameter is missing"}, status=400)
+        if len(doctors) > settings.AVAILABILITY_MAX_DOCTORS:
+            return Response({"error": f"At most {settings.AVAILABILITY_MAX_DOCTORS} doctors per request"}, status=400)
+
+        start = request.query_params.get('start')
+        if start:
+            try:
+                start = parse_date(start)
+            except ValueError:
+                start = None
+            if start is None:
+                return Response({"error": "Invalid start date"}, status=400)
         else:
-            # Если дата не сегодня, не сравниваем с current_time
-            time_status_list = [
-                {
-                    "time": f"{t.strftime('%H:%M')}-{(datetime.combine(date.today(), t) + timedelta(minutes=50)).strftime('%H:%M')}",
-                    "value": t.strftime('%H:%M:%S'),
-                    "is_available": (t not in busy_times)
-                }
-                for t in time_choices
-                if (datetime.combine(date.today(), t) + timedelta(minutes=50)) <= datetime.combine(
-                    date.today(), time(23, 59))
-            ]
+            start = datetime.now().date()
+
+        try:
+            days = int(request.query_params.get('days', 7))
+        except ValueError:
+            return Response({"error": "Invalid days parameter"}, status=400)
+        if not 1 <= days <= settings.AVAILABILITY_MAX_DAYS:
+            return Response({"error": f"Days must be between 1 and {settings.AVAILABILITY_MAX_DAYS}"}, status=400)
 
-        return Response(time_status_list)
+        return Response(availability_matrix(doctors, start, days))
 
 
 # class BusyDates(ListAPIView):
@@ -111,16 +167,16 @@ class DoctorRegisterView(CreateAPIView):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid(raise_exception=True):
             doctor = serializer.save()
-            send_mail(
-                f"Hello, {doctor.roles.role}!",
-                "This is your access key for your doctor account: " + doctor.access_key,
-                from_email=None,
-                recipient_list=[doctor.email],
-                fail_silently=False
-            )
+            bump_directory_version()
+            if doctor.email:
+                enqueue_email(
+                    f"Hello, {doctor.role}!",
+                    "This is your access key for your doctor account: " + doctor.access_key,
+                    [doctor.email]
+                )
             return Response({
                 "id": doctor.id,
-                "role": doctor.roles.role,
+                "role": doctor.role,
                 "access_key": doctor.access_key,
                 "detail": "Doctor account created successfully"
             }, status=status.HTTP_201_CREATED)
@@ -167,6 +223,8 @@ class DoctorUpdateView(UpdateAPIView):
 
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            invalidate_user_snapshot(user.id)
+            bump_directory_version()
             return Response({'message': 'Doctor account updated successfully'}, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
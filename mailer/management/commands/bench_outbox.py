@@ -0,0 +1,128 @@
+import socket
+import threading
+import time
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from django.utils.html import strip_tags
+
+from mailer.models import OutboundEmail
+from mailer.outbox import enqueue_template_email, send_batch
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:  # dev dependency
+    Controller = None
+
+TEMPLATE = 'reset_password'
+
+
+class Sink:
+    """aiosmtpd handler that only counts what it accepts."""
+
+    def __init__(self):
+        self.received = 0
+        self.lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        with self.lock:
+            self.received += 1
+        return '250 Message accepted for delivery'
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure outbox throughput against a local SMTP sink: render and enqueue, then drain with send_batch. "
+        "Needs an empty outbox, since every due row would be delivered to the sink."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help="Emails enqueued and drained")
+        parser.add_argument('--batch-size', type=int, default=None, help="Rows claimed per batch (OUTBOX default)")
+        parser.add_argument(
+            '--legacy', action='store_true',
+            help="Also time the former path: render_to_string + strip_tags and one SMTP connection per email",
+        )
+
+    def handle(self, *args, **options):
+        if Controller is None:
+            raise CommandError("aiosmtpd is not installed; it comes with the dev dependencies")
+        if options['messages'] < 1:
+            raise CommandError("--messages must be at least 1")
+        unsent = OutboundEmail.objects.filter(status__in=[OutboundEmail.PENDING, OutboundEmail.SENDING]).count()
+        if unsent:
+            raise CommandError(f"The outbox holds {unsent} unsent emails; they would be delivered to the sink")
+
+        sink = Sink()
+        port = self.free_port()
+        controller = Controller(sink, hostname='127.0.0.1', port=port)
+        controller.start()
+        try:
+            if options['legacy']:
+                self.report('legacy send', options['messages'], self.timed(self.send_legacy, port, options['messages']))
+                sink.received = 0
+            self.bench_outbox(port, options['messages'], options['batch_size'])
+        finally:
+            controller.stop()
+        if sink.received != options['messages']:
+            self.stderr.write(f"The sink received {sink.received} of {options['messages']} emails")
+
+    def bench_outbox(self, port, messages, batch_size):
+        ids = []
+        try:
+            enqueue = self.timed(lambda: ids.extend(
+                enqueue_template_email("Reset Password", TEMPLATE, {'reset_link': f'https://bench.invalid/{index}'},
+                                       [f'user{index}@bench.invalid']).id
+                for index in range(messages)
+            ))
+            self.report('enqueue', messages, enqueue)
+
+            connection = self.connection(port)
+            batches = []
+
+            def drain():
+                while sent := send_batch(batch_size, connection=connection):
+                    batches.append(sent)
+                connection.close()
+
+            drained = self.timed(drain)
+            self.report(f'drain ({len(batches)} batches)', messages, drained)
+            self.report('enqueue + drain', messages, enqueue + drained)
+
+            sent = OutboundEmail.objects.filter(id__in=ids, status=OutboundEmail.SENT).count()
+            if sent != messages:
+                self.stderr.write(f"{sent} of {messages} outbox rows were marked sent")
+        finally:
+            OutboundEmail.objects.filter(id__in=ids).delete()
+
+    def send_legacy(self, port, messages):
+        for index in range(messages):
+            html = render_to_string(f'{TEMPLATE}.html', {'reset_link': f'https://bench.invalid/{index}'})
+            message = EmailMultiAlternatives(
+                "Reset Password", strip_tags(html), to=[f'user{index}@bench.invalid'], connection=self.connection(port),
+            )
+            message.attach_alternative(html, 'text/html')
+            message.send()
+
+    @staticmethod
+    def connection(port):
+        return get_connection(
+            'django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=port, username='', password='',
+            use_tls=False, use_ssl=False,
+        )
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def timed(function, *args):
+        started = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - started
+
+    def report(self, name, messages, elapsed):
+        self.stdout.write(f"{name:<22} {elapsed:7.2f} s  {messages / elapsed:8.0f} msg/s")
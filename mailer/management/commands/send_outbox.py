@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from mailer.outbox import send_batch
+
+
+class Command(BaseCommand):
+    help = "Drain the outbound email queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Send everything that is due and exit")
+
+    def handle(self, *args, **options):
+        # One SMTP session is kept across consecutive batches and closed whenever the queue runs dry
+        connection = get_connection()
+        try:
+            while True:
+                sent = send_batch(connection=connection)
+                if sent:
+                    self.stdout.write(f"Processed {sent} emails")
+                    continue
+                connection.close()
+                if options['once']:
+                    return
+                time.sleep(settings.OUTBOX['POLL_INTERVAL'])
+        finally:
+            connection.close()
@@ -0,0 +1,101 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from HospitalSystem.metrics import EMAIL_SEND_DURATION
+from mailer.models import OutboundEmail
+from mailer.rendering import render_email
+
+
+def enqueue_email(subject, body, to, html_body=None):
+    """Store an email for the outbox worker; the caller never waits on SMTP."""
+    return OutboundEmail.objects.create(subject=subject, body=body, html_body=html_body, to=list(to))
+
+
+def enqueue_template_email(subject, template_name, context, to):
+    text, html = render_email(template_name, context)
+    return enqueue_email(subject, text, to, html_body=html)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(settings.OUTBOX['BACKOFF'] * 2 ** (attempts - 1), settings.OUTBOX['MAX_BACKOFF']))
+
+
+def build_message(email, connection=None):
+    message = EmailMultiAlternatives(subject=email.subject, body=email.body, to=email.to, connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def send_batch(batch_size=None, connection=None):
+    """
+    Send one batch of due emails and return how many were processed. Rows are claimed in a short
+    transaction and sent outside it, so no lock is held while SMTP runs and several workers can
+    drain the outbox at once.
+
+    The whole batch goes over one SMTP connection. A ``connection`` passed in by the caller is
+    left open afterwards so it can be reused for the next batch.
+    """
+    owns_connection = connection is None
+    connection = connection or get_connection()
+    try:
+        return _send_batch(batch_size, connection)
+    finally:
+        if owns_connection:
+            connection.close()
+
+
+def claim_batch(batch_size=None):
+    """
+    Mark a batch of due emails as sending under a lease of OUTBOX['LEASE'] seconds. Pending rows
+    are due at ``next_attempt_at``; sending rows whose lease ran out belong to a worker that died
+    and are claimed again.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status__in=[OutboundEmail.PENDING, OutboundEmail.SENDING], next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size or settings.OUTBOX['BATCH_SIZE']]
+        )
+        lease_until = now + timedelta(seconds=settings.OUTBOX['LEASE'])
+        for email in emails:
+            email.status = OutboundEmail.SENDING
+            email.attempts += 1
+            email.next_attempt_at = lease_until
+        OutboundEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at'])
+    return emails
+
+
+def _send_batch(batch_size, connection):
+    emails = claim_batch(batch_size)
+
+    for email in emails:
+        started = time.perf_counter()
+        try:
+            connection.open()
+            build_message(email, connection).send()
+        except Exception as e:
+            EMAIL_SEND_DURATION.observe(time.perf_counter() - started, status='error')
+            # Drop a possibly broken session; the next email reconnects
+            connection.close()
+            email.last_error = str(e)
+            if email.attempts >= settings.OUTBOX['MAX_ATTEMPTS']:
+                email.status = OutboundEmail.FAILED
+            else:
+                email.status = OutboundEmail.PENDING
+                email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+        else:
+            EMAIL_SEND_DURATION.observe(time.perf_counter() - started, status='sent')
+            email.status = OutboundEmail.SENT
+            email.sent_at = timezone.now()
+            email.last_error = None
+        # Recorded right away, so a worker killed mid-batch only leaves its unsent rows to the lease
+        email.save(update_fields=['status', 'next_attempt_at', 'last_error', 'sent_at'])
+
+    return len(emails)
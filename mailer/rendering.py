@@ -0,0 +1,16 @@
+from django.template.loader import get_template
+
+_templates = {}
+
+
+def _compiled(name):
+    # Both parts are parsed once per process and reused for every email
+    if name not in _templates:
+        _templates[name] = (get_template(f'{name}.txt'), get_template(f'{name}.html'))
+    return _templates[name]
+
+
+def render_email(name, context):
+    """Render ``<name>.txt`` and ``<name>.html`` and return ``(text, html)``."""
+    text_template, html_template = _compiled(name)
+    return text_template.render(context), html_template.render(context)
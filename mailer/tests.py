@@ -0,0 +1,144 @@
+import socket
+from datetime import timedelta
+from email import message_from_bytes
+from unittest import mock
+
+from aiosmtpd.controller import Controller
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import DatabaseError, connections, transaction
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from mailer.models import OutboundEmail
+from mailer.outbox import enqueue_email, send_batch
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Inbox:
+    """aiosmtpd handler that keeps what it receives and refuses recipients at reject.invalid."""
+
+    def __init__(self):
+        self.messages = []
+        self.on_data = None
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.endswith('@reject.invalid'):
+            return '550 Mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        message = message_from_bytes(envelope.content)
+        if self.on_data:
+            await sync_to_async(self.on_data, thread_sensitive=False)(message)
+        self.messages.append(message)
+        return '250 Message accepted for delivery'
+
+
+# The lock check needs a second connection that sees the outbox's commits
+class OutboxTests(TransactionTestCase):
+
+    def setUp(self):
+        self.inbox = Inbox()
+        port = free_port()
+        controller = Controller(self.inbox, hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        smtp = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1', EMAIL_PORT=port,
+            EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', DEFAULT_FROM_EMAIL='outbox@test.invalid',
+        )
+        smtp.enable()
+        self.addCleanup(smtp.disable)
+
+    def enqueue(self, count, domain='test.invalid'):
+        return [enqueue_email(f'email {index}', 'body', [f'user{index}@{domain}']) for index in range(count)]
+
+    def received(self):
+        return sorted(message['Subject'] for message in self.inbox.messages)
+
+    def test_batch_is_delivered(self):
+        self.enqueue(3)
+
+        self.assertEqual(send_batch(), 3)
+
+        self.assertEqual(self.received(), ['email 0', 'email 1', 'email 2'])
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT, attempts=1).count(), 3)
+        self.assertEqual(send_batch(), 0)
+
+    def test_rows_are_not_locked_while_smtp_runs(self):
+        self.enqueue(2)
+        seen = []
+
+        def lock_row(message):
+            # Runs on its own thread and connection while the outbox waits for the SMTP reply
+            try:
+                with transaction.atomic():
+                    email = OutboundEmail.objects.select_for_update(nowait=True).get(subject=message['Subject'])
+                    seen.append(email.status)
+            except DatabaseError as e:
+                seen.append(e)
+            finally:
+                connections.close_all()
+
+        self.inbox.on_data = lock_row
+        self.assertEqual(send_batch(), 2)
+
+        self.assertEqual(seen, [OutboundEmail.SENDING, OutboundEmail.SENDING])
+
+    def test_killed_worker_leaves_unsent_rows_to_the_lease(self):
+        self.enqueue(5)
+        connection = get_connection()
+        send_messages = connection.send_messages
+
+        def killed_on_third(messages):
+            if len(self.inbox.messages) == 2:
+                raise SystemExit
+            return send_messages(messages)
+
+        with mock.patch.object(connection, 'send_messages', side_effect=killed_on_third):
+            with self.assertRaises(SystemExit):
+                send_batch(connection=connection)
+        connection.close()
+
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 2)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENDING).count(), 3)
+        # Another worker leaves the claimed rows alone until the lease runs out
+        self.assertEqual(send_batch(), 0)
+
+        later = timezone.now() + timedelta(seconds=settings.OUTBOX['LEASE'] + 1)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(send_batch(), 3)
+
+        self.assertEqual(self.received(), [f'email {index}' for index in range(5)])
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 5)
+
+    def test_rejected_email_is_retried_with_backoff(self):
+        rejected = self.enqueue(1, domain='reject.invalid')[0]
+        self.enqueue(1)
+
+        started = timezone.now()
+        self.assertEqual(send_batch(), 2)
+
+        # The rejection does not stop the rest of the batch
+        self.assertEqual(self.received(), ['email 0'])
+        rejected.refresh_from_db()
+        self.assertEqual(rejected.status, OutboundEmail.PENDING)
+        self.assertEqual(rejected.attempts, 1)
+        self.assertIn('550', rejected.last_error)
+        self.assertGreaterEqual(rejected.next_attempt_at, started + timedelta(seconds=settings.OUTBOX['BACKOFF']))
+        self.assertEqual(send_batch(), 0)
+
+        with override_settings(OUTBOX={**settings.OUTBOX, 'MAX_ATTEMPTS': 2}):
+            with mock.patch('django.utils.timezone.now', return_value=rejected.next_attempt_at):
+                self.assertEqual(send_batch(), 1)
+        rejected.refresh_from_db()
+        self.assertEqual(rejected.status, OutboundEmail.FAILED)
+        self.assertEqual(rejected.attempts, 2)
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 
+from HospitalSystem.media import absolute_media_url
 from medicalBook.models import MedicalBook
 from users.models import User
 
@@ -17,10 +18,7 @@ class MedicalBookSerializer(serializers.ModelSerializer):
                   'treatment', 'tests', 'created_at')
 
     def get_tests(self, obj):
-        request = self.context.get('request')
-        if obj.tests:
-            return request.build_absolute_uri(obj.tests.url)
-        return None
+        return absolute_media_url(self.context.get('request'), obj.tests)
 
     def get_patient_name(self, obj):
         return f"{obj.patient.first_name} {obj.patient.last_name}"
@@ -28,11 +26,11 @@ class MedicalBookSerializer(serializers.ModelSerializer):
     def get_doctor_name(self, obj):
         return f"{obj.doctor.first_name} {obj.doctor.last_name}"
 
-    def doctor_id(self, obj):
-        return obj.doctor.id
+    def get_doctor_id(self, obj):
+        return obj.doctor_id
 
-    def patient_id(self, obj):
-        return obj.patient.id
+    def get_patient_id(self, obj):
+        return obj.patient_id
 
 
 class CreateMedicalBookSerializer(serializers.ModelSerializer):
@@ -70,3 +68,14 @@ class CreateMedicalBookSerializer(serializers.ModelSerializer):
         )
 
         return medicalbook
+
+
+class MedicalTestsUploadSerializer(serializers.Serializer):
+    book_id = serializers.IntegerField()
+    file_name = serializers.CharField(max_length=255)
+    file_type = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    size = serializers.IntegerField(min_value=1)
+
+
+class MedicalTestsFinalizeSerializer(serializers.Serializer):
+    upload_token = serializers.CharField()
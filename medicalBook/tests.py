@@ -0,0 +1,32 @@
+from django.test import TestCase
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from HospitalSystem.query_budget import assert_query_budget
+from HospitalSystem.testing import make_user
+from medicalBook.models import MedicalBook
+from medicalBook.views import GetMedicalBooksView, GetMedicalBookView
+
+
+class MedicalBookQueryBudgetTests(TestCase):
+
+    def setUp(self):
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.patient)}')
+
+    def get(self, view, url):
+        with assert_query_budget(view.query_budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_books_stay_within_budget(self):
+        for count in (1, 20):
+            for index in range(MedicalBook.objects.count(), count):
+                doctor = make_user(f'doctor{index}@test.invalid', 'doctor')
+                book = MedicalBook.objects.create(patient=self.patient, doctor=doctor, diagnosis=f'diagnosis {index}')
+            with self.subTest(count=count):
+                self.assertEqual(len(self.get(GetMedicalBooksView, '/book/get-all/')), count)
+                books = self.get(GetMedicalBookView, f'/book/get/?id={book.id}')
+                self.assertEqual([entry['id'] for entry in books], [book.id])
@@ -5,5 +5,7 @@ from medicalBook import views
 urlpatterns = [
     path('create/', views.CreateMedicalBookView.as_view()),
     path('get-all/', views.GetMedicalBooksView.as_view()),
-    path('get/', views.GetMedicalBookView.as_view())
+    path('get/', views.GetMedicalBookView.as_view()),
+    path('tests/upload/', views.MedicalTestsUploadView.as_view()),
+    path('tests/finalize/', views.MedicalTestsFinalizeView.as_view()),
 ]
@@ -1,20 +1,23 @@
 from datetime import date, datetime
 
+from django.conf import settings
 from drf_spectacular.utils import extend_schema
 from rest_framework import status
 from rest_framework.generics import CreateAPIView, ListAPIView, GenericAPIView
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework_simplejwt.authentication import JWTAuthentication
 
+from HospitalSystem.media import presign_upload, resolve_upload, DirectUploadError
 from medicalBook.models import MedicalBook
-from medicalBook.seralizers import CreateMedicalBookSerializer, MedicalBookSerializer
+from medicalBook.seralizers import CreateMedicalBookSerializer, MedicalBookSerializer, MedicalTestsUploadSerializer, \
+    MedicalTestsFinalizeSerializer
 from patient.models import Appointment
+from users.authentication import RoleJWTAuthentication
 
 
 class CreateMedicalBookView(CreateAPIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = (IsAuthenticated,)
     parser_classes = [MultiPartParser, FormParser]
     serializer_class = CreateMedicalBookSerializer
@@ -42,7 +45,7 @@ class CreateMedicalBookView(CreateAPIView):
     @extend_schema(description="Create medical book")
     def perform_create(self, serializer):
         doctor = self.request.user
-        if doctor.roles.role == 'doctor':
+        if doctor.role == 'doctor':
             if serializer.is_valid(raise_exception=True):
                 # Сохранение данных
                 medicalbook = serializer.save(doctor=doctor)
@@ -51,27 +54,77 @@ class CreateMedicalBookView(CreateAPIView):
 
 
 class GetMedicalBooksView(ListAPIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = (IsAuthenticated,)
     serializer_class = MedicalBookSerializer
+    query_budget = 2
 
     @extend_schema(description="Get medical books")
     def get_queryset(self):
         patient = self.request.user
-        if patient.roles.role == 'patient':
-            medicalbooks = MedicalBook.objects.filter(patient=patient)
+        if patient.role == 'patient':
+            medicalbooks = MedicalBook.objects.filter(patient=patient).select_related('patient', 'doctor')
             return medicalbooks
 
 
 class GetMedicalBookView(ListAPIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = (IsAuthenticated,)
     serializer_class = MedicalBookSerializer
+    query_budget = 2
 
     @extend_schema(description="Get medical book")
     def get_queryset(self):
         patient = self.request.user
         id = self.request.query_params.get('id')
-        if patient.roles.role == 'patient':
-            medicalbooks = MedicalBook.objects.filter(patient=patient, id=id)
+        if patient.role == 'patient':
+            medicalbooks = MedicalBook.objects.filter(patient=patient, id=id).select_related('patient', 'doctor')
             return medicalbooks
+
+
+class MedicalTestsUploadView(GenericAPIView):
+    authentication_classes = [RoleJWTAuthentication, ]
+    permission_classes = (IsAuthenticated,)
+    serializer_class = MedicalTestsUploadSerializer
+
+    @extend_schema(description="Get a pre-signed URL to upload test files for a medical book")
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        book = MedicalBook.objects.filter(id=data['book_id'], doctor=request.user).first()
+        if not book:
+            return Response({"detail": "Medical book not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        if data['size'] > settings.MEDICAL_TESTS_MAX_SIZE:
+            return Response({"detail": f"File is larger than {settings.MEDICAL_TESTS_MAX_SIZE} bytes."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        upload = presign_upload(
+            MedicalBook._meta.get_field('tests').upload_to, data['file_name'], data.get('file_type') or None,
+            settings.MEDICAL_TESTS_MAX_SIZE, user=request.user.id, book=book.id
+        )
+        return Response(upload, status=status.HTTP_200_OK)
+
+
+class MedicalTestsFinalizeView(GenericAPIView):
+    authentication_classes = [RoleJWTAuthentication, ]
+    permission_classes = (IsAuthenticated,)
+    serializer_class = MedicalTestsFinalizeSerializer
+
+    @extend_schema(description="Attach uploaded test files to a medical book")
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            upload = resolve_upload(serializer.validated_data['upload_token'], user=request.user.id)
+        except DirectUploadError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        book = MedicalBook.objects.get(id=upload['book'])
+        book.tests = upload['key']
+        book.save(update_fields=['tests'])
+
+        return Response(MedicalBookSerializer(book, context={'request': request}).data, status=status.HTTP_200_OK)
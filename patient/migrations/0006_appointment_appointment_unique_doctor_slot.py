@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+from HospitalSystem.migration_operations import add_unique_concurrently
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('patient', '0005_alter_appointment_doctor_alter_appointment_patient_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=add_unique_concurrently(
+                'patient_appointment', 'appointment_unique_doctor_slot', '"doctor_id", "date", "time"',
+            ),
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='appointment',
+                    constraint=models.UniqueConstraint(
+                        fields=('doctor', 'date', 'time'), name='appointment_unique_doctor_slot',
+                    ),
+                ),
+            ],
+        ),
+    ]
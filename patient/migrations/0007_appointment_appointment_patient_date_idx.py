@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:19
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('patient', '0006_appointment_appointment_unique_doctor_slot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='appointment',
+            index=models.Index(fields=['patient', 'date'], name='appointment_patient_date_idx'),
+        ),
+    ]
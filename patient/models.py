@@ -22,6 +22,10 @@ class Appointment(models.Model):
         (time(18, 0), '06:00 PM'),
     ]
 
+    # A slot is booked for an hour; the visit itself, as shown to patients, takes the first 50 minutes
+    SLOT_DURATION = datetime.timedelta(hours=1)
+    VISIT_DURATION = datetime.timedelta(minutes=50)
+
     patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='patient',
                                 limit_choices_to={'roles__role': 'patient'})
     doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='doctor',
@@ -32,6 +36,16 @@ class Appointment(models.Model):
     message = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # The database is the only arbiter of concurrent bookings for the same slot
+            models.UniqueConstraint(fields=['doctor', 'date', 'time'], name='appointment_unique_doctor_slot'),
+        ]
+        indexes = [
+            # (doctor, date) lookups are served by the slot constraint above
+            models.Index(fields=['patient', 'date'], name='appointment_patient_date_idx'),
+        ]
+
     def clean(self):
         # Проверка даты
         if self.date < datetime.date.today():
@@ -54,6 +68,6 @@ class Appointment(models.Model):
         self.clean()  # Ensure that validations are called before saving
         if self.time:
             start_datetime = datetime.datetime.combine(self.date, self.time)
-            end_datetime = start_datetime + datetime.timedelta(hours=1)
+            end_datetime = start_datetime + self.SLOT_DURATION
             self.end_time = end_datetime.time()
         super().save(*args, **kwargs)
@@ -1,4 +1,6 @@
 from rest_framework import serializers
+
+from HospitalSystem.media import absolute_media_url
 from users.models import User, Role
 
 
@@ -11,10 +13,7 @@ class PatientSerializer(serializers.ModelSerializer):
         fields = ('id', 'avatar', 'first_name', 'last_name', 'email', 'phone', 'gender', 'date_birth', 'roles')
 
     def get_avatar(self, obj):
-        request = self.context.get('request')
-        if obj.avatar:
-            return request.build_absolute_uri(obj.avatar.url)
-        return None
+        return absolute_media_url(self.context.get('request'), obj.avatar)
 
 
 class PatientRegisterSerializer(serializers.ModelSerializer):
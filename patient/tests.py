@@ -1,3 +1,21 @@
-from django.test import TestCase
+import datetime
 
-# Create your tests here.
+from HospitalSystem.testing import QueryPlanTestCase, make_user
+from patient.models import Appointment
+
+
+class IndexUsageTests(QueryPlanTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.patient = make_user('patient@test.invalid', 'patient')
+        self.day = datetime.date.today()
+
+    def test_patient_appointments_use_patient_date_index(self):
+        appointments = Appointment.objects.filter(patient=self.patient, date__gte=self.day)
+        self.assertUsesIndex(appointments, 'appointment_patient_date_idx')
+
+    def test_doctor_appointments_use_slot_constraint(self):
+        appointments = Appointment.objects.filter(doctor=self.doctor, date__gte=self.day)
+        self.assertUsesIndex(appointments, 'appointment_unique_doctor_slot')
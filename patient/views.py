@@ -3,9 +3,9 @@ from drf_spectacular.utils import extend_schema
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
-from rest_framework_simplejwt.authentication import JWTAuthentication
 
 from patient.serializers import PatientSerializer, PatientRegisterSerializer
+from users.authentication import RoleJWTAuthentication
 from users.models import User
 
 
@@ -14,12 +14,12 @@ from users.models import User
 class PatientsList(generics.ListAPIView):
     queryset = User.objects.all()
     serializer_class = PatientSerializer
-    permission_classes = (JWTAuthentication,)
-    authentication_classes = (IsAuthenticated,)
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (RoleJWTAuthentication,)
 
     @extend_schema(description="Get patient list")
     def get_queryset(self):
-        queryset = User.objects.filer(roles__role='patient').related_name('role')
+        queryset = User.objects.filter(roles__role='patient').select_related('roles', 'sub_role')
         return queryset
 
 
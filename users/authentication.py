@@ -0,0 +1,24 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+class UsersWithRoles:
+    """
+    Stands in for the user model inside JWTAuthentication.get_user, which looks users up through
+    ``user_model.objects`` and catches ``user_model.DoesNotExist``.
+    """
+
+    def __init__(self, model):
+        self.objects = model.objects.select_related('roles', 'sub_role')
+        self.DoesNotExist = model.DoesNotExist
+
+
+class RoleJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that loads the user together with ``roles`` and ``sub_role`` in one query,
+    so role checks in views and serializers never hit the database again. simplejwt's own
+    get_user still runs the active and revoked-token checks.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_model = UsersWithRoles(self.user_model)
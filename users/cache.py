@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from users.models import User, Role, SubRole
+
+
+def _snapshot_key(user_id):
+    return f'user_snapshot:{user_id}'
+
+
+def make_user_snapshot(user):
+    return {
+        'id': user.id,
+        'email': user.email,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'avatar': user.avatar.name or None,
+        'is_active': user.is_active,
+        'is_staff': user.is_staff,
+        'is_blocked': user.is_blocked,
+        'roles': (user.roles.id, user.roles.role) if user.roles else None,
+        'sub_role': (user.sub_role.id, user.sub_role.sub_role) if user.sub_role else None,
+    }
+
+
+def user_from_snapshot(snapshot):
+    """
+    Rebuild an unsaved-looking but fully usable User from a snapshot, with roles and sub_role
+    already attached so ``user.roles.role`` needs no query.
+    """
+    fields = {key: value for key, value in snapshot.items() if key not in ('roles', 'sub_role')}
+    user = User(**fields)
+    user._state.adding = False
+    user._state.db = 'default'
+    if snapshot['roles']:
+        role_id, role = snapshot['roles']
+        user.roles = Role(id=role_id, role=role)
+    if snapshot['sub_role']:
+        sub_role_id, sub_role = snapshot['sub_role']
+        user.sub_role = SubRole(id=sub_role_id, sub_role=sub_role)
+    return user
+
+
+def get_cached_user(user_id):
+    """Return the user for ``user_id`` from the snapshot cache, loading it once on a miss."""
+    snapshot = cache.get(_snapshot_key(user_id))
+    if snapshot is None:
+        user = User.objects.select_related('roles', 'sub_role').filter(id=user_id).first()
+        if user is None:
+            return None
+        snapshot = make_user_snapshot(user)
+        cache.set(_snapshot_key(user_id), snapshot, settings.USER_SNAPSHOT_CACHE_TIMEOUT)
+    return user_from_snapshot(snapshot)
+
+
+def invalidate_user_snapshot(user_id):
+    cache.delete(_snapshot_key(user_id))
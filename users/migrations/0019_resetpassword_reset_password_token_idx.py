@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:19
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('users', '0018_alter_user_avatar'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='resetpassword',
+            index=models.Index(fields=['token'], name='reset_password_token_idx'),
+        ),
+    ]
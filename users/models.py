@@ -96,8 +96,17 @@ class User(AbstractUser):
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
 
+    @property
+    def role(self):
+        return self.roles.role if self.roles_id else None
+
 
 class ResetPassword(models.Model):
     email = models.EmailField()
     token = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['token'], name='reset_password_token_idx'),
+        ]
@@ -3,6 +3,8 @@ from django.contrib.auth import get_user_model, authenticate
 
 from django.utils.translation import gettext as _
 
+from HospitalSystem.media import absolute_media_url
+
 User = get_user_model()
 
 
@@ -17,10 +19,7 @@ class UserSerializer(serializers.ModelSerializer):
                   "sub_role", "is_blocked")
 
     def get_avatar(self, obj):
-        request = self.context.get('request')
-        if obj.avatar:
-            return request.build_absolute_uri(obj.avatar.url)
-        return None
+        return absolute_media_url(self.context.get('request'), obj.avatar)
 
 
 class LoginSerializer(serializers.Serializer):
@@ -1,3 +1,46 @@
 from django.test import TestCase
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from HospitalSystem.testing import QueryPlanTestCase, make_user
+from users.models import ResetPassword, SubRole, User
+
+
+class IndexUsageTests(QueryPlanTestCase):
+
+    def test_reset_password_token_lookup_uses_index(self):
+        self.assertUsesIndex(ResetPassword.objects.filter(token='token'), 'reset_password_token_idx')
+
+
+class RoleJWTAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.doctor = make_user('doctor@test.invalid', 'doctor')
+        self.doctor.sub_role = SubRole.objects.create(sub_role='cardiologist')
+        self.doctor.save()
+
+    def authenticate(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+
+    def test_roles_come_with_the_user(self):
+        self.authenticate(self.doctor)
+        with self.assertNumQueries(1):
+            response = self.client.get('/users/detail/')
+        self.assertEqual((response.data['roles'], response.data['sub_role']), ('doctor', 'cardiologist'))
+
+        # The role check that turns doctors away costs nothing beyond authentication
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/doctor/specialist/').status_code, 403)
+
+        self.authenticate(make_user('patient@test.invalid', 'patient'))
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get('/chat/get_chat/').status_code, 200)
+
+    def test_inactive_and_deleted_users_are_rejected(self):
+        self.authenticate(self.doctor)
+        User.objects.filter(id=self.doctor.id).update(is_active=False)
+        self.assertEqual(self.client.get('/users/detail/').status_code, 401)
+
+        User.objects.filter(id=self.doctor.id).delete()
+        self.assertEqual(self.client.get('/users/detail/').status_code, 401)
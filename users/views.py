@@ -1,8 +1,4 @@
-from smtplib import SMTPDataError
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
 from drf_spectacular.utils import extend_schema
 from rest_framework import generics, status
 from django.shortcuts import get_object_or_404
@@ -11,8 +7,11 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.tokens import RefreshToken
+from doctor.directory import bump_directory_version
+from mailer.outbox import enqueue_template_email
+from users.authentication import RoleJWTAuthentication
+from users.cache import invalidate_user_snapshot
 from users.models import User, SubRole, ResetPassword
 from users.serializers import LoginSerializer, UserSerializer, UserUpdateProfileSerializer, \
     ResetPasswordRequestSerializer, PasswordResetSerializer
@@ -50,7 +49,7 @@ class LoginView(generics.GenericAPIView):
             refresh = RefreshToken.for_user(user)
             return Response({
                 "user": user.email,
-                "role": user.roles.role,
+                "role": user.role,
                 "Admin": user.is_staff,
                 "refreshToken": str(refresh),
                 "accessToken": str(refresh.access_token),
@@ -59,7 +58,7 @@ class LoginView(generics.GenericAPIView):
 
 
 class LogoutView(APIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = [IsAuthenticated, ]
 
     @extend_schema(description="Logout user")
@@ -81,7 +80,7 @@ class LogoutView(APIView):
 
 
 class UserDetailView(generics.RetrieveAPIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = [IsAuthenticated, ]
 
     @extend_schema(description="Get user details")
@@ -91,7 +90,7 @@ class UserDetailView(generics.RetrieveAPIView):
 
 
 class UserUpdateView(generics.UpdateAPIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = [IsAuthenticated, ]
     serializer_class = UserUpdateProfileSerializer
     parser_classes = [MultiPartParser, FormParser]
@@ -105,6 +104,9 @@ class UserUpdateView(generics.UpdateAPIView):
         serializer = self.get_serializer(user, data=request.data, partial=True)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            invalidate_user_snapshot(user.id)
+            if user.role == 'doctor':
+                bump_directory_version()
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -118,11 +120,11 @@ class GetSpecificUserView(generics.RetrieveAPIView):
     def get(self, request, *args, **kwargs):
         user_id = request.query_params.get('user_id')
         user = request.user
-        if user.roles.role == 'patient' or user.roles.role == 'admin':
+        if user.role == 'patient' or user.role == 'admin':
             user = get_object_or_404(User, id=user_id, roles__role='doctor')
             serializer = self.serializer_class(user, context={'request': request})
             return Response(serializer.data)
-        elif user.roles.role == 'doctor' or user.roles.role == 'admin':
+        elif user.role == 'doctor' or user.role == 'admin':
             user = get_object_or_404(User, id=user_id, roles__role='patient')
             serializer = self.serializer_class(user, context={'request': request})
             return Response(serializer.data)
@@ -143,20 +145,9 @@ class RequestPasswordReset(generics.GenericAPIView):
             reset = ResetPassword(email=email, token=token)
             reset.save()
             reset_link = f"{env.str('RESET_PASSWORD_URL')}/{token}"
-            try:
-                subject = f"Reset Password"
-                html_message = render_to_string('reset_password.html', {
-                    'reset_link': reset_link
-                })
-                message = strip_tags(html_message)
-                email = EmailMultiAlternatives(
-                    subject=subject,
-                    body=message,
-                    to=[email])
-                email.attach_alternative(html_message, 'text/html')
-                email.send()
-            except SMTPDataError as e:
-                print(e)
+            enqueue_template_email("Reset Password", 'reset_password', {
+                'reset_link': reset_link
+            }, [email])
             return Response({"message": "Password reset link sent to your email."}, status=status.HTTP_200_OK)
 
         return Response({"message": "User with this email does not exist."}, status=status.HTTP_404_NOT_FOUND)
@@ -192,7 +183,7 @@ class ResetPasswordView(generics.GenericAPIView):
 
 
 class UsersForAdmin(GenericAPIView):
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     permission_classes = [IsAuthenticated, IsAdminUser]
     serializer_class = UserSerializer
 
@@ -207,7 +198,7 @@ class UsersForAdmin(GenericAPIView):
 
 class BlockUserView(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated, IsAdminUser]
-    authentication_classes = [JWTAuthentication, ]
+    authentication_classes = [RoleJWTAuthentication, ]
     lookup_field = 'user_id'
     lookup_url_kwarg = 'user_id'
 
@@ -228,6 +219,7 @@ class BlockUserView(generics.UpdateAPIView):
 
         user.is_blocked = not user.is_blocked
         user.save()
+        invalidate_user_snapshot(user.id)
 
         return Response({
             "message": f"User {'blocked' if user.is_blocked else 'unblocked'} successfully",